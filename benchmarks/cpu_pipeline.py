@@ -0,0 +1,94 @@
+"""
+CPU latency/throughput benchmark for fast_diffusion_pipeline
+
+Renders from pre-computed encodings (the explorer's hot path) at several resolutions and thread counts.
+
+Usage:
+    python -m benchmarks.cpu_pipeline --resolutions 256 512 --threads 1 4 8 --dtype bf16
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+
+from faceforge_core.fast_sd import fast_diffusion_pipeline, set_cpu_threads
+
+def time_renders(pipe, encodes, latents, resolution, iters, warmup):
+    """
+    Latencies (ms) of `iters` renders, after `warmup` untimed ones
+    """
+    times = []
+    for i in range(warmup + iters):
+        start = time.perf_counter()
+        pipe.generate_from_encodes(list(encodes), latents = latents, height = resolution, width = resolution, output_type = "np")
+        if i >= warmup:
+            times.append((time.perf_counter() - start) * 1000)
+    return np.array(times)
+
+def time_decodes(pipe, latents, iters, warmup):
+    """
+    Latencies (ms) of decoding denoised latents only, the cost of a preview render
+    """
+    times = []
+    for i in range(warmup + iters):
+        start = time.perf_counter()
+        pipe.decode(latents, output_type = "np")
+        if i >= warmup:
+            times.append((time.perf_counter() - start) * 1000)
+    return np.array(times)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark fast_diffusion_pipeline on cpu")
+    parser.add_argument("--model-id", default = "stabilityai/sdxl-turbo")
+    parser.add_argument("--vae-id", default = "madebyollin/taesdxl")
+    parser.add_argument("--dtype", default = "fp32", help = "fp32 or bf16")
+    parser.add_argument("--resolutions", type = int, nargs = "+", default = [256, 512])
+    parser.add_argument("--threads", type = int, nargs = "+", default = [torch.get_num_threads()])
+    parser.add_argument("--interop-threads", type = int, default = None)
+    parser.add_argument("--batch-size", type = int, default = 1)
+    parser.add_argument("--iters", type = int, default = 10)
+    parser.add_argument("--warmup", type = int, default = 2)
+    parser.add_argument("--compile", action = "store_true", help = "torch.compile the unet and decoder")
+    parser.add_argument("--no-channels-last", action = "store_true")
+    parser.add_argument("--prompt", default = "A photo of a face")
+    parser.add_argument("--json", default = None, help = "Also write results to this file")
+    args = parser.parse_args()
+
+    pipe = fast_diffusion_pipeline(
+        model_id = args.model_id, vae_id = args.vae_id, compile = args.compile, device = "cpu", dtype = args.dtype,
+        num_interop_threads = args.interop_threads, channels_last = not args.no_channels_last,
+    )
+    encodes = pipe.get_encodes([args.prompt] * args.batch_size)
+
+    results = []
+    print(f"{'threads':>8} {'res':>6} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10} {'img/s':>8} {'decode ms':>10}")
+    for threads in args.threads:
+        set_cpu_threads(threads)
+        for resolution in args.resolutions:
+            latents = pipe.initial_latents(0, batch_size = args.batch_size, height = resolution, width = resolution, dtype = encodes[0].dtype)
+            times = time_renders(pipe, encodes, latents, resolution, args.iters, args.warmup)
+            denoised = pipe.generate_from_encodes(list(encodes), latents = latents, height = resolution, width = resolution, output_type = "latent").images
+            decode_times = time_decodes(pipe, denoised, args.iters, args.warmup)
+            row = {
+                "threads" : threads,
+                "resolution" : resolution,
+                "batch_size" : args.batch_size,
+                "dtype" : args.dtype,
+                "mean_ms" : float(times.mean()),
+                "p50_ms" : float(np.percentile(times, 50)),
+                "p95_ms" : float(np.percentile(times, 95)),
+                "images_per_s" : float(args.batch_size * 1000 / times.mean()),
+                "decode_mean_ms" : float(decode_times.mean()),
+            }
+            results.append(row)
+            print(f"{threads:>8} {resolution:>6} {row['mean_ms']:>10.1f} {row['p50_ms']:>10.1f} {row['p95_ms']:>10.1f} {row['images_per_s']:>8.2f} {row['decode_mean_ms']:>10.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent = 2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Time of each classifier_direction solver against its agreement with the logistic regression direction
+
+Latents are synthetic, shaped like text embeddings: a few strong correlated directions plus isotropic noise, with
+labels from a noisy linear rule. The reference is sklearn's logistic regression run to convergence; the default
+(100 iteration) logistic solver is timed and compared like the others.
+
+With --attributes K, also times fitting K attributes of the same latents one by one (a new finder each, like K
+/attribute_direction calls) against one classifier_directions call sharing the statistics.
+
+Usage:
+    python -m benchmarks.direction_solvers --sizes 4000x1280 10000x2048
+    python -m benchmarks.direction_solvers --sizes 4000x1280 --attributes 40 --solvers mean_diff lda sgd
+"""
+
+import argparse
+import json
+import time
+import warnings
+
+import numpy as np
+from sklearn.exceptions import ConvergenceWarning
+
+from faceforge_core.attribute_directions import LatentDirectionFinder
+
+def synthetic_latents(n, d, rank = 32, seed = 0):
+    """
+    (latents [N, D], 0/1 labels [N], true direction [D])
+    """
+    rng = np.random.default_rng(seed)
+    latents = rng.standard_normal((n, rank)) @ (2 * rng.standard_normal((rank, d))) + rng.standard_normal((n, d))
+    direction = rng.standard_normal(d)
+    direction /= np.linalg.norm(direction)
+    score = latents @ direction
+    labels = (score / score.std() + rng.standard_normal(n) > 0).astype(int)
+    return latents, labels, direction
+
+def synthetic_labels(latents, k, seed = 0):
+    """
+    (N, K) labels, each column from its own noisy linear rule
+    """
+    rng = np.random.default_rng(seed)
+    score = latents @ rng.standard_normal((latents.shape[1], k))
+    return (score / score.std(0) + rng.standard_normal(score.shape) > 0).astype(int)
+
+def time_attributes(latents, labels, solver):
+    """
+    (seconds one by one, seconds together, min cosine between the two) for the columns of labels
+    """
+    start = time.perf_counter()
+    single = np.stack([LatentDirectionFinder(latents).classifier_direction(y, solver = solver) for y in labels.T])
+    separate = time.perf_counter() - start
+    start = time.perf_counter()
+    shared = LatentDirectionFinder(latents).classifier_directions(labels, solver = solver)
+    together = time.perf_counter() - start
+    return separate, together, float((single * shared).sum(1).min())
+
+def time_solver(finder, labels, solver, repeats, **kwargs):
+    """
+    (median seconds, direction)
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        direction = finder.classifier_direction(labels, solver = solver, **kwargs)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)), direction
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark classifier_direction solvers")
+    parser.add_argument("--sizes", nargs = "+", default = ["1000x512", "4000x1280", "10000x2048"], help = "NxD latent matrices")
+    parser.add_argument("--solvers", nargs = "+", default = list(LatentDirectionFinder.SOLVERS))
+    parser.add_argument("--repeats", type = int, default = 3)
+    parser.add_argument("--attributes", type = int, default = 0, help = "Also time fitting this many attributes separately vs together")
+    parser.add_argument("--json", default = None, help = "Also write results to this file")
+    args = parser.parse_args()
+    warnings.filterwarnings("ignore", category = ConvergenceWarning)
+
+    results = []
+    print(f"{'N x D':>12} {'solver':>10} {'seconds':>9} {'speedup':>8} {'cos ref':>8} {'cos true':>9}")
+    for size in args.sizes:
+        n, d = (int(v) for v in size.split("x"))
+        latents, labels, true_direction = synthetic_latents(n, d)
+        finder = LatentDirectionFinder(latents)
+        ref_time, reference = time_solver(finder, labels, "logistic", 1, max_iter = 10000)
+        print(f"{size:>12} {'reference':>10} {ref_time:>9.3f}")
+        for solver in args.solvers:
+            seconds, direction = time_solver(finder, labels, solver, args.repeats)
+            row = {
+                "n" : n,
+                "d" : d,
+                "solver" : solver,
+                "seconds" : seconds,
+                "speedup" : ref_time / seconds,
+                "cos_reference" : float(direction @ reference),
+                "cos_true" : float(direction @ true_direction),
+            }
+            results.append(row)
+            print(f"{size:>12} {solver:>10} {seconds:>9.3f} {row['speedup']:>8.1f} {row['cos_reference']:>8.3f} {row['cos_true']:>9.3f}")
+
+    if args.attributes:
+        print(f"\n{args.attributes} attributes")
+        print(f"{'N x D':>12} {'solver':>10} {'separate s':>11} {'together s':>11} {'speedup':>8} {'min cos':>8}")
+        for size in args.sizes:
+            n, d = (int(v) for v in size.split("x"))
+            latents, _, _ = synthetic_latents(n, d)
+            labels = synthetic_labels(latents, args.attributes)
+            for solver in args.solvers:
+                separate, together, agreement = time_attributes(latents, labels, solver)
+                results.append({
+                    "n" : n,
+                    "d" : d,
+                    "solver" : solver,
+                    "attributes" : args.attributes,
+                    "separate_seconds" : separate,
+                    "together_seconds" : together,
+                    "min_cos_separate" : agreement,
+                })
+                print(f"{size:>12} {solver:>10} {separate:>11.3f} {together:>11.3f} {separate / together:>8.1f} {agreement:>8.3f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent = 2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Throughput and convergence of EditStrengthOptimizer on the tiny stand-in model's decoder, by batch size and precision
+
+Targets are the predictions of a fixed random attribute predictor at known alphas, so how close the optimized alphas
+get to those (alpha error) measures convergence along with the loss. Batch size 1 is the one-sample-at-a-time baseline.
+
+Usage:
+    python -m benchmarks.edit_strength --samples 64 --batch-sizes 1 8 64 --precisions fp32 bf16
+"""
+
+import argparse
+import json
+import time
+
+import torch
+
+from faceforge_core.fast_sd import DTYPES, tiny_diffusion_pipeline
+from faceforge_core.edit_strength import EditStrengthOptimizer, latent_decoder
+
+def setup(samples, seed = 0):
+    """
+    Generator, predictor, latents, direction, target alphas and the targets they give
+    """
+    pipe = tiny_diffusion_pipeline(seed = seed)
+    generator = latent_decoder(pipe)
+    with torch.random.fork_rng(devices = []):
+        torch.manual_seed(seed)
+        predictor = torch.nn.Sequential(
+            torch.nn.Conv2d(3, 8, 3, stride = 2), torch.nn.SiLU(), torch.nn.AdaptiveAvgPool2d(1), torch.nn.Flatten(), torch.nn.Linear(8, 1)
+        )
+        latents = torch.randn(samples, 4, 8, 8)
+        direction = torch.randn(4, 8, 8)
+        alphas = torch.rand(samples) * 2 - 1
+    for p in list(predictor.parameters()) + list(pipe.vae.parameters()):
+        p.requires_grad_(False)
+    direction *= 8 / direction.norm()
+    with torch.no_grad():
+        targets = predictor(generator(latents + alphas[:, None, None, None] * direction))
+    return generator, predictor, latents, direction, alphas, targets
+
+def run(optimizer, latents, direction, targets, alphas, batch_size):
+    """
+    Optimize all samples in batches of batch_size, summary over all of them
+    """
+    results = []
+    start = time.perf_counter()
+    for i in range(0, len(latents), batch_size):
+        results.append(optimizer.optimize(latents[i:i + batch_size], direction, targets[i:i + batch_size]))
+    seconds = time.perf_counter() - start
+    found = torch.cat([r.alphas for r in results])
+    steps = torch.cat([r.steps for r in results]).float()
+    return {
+        "samples_per_s" : len(latents) / seconds,
+        "sample_steps_per_s" : sum(r.sample_steps for r in results) / seconds,
+        "mean_steps" : float(steps.mean()),
+        "converged" : float(torch.cat([r.converged for r in results]).float().mean()),
+        "loss_ratio" : float(torch.cat([r.losses for r in results]).sum() / torch.cat([r.initial_losses for r in results]).sum()),
+        "alpha_error" : float((found - alphas).abs().median()),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the batched edit strength optimizer on the tiny model")
+    parser.add_argument("--samples", type = int, default = 64)
+    parser.add_argument("--batch-sizes", type = int, nargs = "+", default = [1, 8, 64])
+    parser.add_argument("--precisions", nargs = "+", default = ["fp32", "bf16"], help = "Autocast dtypes, fp32 disables autocast")
+    parser.add_argument("--no-checkpoint", action = "store_true", help = "Keep the decoder's activations instead of recomputing them")
+    parser.add_argument("--micro-batch", type = int, default = None)
+    parser.add_argument("--max-steps", type = int, default = 200)
+    parser.add_argument("--json", default = None, help = "Also write results to this file")
+    args = parser.parse_args()
+
+    generator, predictor, latents, direction, alphas, targets = setup(args.samples)
+    rows = []
+    print(f"{'precision':>9} {'batch':>6} {'samples/s':>10} {'steps/s':>9} {'mean steps':>10} {'converged':>9} {'loss ratio':>10} {'alpha err':>9}")
+    for precision in args.precisions:
+        amp_dtype = None if DTYPES[precision] == torch.float32 else DTYPES[precision]
+        for batch_size in args.batch_sizes:
+            optimizer = EditStrengthOptimizer(
+                generator, predictor, lambda_recon = 0.0, max_steps = args.max_steps, amp_dtype = amp_dtype,
+                checkpoint = not args.no_checkpoint, micro_batch = args.micro_batch,
+            )
+            row = {"precision" : precision, "batch_size" : batch_size, **run(optimizer, latents, direction, targets, alphas, batch_size)}
+            rows.append(row)
+            print(f"{precision:>9} {batch_size:>6} {row['samples_per_s']:>10.1f} {row['sample_steps_per_s']:>9.0f} {row['mean_steps']:>10.1f} "
+                  f"{row['converged']:>9.0%} {row['loss_ratio']:>10.4f} {row['alpha_error']:>9.4f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent = 2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Memory, blend latency and quality of compressed anchor encodings (fp16, int8 with per-channel scales) against fp32
+
+Two parts:
+- SDXL shapes: N anchors of (77, 2048) prompt embeddings and (1280,) pooled embeddings of synthetic (random) data.
+  Bytes per anchor, p50 latency of a DistanceSampling blend and its error to the fp32 blend. The error is measured on
+  two made up outlier patterns: a few large channels, which per-channel scales suit, and one large token (like the BOS
+  token of SDXL's text encoders), which sets every channel's scale and costs the other tokens precision. Neither is
+  real data, so these errors only show how the scheme behaves, not what a checkpoint will see
+- Renders, with --model-id: prompts encoded by an SDXL checkpoint, blended at random points from fp32 and from
+  compressed anchors. Error of the blended encodings and pixel drift (0-255) of the images rendered from them.
+  These are the quality figures to go by. "tiny" runs the random stand-in, which only checks that the path works
+
+Usage:
+    python -m benchmarks.encoding_compression --anchors 8 64 --modes fp16 int8
+    python -m benchmarks.encoding_compression --model-id stabilityai/sdxl-turbo --resolution 512
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+
+from faceforge_core.fast_sd import fast_diffusion_pipeline
+from faceforge_core.sampling import DistanceSampling
+from faceforge_core.encoding_compression import anchor_memory, batch, compress_encoding
+
+SDXL_TOKENS, SDXL_DIM, SDXL_POOLED_DIM = 77, 2048, 1280
+DEFAULT_PROMPTS = ["A photo of a face", "A portrait of an old man", "A smiling woman with red hair", "A child with freckles"]
+
+OUTLIERS = ("channels", "tokens")
+
+def sdxl_anchors(n, outliers = "channels", seed = 0):
+    """
+    Per anchor encoding tuples shaped like SDXL's, as the explorers hold them. Synthetic data
+
+    :param outliers: "channels" (a few channels 20x larger) or "tokens" (the first token 50x larger)
+    """
+    generator = torch.Generator().manual_seed(seed)
+    embeds = torch.randn(n, SDXL_TOKENS, SDXL_DIM, generator = generator)
+    if outliers == "channels":
+        embeds[:, :, torch.randperm(SDXL_DIM, generator = generator)[:8]] *= 20
+    else:
+        embeds[:, 0] *= 50
+    pooled = torch.randn(n, SDXL_POOLED_DIM, generator = generator)
+    return [(embeds[i:i + 1], None, pooled[i:i + 1], None) for i in range(n)]
+
+def batched(anchors):
+    """
+    Per anchor encodings (compressed or not) into batched ones, like the pygame explorer's batch_encodings
+    """
+    return tuple(batch([a[j] for a in anchors]) for j in range(len(anchors[0])))
+
+def errors(blended, expected):
+    """
+    Relative error, max abs error and cosine similarity of blended encodings to the fp32 ones, over all components
+    """
+    b = torch.cat([x.double().flatten() for x in blended if x is not None])
+    e = torch.cat([x.double().flatten() for x in expected if x is not None])
+    return {
+        "rel_error" : float((b - e).norm() / e.norm()),
+        "max_abs_error" : float((b - e).abs().max()),
+        "cosine" : float(torch.nn.functional.cosine_similarity(b, e, dim = 0)),
+    }
+
+def blend_latency(encodes, point, positions, repeats):
+    sampler = DistanceSampling(encodes)
+    sampler(point, positions) # Warmup
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        sampler(point, positions)
+        times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times))
+
+def sdxl_shapes(n, modes, repeats, outliers):
+    rng = np.random.default_rng(0)
+    anchors = sdxl_anchors(n, outliers)
+    positions, point = rng.uniform(-1, 1, (n, 2)), rng.uniform(-1, 1, 2)
+    expected = DistanceSampling(batched(anchors))(point, positions)
+    rows = []
+    for mode in ["fp32"] + modes:
+        compression = None if mode == "fp32" else mode
+        stored = [compress_encoding(a, compression) for a in anchors]
+        encodes = batched(stored)
+        blended = DistanceSampling(encodes)(point, positions)
+        rows.append({
+            "anchors" : n, "outliers" : outliers, "mode" : mode, "bytes_per_anchor" : anchor_memory(stored)["bytes_per_anchor"],
+            "blend_ms" : blend_latency(encodes, point, positions, repeats), **errors(blended, expected),
+        })
+    return rows
+
+def renders(model_id, prompts, modes, points, resolution, seed = 0):
+    pipe = fast_diffusion_pipeline(model_id = model_id)
+    encodes = pipe.get_encodes(prompts)
+    anchors = [tuple(e[i:i + 1] if e is not None else None for e in encodes) for i in range(len(prompts))]
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform(-1, 1, (len(prompts), 2))
+    queries = rng.uniform(-1, 1, (points, 2))
+    latents = pipe.initial_latents(seed, height = resolution, width = resolution, dtype = encodes[0].dtype)
+
+    def render(encoding):
+        return pipe.generate_from_encodes(encoding, latents = latents, height = resolution, width = resolution, output_type = "np").images[0] * 255
+
+    expected = [DistanceSampling(batched(anchors))(q, positions) for q in queries]
+    expected_images = [render(e) for e in expected]
+    rows = []
+    for mode in modes:
+        stored = [compress_encoding(a, mode) for a in anchors]
+        encodes = batched(stored)
+        blended = [DistanceSampling(encodes)(q, positions) for q in queries]
+        drift = np.stack([np.abs(render(b) - e) for b, e in zip(blended, expected_images)])
+        errs = [errors(b, e) for b, e in zip(blended, expected)]
+        rows.append({
+            "model_id" : model_id, "mode" : mode, "bytes_per_anchor" : anchor_memory(stored)["bytes_per_anchor"],
+            "fp32_bytes_per_anchor" : anchor_memory(anchors)["bytes_per_anchor"],
+            "rel_error" : max(e["rel_error"] for e in errs), "cosine" : min(e["cosine"] for e in errs),
+            "mean_pixel_drift" : float(drift.mean()), "max_pixel_drift" : float(drift.max()),
+        })
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark compressed anchor encodings against fp32")
+    parser.add_argument("--anchors", type = int, nargs = "+", default = [8, 64])
+    parser.add_argument("--modes", nargs = "+", default = ["fp16", "int8"])
+    parser.add_argument("--repeats", type = int, default = 20)
+    parser.add_argument("--model-id", default = None, help = "SDXL checkpoint whose prompt encodings are compressed and rendered. Skipped if not given")
+    parser.add_argument("--prompts", nargs = "+", default = DEFAULT_PROMPTS)
+    parser.add_argument("--points", type = int, default = 4, help = "Blended points rendered per mode")
+    parser.add_argument("--resolution", type = int, default = None)
+    parser.add_argument("--json", default = None, help = "Also write results to this file")
+    args = parser.parse_args()
+
+    results = {"sdxl_shapes" : [], "renders" : []}
+    print("SDXL shapes, synthetic data (errors depend on the made up outliers, see --model-id for real embeddings)")
+    print(f"{'anchors':>7} {'outliers':>8} {'mode':>5} {'KB/anchor':>9} {'blend ms':>8} {'rel err':>9} {'max abs err':>11} {'cosine':>9}")
+    for n in args.anchors:
+        for outliers in OUTLIERS:
+            for row in sdxl_shapes(n, args.modes, args.repeats, outliers):
+                results["sdxl_shapes"].append(row)
+                print(f"{n:>7} {outliers:>8} {row['mode']:>5} {row['bytes_per_anchor'] / 1024:>9.1f} {row['blend_ms']:>8.2f} "
+                      f"{row['rel_error']:>9.2e} {row['max_abs_error']:>11.2e} {row['cosine']:>9.6f}")
+
+    if args.model_id:
+        print(f"\n{'model':>24} {'mode':>5} {'KB/anchor':>9} {'fp32 KB':>8} {'rel err':>9} {'cosine':>9} {'mean drift':>10} {'max drift':>9}")
+        for row in renders(args.model_id, args.prompts, args.modes, args.points, args.resolution):
+            results["renders"].append(row)
+            print(f"{row['model_id'][-24:]:>24} {row['mode']:>5} {row['bytes_per_anchor'] / 1024:>9.2f} {row['fp32_bytes_per_anchor'] / 1024:>8.2f} "
+                  f"{row['rel_error']:>9.2e} {row['cosine']:>9.6f} {row['mean_pixel_drift']:>10.3f} {row['max_pixel_drift']:>9.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent = 2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Per-frame cost of getting a decoded image to the screen and into an HTTP response
+
+Compares the PIL path (postprocess to PIL, tobytes + pygame.image.fromstring, PIL -> PNG -> base64) against the
+uint8 path (output_type = "uint8", pygame.image.frombuffer, PNG encoding straight from the array).
+Only the stages after the decoder are timed, so no model is needed.
+
+Allocations are measured with tracemalloc, which sees numpy and Python allocations but not torch's or PIL's
+internal buffers, so they are a lower bound.
+
+Usage:
+    python -m benchmarks.image_output --resolutions 512 1024
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+import pygame
+from diffusers.image_processor import VaeImageProcessor
+
+from faceforge_core.hacked_sdxl_pipeline import to_uint8
+from faceforge_api.main import encode_png_b64
+
+def pil_screen(image, processor):
+    sample = processor.postprocess(image, output_type = "pil")[0]
+    return pygame.image.fromstring(sample.tobytes(), sample.size, sample.mode)
+
+def uint8_screen(image, processor):
+    sample = to_uint8(image)[0]
+    return pygame.image.frombuffer(sample, (sample.shape[1], sample.shape[0]), "RGB")
+
+def pil_http(image, processor):
+    sample = processor.postprocess(image, output_type = "pil")[0]
+    return encode_png_b64(np.array(sample))
+
+def uint8_http(image, processor):
+    return encode_png_b64(to_uint8(image)[0])
+
+PATHS = {
+    "screen" : (pil_screen, uint8_screen),
+    "http" : (pil_http, uint8_http),
+}
+
+def measure(fn, image, processor, iters, warmup):
+    """
+    Mean latency (ms), and mean peak / number of traced allocations per frame
+    """
+    for _ in range(warmup):
+        fn(image, processor)
+
+    times, peaks, counts = [], [], []
+    for _ in range(iters):
+        start = time.perf_counter()
+        fn(image, processor)
+        times.append((time.perf_counter() - start) * 1000)
+
+        tracemalloc.start()
+        fn(image, processor)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        counts.append(sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename")))
+        tracemalloc.stop()
+    return float(np.mean(times)), float(np.mean(peaks)), float(np.mean(counts))
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the PIL and uint8 image output paths")
+    parser.add_argument("--resolutions", type = int, nargs = "+", default = [512, 1024])
+    parser.add_argument("--iters", type = int, default = 20)
+    parser.add_argument("--warmup", type = int, default = 2)
+    parser.add_argument("--json", default = None, help = "Also write results to this file")
+    args = parser.parse_args()
+
+    processor = VaeImageProcessor(vae_scale_factor = 8)
+    results = []
+    print(f"{'path':>8} {'res':>6} {'pil ms':>10} {'uint8 ms':>10} {'saved ms':>10} {'pil KB':>10} {'uint8 KB':>10}")
+    for resolution in args.resolutions:
+        # Smooth stand-in for decoder output, random noise would make PNG encoding dominate everything
+        image = torch.nn.functional.interpolate(torch.rand(1, 3, 16, 16) * 2 - 1, size = (resolution, resolution), mode = "bilinear")
+        for name, (pil_fn, uint8_fn) in PATHS.items():
+            pil_ms, pil_peak, pil_count = measure(pil_fn, image, processor, args.iters, args.warmup)
+            uint8_ms, uint8_peak, uint8_count = measure(uint8_fn, image, processor, args.iters, args.warmup)
+            row = {
+                "path" : name,
+                "resolution" : resolution,
+                "pil_ms" : pil_ms,
+                "uint8_ms" : uint8_ms,
+                "saved_ms" : pil_ms - uint8_ms,
+                "pil_peak_bytes" : pil_peak,
+                "uint8_peak_bytes" : uint8_peak,
+                "pil_allocations" : pil_count,
+                "uint8_allocations" : uint8_count,
+            }
+            results.append(row)
+            print(f"{name:>8} {resolution:>6} {pil_ms:>10.2f} {uint8_ms:>10.2f} {row['saved_ms']:>10.2f} {pil_peak / 1024:>10.0f} {uint8_peak / 1024:>10.0f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent = 2)
+
+if __name__ == "__main__":
+    main()
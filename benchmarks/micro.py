@@ -0,0 +1,266 @@
+"""
+CPU microbenchmarks of the explorer's and the API's hot paths, with JSON baselines and regression checks
+
+Cases:
+    sampling.*      DistanceSampling / CircleSampling blending SDXL encodings ([N, 77, 2048] and [N, 1280])
+    explorer.*      latent_explorer.LatentSpaceExplorer.sample_encoding from 10 to 10k anchors
+    directions.*    LatentDirectionFinder PCA and classifier fits (every solver) at several N x D
+    api.*           /generate, /manipulate and /attribute_direction through an in-process ASGI client
+
+Every case reports p50 / p95 / mean latency. `run` saves them as a baseline, `compare` checks a later run against
+it and exits with status 1 if any case's p50 got slower than the threshold allows.
+The API runs with mock encodings unless FACEFORGE_MODEL_ID is set, i.e. to "tiny" for the whole render path on a small
+random model. Its debug logging is turned off while timing.
+
+Usage:
+    python -m benchmarks.micro run --json baseline.json
+    python -m benchmarks.micro run --filter sampling explorer --quick --json current.json
+    python -m benchmarks.micro compare baseline.json current.json --threshold 0.15
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import re
+import sys
+import time
+
+import numpy as np
+import torch
+
+from faceforge_core.sampling import DistanceSampling, CircleSampling
+from faceforge_core.latent_explorer import LatentSpaceExplorer
+from faceforge_core.attribute_directions import LatentDirectionFinder
+
+# SDXL text encoder output: per-token embeddings of both encoders concatenated, and the pooled embedding
+SDXL_TOKENS, SDXL_DIM, SDXL_POOLED_DIM = 77, 2048, 1280
+
+def measure(fn, min_time = 0.25, min_iters = 5, max_iters = 1000, warmup = 1) -> np.ndarray:
+    """
+    Latencies (ms) of fn, called at least min_iters times and until min_time seconds passed (at most max_iters)
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    start = time.perf_counter()
+    while len(times) < max_iters and (len(times) < min_iters or time.perf_counter() - start < min_time):
+        t = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t) * 1000)
+    return np.array(times)
+
+def summarize(times : np.ndarray) -> dict:
+    return {
+        "p50_ms" : float(np.percentile(times, 50)),
+        "p95_ms" : float(np.percentile(times, 95)),
+        "mean_ms" : float(times.mean()),
+        "min_ms" : float(times.min()),
+        "iters" : len(times),
+    }
+
+# --- Cases. Each yields (name, setup) pairs, setup() builds the inputs and returns the function to time ---
+
+def sampling_cases(quick):
+    def setup(n, sampler_cls):
+        rng = np.random.default_rng(0)
+        encodes = [
+            torch.randn(n, SDXL_TOKENS, SDXL_DIM), None,
+            torch.randn(n, SDXL_POOLED_DIM), None,
+        ]
+        sampler = sampler_cls(encodes)
+        positions, point = rng.uniform(-1, 1, (n, 2)), rng.uniform(-1, 1, 2)
+        return lambda: sampler(point, positions)
+
+    for n in ((2, 8) if quick else (2, 8, 32)):
+        yield f"sampling.distance[n={n}]", lambda n = n: setup(n, DistanceSampling)
+        yield f"sampling.circle[n={n}]", lambda n = n: setup(n, CircleSampling)
+
+def explorer_cases(quick, dim = SDXL_POOLED_DIM):
+    def setup(n, mode):
+        rng = np.random.default_rng(0)
+        explorer = LatentSpaceExplorer()
+        for i in range(n):
+            explorer.add_point(str(i), rng.standard_normal(dim), tuple(rng.uniform(0.1, 1, 2)))
+        return lambda: explorer.sample_encoding((0.5, 0.5), mode = mode)
+
+    for n in ((10, 100) if quick else (10, 100, 1000, 10000)):
+        for mode in ("distance", "circle"):
+            yield f"explorer.{mode}[n={n},d={dim}]", lambda n = n, mode = mode: setup(n, mode)
+
+def direction_cases(quick):
+    def data(n, d):
+        rng = np.random.default_rng(0)
+        latents = rng.standard_normal((n, d))
+        labels = (latents[:, 0] + 0.5 * rng.standard_normal(n) > 0).astype(int).tolist()
+        return LatentDirectionFinder(latents), labels
+
+    def pca(n, d):
+        finder, _ = data(n, d)
+        return lambda: finder.pca_direction(n_components = 10)
+
+    def classifier(n, d, solver):
+        finder, labels = data(n, d)
+        return lambda: finder.classifier_direction(labels, solver = solver)
+
+    for n, d in (((256, 512),) if quick else ((256, 512), (1024, 512), (1024, 2048), (4096, 2048))):
+        yield f"directions.pca[n={n},d={d}]", lambda n = n, d = d: pca(n, d)
+        yield f"directions.classifier[n={n},d={d}]", lambda n = n, d = d: classifier(n, d, "logistic")
+        for solver in ("sgd", "lda", "mean_diff"):
+            yield f"directions.classifier.{solver}[n={n},d={d}]", lambda n = n, d = d, solver = solver: classifier(n, d, solver)
+
+def api_cases(quick):
+    state = {} # Event loop and client, created by the first api case that runs
+
+    def client():
+        if not state:
+            import httpx
+            from faceforge_api.main import app
+
+            logging.getLogger("faceforge_api").setLevel(logging.WARNING)
+            logging.getLogger("httpx").setLevel(logging.WARNING)
+            state["loop"] = asyncio.new_event_loop()
+            state["client"] = httpx.AsyncClient(transport = httpx.ASGITransport(app = app), base_url = "http://bench")
+        return state["loop"], state["client"]
+
+    def post(path, body, **params):
+        def setup():
+            loop, api = client()
+            def fn():
+                resp = loop.run_until_complete(api.post(path, json = body, params = params))
+                resp.raise_for_status()
+            return fn
+        return setup
+
+    rng = np.random.default_rng(0)
+    generate = {"prompts" : ["A photo of a cat", "A photo of a dog"], "player_pos" : [0.3, -0.2]}
+    for fmt in ("json", "png", "raw"):
+        yield f"api.generate[format={fmt}]", post("/generate", generate, format = fmt)
+    yield "api.generate[format=raw,preview]", post("/generate", {**generate, "preview" : True}, format = "raw")
+    for d in ((SDXL_POOLED_DIM,) if quick else (SDXL_POOLED_DIM, SDXL_TOKENS * SDXL_DIM)):
+        manipulate = {"encoding" : rng.standard_normal(d).tolist(), "direction" : rng.standard_normal(d).tolist(), "alpha" : 0.5}
+        yield f"api.manipulate[d={d}]", post("/manipulate", manipulate)
+    n, d = (64, 128) if quick else (256, 512)
+    latents = rng.standard_normal((n, d))
+    yield f"api.attribute_direction.pca[n={n},d={d}]", post("/attribute_direction", {"latents" : latents.tolist(), "n_components" : 10})
+    labels = (latents[:, 0] > 0).astype(int).tolist()
+    yield f"api.attribute_direction.classifier[n={n},d={d}]", post("/attribute_direction", {"latents" : latents.tolist(), "labels" : labels})
+
+    if state:
+        state["loop"].run_until_complete(state["client"].aclose())
+        state["loop"].close()
+
+SUITES = {
+    "sampling" : sampling_cases,
+    "explorer" : explorer_cases,
+    "directions" : direction_cases,
+    "api" : api_cases,
+}
+
+def environment() -> dict:
+    return {
+        "time" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "processor" : platform.processor(),
+        "cpu_count" : os.cpu_count(),
+        "torch" : torch.__version__,
+        "torch_threads" : torch.get_num_threads(),
+        "numpy" : np.__version__,
+    }
+
+def run(filters = None, quick = False, min_time = 0.25, verbose = True) -> dict:
+    """
+    Run the cases whose names match any of the filters (regexes, all cases if None)
+
+    :return: {"environment": ..., "results": {case name: latency summary}}
+    """
+    results = {}
+    if verbose:
+        print(f"{'case':<48} {'p50 ms':>10} {'p95 ms':>10} {'iters':>6}")
+    for cases in SUITES.values():
+        for name, setup in cases(quick):
+            if filters and not any(re.search(f, name) for f in filters):
+                continue
+            results[name] = row = summarize(measure(setup(), min_time = min_time))
+            if verbose:
+                print(f"{name:<48} {row['p50_ms']:>10.3f} {row['p95_ms']:>10.3f} {row['iters']:>6}")
+    return {"environment" : environment(), "results" : results}
+
+def compare(baseline : dict, current : dict, threshold : float = 0.1, metric : str = "p50_ms") -> dict:
+    """
+    Compare two runs case by case
+
+    :param threshold: Relative slowdown flagged as a regression, i.e. 0.1 for 10% slower
+    :return: {"regressions": [...], "improvements": [...], "rows": [...]} where rows are
+        (case, baseline ms, current ms, ratio) for the cases both runs have
+    """
+    rows, regressions, improvements = [], [], []
+    for name, base in baseline["results"].items():
+        if name not in current["results"]:
+            continue
+        ratio = current["results"][name][metric] / max(base[metric], 1e-9)
+        rows.append((name, base[metric], current["results"][name][metric], ratio))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold):
+            improvements.append(name)
+    return {"regressions" : regressions, "improvements" : improvements, "rows" : rows}
+
+def print_comparison(baseline, current, report, threshold):
+    for key in ("cpu_count", "torch_threads", "torch", "numpy", "processor"):
+        if baseline["environment"].get(key) != current["environment"].get(key):
+            print(f"warning: {key} differs ({baseline['environment'].get(key)} vs {current['environment'].get(key)})")
+    print(f"{'case':<48} {'base ms':>10} {'now ms':>10} {'ratio':>7}")
+    for name, base_ms, ms, ratio in report["rows"]:
+        flag = "  REGRESSION" if name in report["regressions"] else ("  faster" if name in report["improvements"] else "")
+        print(f"{name:<48} {base_ms:>10.3f} {ms:>10.3f} {ratio:>7.2f}{flag}")
+    print(f"{len(report['regressions'])} regression(s) past {threshold:.0%}, {len(report['improvements'])} improvement(s)")
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description = "CPU microbenchmarks with JSON baselines")
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    run_parser = commands.add_parser("run", help = "Run the cases")
+    run_parser.add_argument("--filter", nargs = "+", default = None, help = "Only cases matching any of these regexes, i.e. sampling api.generate")
+    run_parser.add_argument("--quick", action = "store_true", help = "Smaller sizes only")
+    run_parser.add_argument("--min-time", type = float, default = 0.25, help = "Seconds spent timing each case")
+    run_parser.add_argument("--threads", type = int, default = None, help = "torch threads")
+    run_parser.add_argument("--json", default = None, help = "Write results to this file (i.e. a baseline)")
+    run_parser.add_argument("--baseline", default = None, help = "Compare against this baseline after running")
+    run_parser.add_argument("--threshold", type = float, default = 0.1)
+
+    compare_parser = commands.add_parser("compare", help = "Compare a run against a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type = float, default = 0.1, help = "Relative slowdown flagged as a regression")
+    compare_parser.add_argument("--metric", default = "p50_ms", choices = ["p50_ms", "p95_ms", "mean_ms", "min_ms"])
+    args = parser.parse_args()
+
+    if args.command == "run":
+        if args.threads is not None:
+            torch.set_num_threads(args.threads)
+        current = run(args.filter, args.quick, args.min_time)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(current, f, indent = 2)
+        if args.baseline is None:
+            return
+        baseline = load(args.baseline)
+        metric = "p50_ms"
+    else:
+        baseline, current = load(args.baseline), load(args.current)
+        metric = args.metric
+
+    report = compare(baseline, current, args.threshold, metric)
+    print_comparison(baseline, current, report, args.threshold)
+    sys.exit(1 if report["regressions"] else 0)
+
+if __name__ == "__main__":
+    main()
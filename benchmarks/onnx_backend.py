@@ -0,0 +1,66 @@
+"""
+Latency of the torch unet/decoder against the ONNX Runtime and OpenVINO backends on cpu
+
+Needs graphs exported with `python -m faceforge_core.onnx_backend export --out-dir <dir>`.
+
+Usage:
+    python -m benchmarks.onnx_backend --onnx-dir onnx/sdxl-turbo --runtimes onnxruntime openvino
+"""
+
+import argparse
+import json
+
+import numpy as np
+
+from faceforge_core.fast_sd import fast_diffusion_pipeline
+from faceforge_core.onnx_backend import GraphBackend
+from benchmarks.cpu_pipeline import time_renders
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compare torch and graph runtime backends on cpu")
+    parser.add_argument("--model-id", default = "stabilityai/sdxl-turbo")
+    parser.add_argument("--onnx-dir", required = True)
+    parser.add_argument("--runtimes", nargs = "+", default = ["onnxruntime", "openvino"])
+    parser.add_argument("--resolution", type = int, default = 512)
+    parser.add_argument("--threads", type = int, default = None)
+    parser.add_argument("--iters", type = int, default = 10)
+    parser.add_argument("--warmup", type = int, default = 2)
+    parser.add_argument("--prompt", default = "A photo of a face")
+    parser.add_argument("--json", default = None, help = "Also write results to this file")
+    args = parser.parse_args()
+
+    pipe = fast_diffusion_pipeline(model_id = args.model_id, device = "cpu", dtype = "fp32", num_threads = args.threads)
+    encodes = pipe.get_encodes([args.prompt])
+    latents = pipe.initial_latents(0, height = args.resolution, width = args.resolution)
+
+    def render():
+        return pipe.generate_from_encodes(list(encodes), latents = latents, height = args.resolution, width = args.resolution, output_type = "np").images
+
+    reference = render()
+    results = []
+    for runtime in ["torch"] + args.runtimes:
+        try:
+            pipe.set_backend(None if runtime == "torch" else GraphBackend(args.onnx_dir, runtime, num_threads = args.threads))
+        except ImportError as e:
+            print(f"Skipping {runtime}: {e}")
+            continue
+        times = time_renders(pipe, encodes, latents, args.resolution, args.iters, args.warmup)
+        results.append({
+            "backend" : runtime,
+            "mean_ms" : float(times.mean()),
+            "p50_ms" : float(np.percentile(times, 50)),
+            "p95_ms" : float(np.percentile(times, 95)),
+            "max_abs_diff" : float(np.abs(render() - reference).max()),
+        })
+
+    print(f"{'backend':>12} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10} {'speedup':>8} {'max diff':>10}")
+    for row in results:
+        speedup = results[0]["mean_ms"] / row["mean_ms"]
+        print(f"{row['backend']:>12} {row['mean_ms']:>10.1f} {row['p50_ms']:>10.1f} {row['p95_ms']:>10.1f} {speedup:>7.2f}x {row['max_abs_diff']:>10.2e}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent = 2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Evaluate int8 quantization modes of fast_diffusion_pipeline against the fp32 pipeline on cpu
+
+Reports render latency, memory of the quantized components and how far the images drift from the fp32 ones.
+
+Usage:
+    python -m benchmarks.quantization --modes dynamic weight_only --resolution 512
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from faceforge_core.fast_sd import fast_diffusion_pipeline
+from faceforge_core.quantization import QUANTIZED_COMPONENTS, module_nbytes
+
+DEFAULT_PROMPTS = ["A photo of a face", "A portrait of an old man", "A smiling woman with red hair"]
+
+def render_all(pipe, prompts, resolution, warmup):
+    """
+    Render each prompt from the same initial noise. Returns (images in [0, 1] as [N, H, W, 3], latencies in ms)
+    """
+    encodes = pipe.get_encodes(prompts)
+    latents = pipe.initial_latents(0, height = resolution, width = resolution, dtype = encodes[0].dtype)
+    images, times = [], []
+    for i in range(len(prompts)):
+        single = [e[i:i+1] if e is not None else None for e in encodes]
+        for j in range(warmup + 1):
+            start = time.perf_counter()
+            image = pipe.generate_from_encodes(list(single), latents = latents, height = resolution, width = resolution, output_type = "np").images[0]
+            if j == warmup:
+                times.append((time.perf_counter() - start) * 1000)
+        images.append(image)
+    return np.stack(images), np.array(times)
+
+def components_nbytes(pipe):
+    return sum(module_nbytes(getattr(pipe, name)) for name in QUANTIZED_COMPONENTS if getattr(pipe, name, None) is not None)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Latency, memory and image quality of int8 quantization on cpu")
+    parser.add_argument("--model-id", default = "stabilityai/sdxl-turbo")
+    parser.add_argument("--modes", nargs = "+", default = ["dynamic", "weight_only"])
+    parser.add_argument("--prompts", nargs = "+", default = DEFAULT_PROMPTS)
+    parser.add_argument("--resolution", type = int, default = 512)
+    parser.add_argument("--threads", type = int, default = None)
+    parser.add_argument("--warmup", type = int, default = 1)
+    parser.add_argument("--json", default = None, help = "Also write results to this file")
+    args = parser.parse_args()
+
+    def build(mode):
+        return fast_diffusion_pipeline(model_id = args.model_id, device = "cpu", dtype = "fp32", num_threads = args.threads, quantize = mode)
+
+    pipe = build(None)
+    reference, reference_times = render_all(pipe, args.prompts, args.resolution, args.warmup)
+    reference_bytes = components_nbytes(pipe)
+    del pipe
+
+    results = [{"mode" : "fp32", "mean_ms" : float(reference_times.mean()), "mbytes" : reference_bytes / 1e6, "mse" : 0.0, "psnr" : float("inf"), "max_abs_diff" : 0.0}]
+    for mode in args.modes:
+        pipe = build(mode)
+        images, times = render_all(pipe, args.prompts, args.resolution, args.warmup)
+        mse = float(((images - reference) ** 2).mean())
+        results.append({
+            "mode" : mode,
+            "mean_ms" : float(times.mean()),
+            "mbytes" : components_nbytes(pipe) / 1e6,
+            "mse" : mse,
+            "psnr" : float(10 * np.log10(1. / mse)) if mse > 0 else float("inf"),
+            "max_abs_diff" : float(np.abs(images - reference).max()),
+        })
+        del pipe
+
+    print(f"{'mode':>12} {'mean ms':>10} {'speedup':>8} {'MB':>10} {'saved':>7} {'mse':>10} {'psnr':>8}")
+    for row in results:
+        speedup = results[0]["mean_ms"] / row["mean_ms"]
+        saved = 1 - row["mbytes"] / results[0]["mbytes"]
+        print(f"{row['mode']:>12} {row['mean_ms']:>10.1f} {speedup:>7.2f}x {row['mbytes']:>10.1f} {saved:>6.0%} {row['mse']:>10.2e} {row['psnr']:>8.2f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent = 2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Per-click latency of the Gradio UI's generate_image, calling the API over loopback HTTP against calling it in process
+
+Serves faceforge_api on a local port with uvicorn, like the integrated app does, then times generate_image both ways.
+Without FACEFORGE_MODEL_ID set the API renders stub images, so this mostly measures transport and encoding overhead.
+
+Usage:
+    python -m benchmarks.ui_fast_path --clicks 50
+"""
+
+import argparse
+import asyncio
+import json
+import socket
+import threading
+import time
+
+import numpy as np
+import uvicorn
+
+import faceforge_ui.app as ui
+import faceforge_ui.api_client as api_client
+from faceforge_api.main import app as api_app, generate
+
+def serve(port):
+    server = uvicorn.Server(uvicorn.Config(api_app, host = "127.0.0.1", port = port, log_level = "warning"))
+    threading.Thread(target = server.run, daemon = True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def time_clicks(prompts, clicks, warmup, fresh_connections = False):
+    """
+    Click latencies (ms). fresh_connections drops the pooled client before every click
+    """
+    times = []
+    rng = np.random.default_rng(0)
+    for i in range(warmup + clicks):
+        x, y = rng.uniform(-1, 1, 2)
+        if fresh_connections:
+            api_client.clients.clear()
+        start = time.perf_counter()
+        img, status = await ui.generate_image(prompts, "distance", x, y)
+        if img is None:
+            raise RuntimeError(status)
+        if i >= warmup:
+            times.append((time.perf_counter() - start) * 1000)
+    return np.array(times)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the UI's in-process API path against HTTP")
+    parser.add_argument("--prompts", default = "A photo of a cat, A photo of a dog")
+    parser.add_argument("--clicks", type = int, default = 50)
+    parser.add_argument("--warmup", type = int, default = 3)
+    parser.add_argument("--json", default = None, help = "Also write results to this file")
+    args = parser.parse_args()
+
+    port = free_port()
+    server = serve(port)
+    ui.API_URL = f"http://127.0.0.1:{port}"
+
+    results = []
+    paths = (("http, new connections", None, True), ("http, pooled", None, False), ("in-process", generate, False))
+    print(f"{'path':>22} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10}")
+    for path, service, fresh_connections in paths:
+        ui.use_local_api(service)
+        times = asyncio.run(time_clicks(args.prompts, args.clicks, args.warmup, fresh_connections))
+        row = {
+            "path" : path,
+            "mean_ms" : float(times.mean()),
+            "p50_ms" : float(np.percentile(times, 50)),
+            "p95_ms" : float(np.percentile(times, 95)),
+        }
+        results.append(row)
+        print(f"{path:>22} {row['mean_ms']:>10.2f} {row['p50_ms']:>10.2f} {row['p95_ms']:>10.2f}")
+    server.should_exit = True
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent = 2)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Request, Depends
+from fastapi.responses import JSONResponse, Response, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 import numpy as np
@@ -9,6 +10,13 @@ import logging
 import sys
 import traceback
 import io
+import os
+import re
+import hmac
+import uuid
+import tempfile
+import threading
+from contextlib import nullcontext
 from PIL import Image
 import json
 
@@ -18,12 +26,30 @@ try:
     from faceforge_core.latent_explorer import LatentSpaceExplorer
     from faceforge_core.attribute_directions import LatentDirectionFinder
     from faceforge_core.custom_loss import attribute_preserving_loss
+    from faceforge_core.direction_registry import DirectionRegistry, UnknownDirection, dataset_hash
+    from faceforge_core.latent_dataset import LatentDataset
     HAS_CORE = True
 except ImportError as e:
     logging.warning(f"Failed to import faceforge_core modules: {e}")
     logging.warning("Using mock implementations instead")
     HAS_CORE = False
 
+try:
+    import torch
+    from faceforge_core.embedding_store import EmbeddingStore
+    from faceforge_core.sampling import DistanceSampling, CircleSampling
+    from faceforge_core.preview import AnchorLatentCache
+except ImportError as e:
+    logging.warning(f"Failed to import diffusion dependencies: {e}")
+
+try:
+    from faceforge_core.profiling import RequestProfiler, ProfilerBusy, profile_stage
+    HAS_PROFILING = True
+except ImportError as e:
+    logging.warning(f"Failed to import profiling: {e}")
+    HAS_PROFILING = False
+    profile_stage = lambda name: nullcontext()
+
 # Configure logging
 logging.basicConfig(
     level=logging.DEBUG,
@@ -32,6 +58,30 @@ logging.basicConfig(
 )
 logger = logging.getLogger("faceforge_api")
 
+# Diffusion model used by /generate. "mock" keeps stub encodings and images (no model weights needed),
+# "tiny" runs the full render path on a small random stand-in model (see faceforge_core.fast_sd.tiny_diffusion_pipeline)
+MODEL_ID = os.environ.get("FACEFORGE_MODEL_ID", "mock")
+# Device and precision for the model, defaults to the best available device (fp32 on cpu)
+DEVICE = os.environ.get("FACEFORGE_DEVICE")
+DTYPE = os.environ.get("FACEFORGE_DTYPE")
+# Optional int8 quantization of the model ("dynamic" or "weight_only")
+QUANTIZE = os.environ.get("FACEFORGE_QUANTIZE")
+# Optional graph runtime for the unet and decoder ("onnxruntime" or "openvino") and the directory of the exported graphs
+BACKEND = os.environ.get("FACEFORGE_BACKEND")
+ONNX_DIR = os.environ.get("FACEFORGE_ONNX_DIR")
+# Directory of a persistent prompt embedding store, can be shared between worker processes
+EMBEDDING_STORE = os.environ.get("FACEFORGE_EMBEDDING_STORE")
+# Directory of the persistent direction registry (directions referred to by id), and the precision they're stored in
+DIRECTION_REGISTRY = os.environ.get("FACEFORGE_DIRECTION_REGISTRY", os.path.join(os.path.expanduser("~"), ".cache", "faceforge", "directions"))
+DIRECTION_DTYPE = os.environ.get("FACEFORGE_DIRECTION_DTYPE", "float32")
+# Directory of the out-of-core latent datasets (see /datasets), one subdirectory per dataset
+DATASET_DIR = os.environ.get("FACEFORGE_DATASET_DIR", os.path.join(os.path.expanduser("~"), ".cache", "faceforge", "datasets"))
+# Token for admin features (request profiling). They are disabled when unset
+ADMIN_TOKEN = os.environ.get("FACEFORGE_ADMIN_TOKEN")
+# Where request profiles are stored for download, and how many of the newest are kept
+PROFILE_DIR = os.environ.get("FACEFORGE_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "faceforge_profiles"))
+PROFILE_KEEP = int(os.environ.get("FACEFORGE_PROFILE_KEEP", "20"))
+
 # --- Models for API ---
 
 class PointIn(BaseModel):
@@ -39,28 +89,42 @@ class PointIn(BaseModel):
     encoding: Optional[List[float]] = Field(None)
     xy_pos: Optional[List[float]] = Field(None)
 
+class DirectionEdit(BaseModel):
+    id: str  # Id in the direction registry
+    alpha: float
+
 class GenerateRequest(BaseModel):
     prompts: List[str]
     positions: Optional[List[List[float]]] = Field(None)
     mode: str = "distance"
     player_pos: Optional[List[float]] = Field(None)
+    preview: bool = False  # Decode-only preview from cached per-prompt latents (approximate, much faster)
+    edits: Optional[List[DirectionEdit]] = Field(None)  # Registered directions added to the blended encoding
 
 class ManipulateRequest(BaseModel):
     encoding: List[float]
-    direction: List[float]
-    alpha: float
+    direction: Optional[List[float]] = Field(None)
+    direction_id: Optional[str] = Field(None)  # Registered direction, instead of or on top of direction
+    alpha: float = 1.0  # Strength of direction / direction_id
+    edits: Optional[List[DirectionEdit]] = Field(None)  # More registered directions, all applied as one update
 
 class AttributeDirectionRequest(BaseModel):
-    latents: List[List[float]]
+    latents: Optional[List[List[float]]] = Field(None)
+    dataset: Optional[str] = Field(None)  # Name of an uploaded dataset (see /datasets) to fit on instead of latents
+    dataset_labels: bool = False  # Use the labels stored with the dataset as the label_matrix
     labels: Optional[List[int]] = Field(None)
+    label_matrix: Optional[List[List[int]]] = Field(None)  # N x K labels, fits K attribute directions in one pass
     n_components: Optional[int] = 10
+    solver: str = "logistic"  # Classifier solver: "logistic", "sgd", "lda" or "mean_diff" (see LatentDirectionFinder.SOLVERS)
+    store: bool = False  # Store the directions (or PCA components) in the direction registry and return their ids
+    names: Optional[List[str]] = Field(None)  # Ids to register them under, one per direction. Content hashes by default
 
 # --- Mock classes if core modules aren't available ---
 
 class MockLatentSpaceExplorer:
     def __init__(self):
         self.points = []
-        logger.warning("Using mock LatentSpaceExplorer")
+        logger.debug("Using mock LatentSpaceExplorer")
     
     def add_point(self, text, encoding=None, xy_pos=None):
         logger.debug(f"Mock add_point: {text}")
@@ -76,8 +140,11 @@ class MockLatentDirectionFinder:
         self.latents = latents
         logger.warning("Using mock LatentDirectionFinder")
     
-    def classifier_direction(self, labels):
+    def classifier_direction(self, labels, solver="logistic"):
         return np.random.randn(512)
+
+    def classifier_directions(self, labels, solver="logistic"):
+        return np.random.randn(np.shape(labels)[1], 512)
     
     def pca_direction(self, n_components=10):
         components = np.random.randn(n_components, 512)
@@ -103,8 +170,187 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Global explorer instance
-explorer = LatentSpaceExplorer() if HAS_CORE else MockLatentSpaceExplorer()
+# Explorer class. generate builds one per call, so concurrent calls (the endpoint on FastAPI's threadpool, an in-process UI
+# on worker threads) never share points
+Explorer = LatentSpaceExplorer if HAS_CORE else MockLatentSpaceExplorer
+
+# --- Diffusion pipeline ---
+
+pipe = None # Loaded lazily on first use
+anchor_latents = None # Denoised latents per prompt for previews
+pipeline_lock = threading.Lock() # Concurrent first requests load the pipeline once
+embedding_store = EmbeddingStore(EMBEDDING_STORE) if EMBEDDING_STORE and HAS_CORE else None
+direction_registry = DirectionRegistry(DIRECTION_REGISTRY, DIRECTION_DTYPE) if HAS_CORE else None # Read on first use
+
+def get_pipeline():
+    """
+    Get the diffusion pipeline, loading it on first call. None if running with mock encodings.
+    """
+    global pipe, anchor_latents
+    if pipe is None and MODEL_ID != "mock" and HAS_CORE and faceforge_core.HAS_DIFFUSION:
+        with pipeline_lock:
+            if pipe is None:
+                logger.info(f"Loading diffusion pipeline {MODEL_ID}")
+                loaded = faceforge_core.fast_diffusion_pipeline(
+                    model_id=MODEL_ID, device=DEVICE, dtype=DTYPE, quantize=QUANTIZE, backend=BACKEND, onnx_dir=ONNX_DIR
+                )
+                # anchor_latents is set first, so callers that see the pipeline also see its cache
+                anchor_latents = AnchorLatentCache(loaded)
+                pipe = loaded
+    return pipe
+
+def encode_prompts(pipe, prompts: List[str]) -> list:
+    """
+    Encode prompts into per-prompt encoding tuples, through the embedding store if one is configured
+    """
+    def encode(batch):
+        encodes = pipe.get_encodes(batch)
+        return [tuple(e[i:i+1] if e is not None else None for e in encodes) for i in range(len(batch))]
+
+    if embedding_store is not None:
+        return embedding_store.cached_encodes(MODEL_ID, prompts, encode, device=pipe.device)
+    return encode(prompts)
+
+class RegistryUnavailable(RuntimeError):
+    """
+    Edits refer to registered directions, but there is no direction registry (the core package failed to import)
+    """
+
+def direction_update(edits) -> Optional[np.ndarray]:
+    """
+    Fused update sum_i alpha_i * direction_i for [(id, alpha)] of registered directions, None without edits.
+    Raises UnknownDirection for ids that aren't registered and RegistryUnavailable without a registry
+    """
+    if not edits:
+        return None
+    if direction_registry is None:
+        raise RegistryUnavailable("The direction registry is unavailable")
+    return direction_registry.combine(edits)
+
+def shift_encoding(encoding: tuple, update: np.ndarray) -> tuple:
+    """
+    Add a flat direction update to an encoding tuple (prompt_embeds, negative, pooled, negative_pooled).
+    The update applies to the prompt embeddings or the pooled embeddings, whichever has its size, or to both
+    flattened and concatenated.
+    """
+    prompt_embeds, pooled = encoding[0], encoding[2]
+    sizes = [prompt_embeds.numel(), pooled.numel() if pooled is not None else 0]
+    update = torch.as_tensor(update, dtype=prompt_embeds.dtype, device=prompt_embeds.device)
+    if len(update) == sum(sizes) and sizes[1]:
+        prompt_embeds = prompt_embeds + update[:sizes[0]].view(prompt_embeds.shape)
+        pooled = pooled + update[sizes[0]:].view(pooled.shape)
+    elif len(update) == sizes[0]:
+        prompt_embeds = prompt_embeds + update.view(prompt_embeds.shape)
+    elif len(update) == sizes[1]:
+        pooled = pooled + update.view(pooled.shape)
+    else:
+        raise ValueError(f"Direction of size {len(update)} doesn't fit encodings of sizes {sizes}")
+    return (prompt_embeds, encoding[1], pooled, encoding[3])
+
+def render(pipe, encodings: list, positions: np.ndarray, player_pos: List[float], mode: str,
+           prompts: Optional[List[str]] = None, preview: bool = False, update: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Blend per-prompt encodings for the player position and generate an image as an (H, W, 3) uint8 array.
+    With preview, blend the prompts' cached denoised latents instead and only run the decoder.
+    update (see direction_update) shifts the blended encoding, previews can't apply it and render in full.
+    """
+    samplers = {"distance": DistanceSampling, "circle": CircleSampling}
+    if mode not in samplers:
+        raise ValueError(f"Unknown sampling mode: {mode}")
+    if preview and update is None:
+        point = np.array(player_pos, dtype=np.float64)
+        return anchor_latents.preview(samplers[mode], prompts, encodings, point, positions, output_type="uint8")[0]
+    with profile_stage("faceforge.sampler"):
+        batched = [torch.cat([e[i] for e in encodings]) if encodings[0][i] is not None else None for i in range(len(encodings[0]))]
+        encoding = samplers[mode](batched)(np.array(player_pos, dtype=np.float64), positions)
+        if update is not None:
+            encoding = shift_encoding(encoding, update)
+    latents = pipe.initial_latents(0, dtype=encoding[0].dtype)
+    return pipe.generate_from_encodes(encoding, latents=latents, output_type="uint8").images[0]
+
+def encode_png(img: np.ndarray) -> bytes:
+    """
+    PNG encode an (H, W, 3) uint8 array
+    """
+    buffer = io.BytesIO()
+    Image.fromarray(img).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def encode_png_b64(img: np.ndarray) -> str:
+    """
+    PNG encode an (H, W, 3) uint8 array and base64 it for JSON responses
+    """
+    return base64.b64encode(encode_png(img)).decode("ascii")
+
+# Response formats of /generate: JSON with a base64 PNG, or the image as the binary body
+RESPONSE_FORMATS = ("json", "png", "raw")
+
+def image_response(img: np.ndarray, format: str) -> Response:
+    """
+    /generate response for an (H, W, 3) uint8 image in one of RESPONSE_FORMATS
+    """
+    # Binary responses skip base64
+    if format == "png":
+        return Response(content=encode_png(img), media_type="image/png")
+    if format == "raw":
+        shape = ",".join(str(d) for d in img.shape)
+        return Response(content=np.ascontiguousarray(img).tobytes(), media_type="application/octet-stream",
+                        headers={"X-Image-Shape": shape})
+
+    # Convert to base64
+    logger.debug("Converting image to base64")
+    img_b64 = encode_png_b64(img)
+
+    # Prepare response
+    response = {"status": "success", "image": img_b64}
+    logger.debug(f"Response structure: {list(response.keys())}")
+    logger.debug(f"Image base64 length: {len(img_b64)}")
+    return JSONResponse(content=response)
+
+# --- Request profiling ---
+
+def check_admin(request: Request):
+    """
+    Raise unless the request carries the admin token in the X-Admin-Token header
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin features are disabled (FACEFORGE_ADMIN_TOKEN is not set)")
+    if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+def request_profiler(request: Request, profile: bool = False):
+    """
+    Dependency: a profiler for the request if it asks for one with ?profile=true or an X-Profile: 1 header
+    (and carries the admin token), None otherwise
+    """
+    if not profile and request.headers.get("X-Profile", "").lower() not in ("1", "true"):
+        return None
+    check_admin(request)
+    if not HAS_PROFILING:
+        raise HTTPException(status_code=501, detail="Profiling is unavailable")
+    return RequestProfiler()
+
+def profiled(profiler):
+    """
+    Context to run a request's work in: the profiler if there is one
+    """
+    return profiler if profiler is not None else nullcontext()
+
+def store_profile(request: Request, profiler, meta: dict) -> Dict[str, str]:
+    """
+    Save a finished profile to PROFILE_DIR, dropping the oldest beyond PROFILE_KEEP.
+    Returns the response headers pointing to it (none if the request wasn't profiled)
+    """
+    if profiler is None:
+        return {}
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profile_id = uuid.uuid4().hex
+    profiler.save(os.path.join(PROFILE_DIR, f"{profile_id}.zip"), meta={"path": request.url.path, **meta})
+    profiles = sorted((os.path.join(PROFILE_DIR, f) for f in os.listdir(PROFILE_DIR) if f.endswith(".zip")), key=os.path.getmtime)
+    for path in profiles[:-PROFILE_KEEP] if PROFILE_KEEP > 0 else []:
+        os.remove(path)
+    logger.info(f"Profiled {request.url.path} ({profiler.ms:.0f} ms) as {profile_id}")
+    return {"X-Profile-Id": profile_id, "X-Profile-Url": str(request.url_for("download_profile", profile_id=profile_id))}
 
 # Error handling middleware
 @app.middleware("http")
@@ -124,60 +370,92 @@ def read_root():
     logger.debug("API root endpoint called")
     return {"message": "FaceForge API is running"}
 
+def generate(prompts: List[str], mode: str = "distance", player_pos: Optional[List[float]] = None,
+             positions: Optional[List[List[float]]] = None, preview: bool = False,
+             edits: Optional[List[tuple]] = None) -> np.ndarray:
+    """
+    Generation service behind /generate, returns an (H, W, 3) uint8 image.
+    A UI running in the same process calls this directly, without HTTP or image encoding.
+    edits: [(direction id, alpha)] of registered directions, added to the blended encoding as one update
+    """
+    update = direction_update(edits)
+    explorer = Explorer()
+
+    pipe = get_pipeline()
+    if pipe is not None:
+        encodings = encode_prompts(pipe, prompts)
+    else:
+        encodings = [np.random.randn(512) for _ in prompts]  # Stub encodings when no model is configured
+    
+    # Add points for each prompt
+    for i, prompt in enumerate(prompts):
+        logger.debug(f"Processing prompt {i}: {prompt}")
+        encoding = encodings[i]
+        
+        # Get position if provided, otherwise None
+        xy_pos = positions[i] if positions and i < len(positions) else None
+        logger.debug(f"Position for prompt {i}: {xy_pos}")
+        
+        # Add point to explorer
+        explorer.add_point(prompt, encoding, xy_pos)
+    
+    # Get player position
+    if player_pos is None:
+        player_pos = [0.0, 0.0]
+    logger.debug(f"Player position: {player_pos}")
+    
+    if pipe is not None:
+        logger.debug(f"Rendering with mode: {mode}")
+        return render(pipe, encodings, explorer.get_positions(), player_pos, mode, prompts=prompts, preview=preview, update=update)
+
+    # Sample encoding
+    logger.debug(f"Sampling with mode: {mode}")
+    sampled = explorer.sample_encoding(tuple(player_pos), mode=mode)
+    if update is not None:
+        if update.size != np.size(sampled):
+            raise ValueError(f"Direction of size {update.size} doesn't fit encodings of size {np.size(sampled)}")
+        sampled = sampled + update.reshape(np.shape(sampled))
+    
+    # Generate mock image
+    return (np.random.rand(256, 256, 3) * 255).astype(np.uint8)
+
 @app.post("/generate")
-async def generate_image(req: GenerateRequest):
+def generate_image(req: GenerateRequest, request: Request, format: str = "json",
+                   profiler=Depends(request_profiler)):
+    """
+    format: "json" ({"status", "image": base64 PNG}), "png" (PNG body) or
+    "raw" (uint8 pixels as the body, shape in the X-Image-Shape header as "H,W,C").
+    Profiled requests (see request_profiler) get X-Profile-Id / X-Profile-Url headers to download the profile from.
+    A plain def: FastAPI runs it in its threadpool, so renders don't block the event loop (and other requests)
+    """
+    if format not in RESPONSE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown response format: {format}")
     try:
         logger.debug(f"Generate image request: {json.dumps(req.dict(), default=str)}")
         
         # Log request schema for debugging
         logger.debug(f"Request schema: {GenerateRequest.schema_json()}")
         
-        # Clear existing points
-        explorer.points = []
-        
-        # Add points for each prompt
-        for i, prompt in enumerate(req.prompts):
-            logger.debug(f"Processing prompt {i}: {prompt}")
-            
-            # Generate a mock encoding (in production, this would use a real model)
-            encoding = np.random.randn(512)  # Stub: replace with real encoding
-            
-            # Get position if provided, otherwise None
-            xy_pos = req.positions[i] if req.positions and i < len(req.positions) else None
-            logger.debug(f"Position for prompt {i}: {xy_pos}")
-            
-            # Add point to explorer
-            explorer.add_point(prompt, encoding, xy_pos)
-        
-        # Get player position
-        if req.player_pos is None:
-            player_pos = [0.0, 0.0]
-        else:
-            player_pos = req.player_pos
-        logger.debug(f"Player position: {player_pos}")
-        
-        # Sample encoding
-        logger.debug(f"Sampling with mode: {req.mode}")
-        sampled = explorer.sample_encoding(tuple(player_pos), mode=req.mode)
-        
-        # Generate mock image (in production, this would use the sampled encoding)
-        img = (np.random.rand(256, 256, 3) * 255).astype(np.uint8)
-        
-        # Convert to base64
-        logger.debug("Converting image to base64")
-        pil_img = Image.fromarray(img)
-        buffer = io.BytesIO()
-        pil_img.save(buffer, format="PNG")
-        img_b64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
-        
-        # Prepare response
-        response = {"status": "success", "image": img_b64}
-        logger.debug(f"Response structure: {list(response.keys())}")
-        logger.debug(f"Image base64 length: {len(img_b64)}")
-        
+        with profiled(profiler):
+            edits = [(edit.id, edit.alpha) for edit in req.edits] if req.edits else None
+            img = generate(req.prompts, req.mode, req.player_pos, req.positions, req.preview, edits)
+            with profile_stage("faceforge.encode_image"):
+                response = image_response(img, format)
+        response.headers.update(store_profile(request, profiler, {"request": req.dict(), "format": format}))
+
         logger.debug("Image generated successfully")
         return response
-        
+
+    except HTTPException:
+        raise
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except RegistryUnavailable as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    except UnknownDirection as e:
+        raise HTTPException(status_code=404, detail=f"Unknown direction: {e.args[0]}")
+    except ValueError as e: # i.e. an unknown mode or directions that don't fit the encodings
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error in generate_image: {str(e)}")
         logger.debug(traceback.format_exc())
@@ -185,37 +463,193 @@ async def generate_image(req: GenerateRequest):
 
 @app.post("/manipulate")
 def manipulate(req: ManipulateRequest):
+    """
+    encoding + alpha * (direction and / or the registered direction_id) + the registered edits, as one update
+    """
+    if req.direction is None and req.direction_id is None and not req.edits:
+        raise HTTPException(status_code=400, detail="Pass a direction, a direction_id or edits")
     try:
         logger.debug(f"Manipulate request: {json.dumps(req.dict(), default=str)}")
         encoding = np.array(req.encoding)
-        direction = np.array(req.direction)
-        manipulated = encoding + req.alpha * direction
+        edits = ([(req.direction_id, req.alpha)] if req.direction_id is not None else []) + [(e.id, e.alpha) for e in req.edits or []]
+        update = direction_update(edits)
+        if req.direction is not None:
+            direction = req.alpha * np.array(req.direction)
+            update = direction if update is None else update + direction
+        if update.shape != encoding.shape:
+            raise ValueError(f"Direction of size {update.size} doesn't fit an encoding of size {encoding.size}")
+        manipulated = encoding + update
         logger.debug("Manipulation successful")
         return {"manipulated_encoding": manipulated.tolist()}
+    except HTTPException:
+        raise
+    except RegistryUnavailable as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    except UnknownDirection as e:
+        raise HTTPException(status_code=404, detail=f"Unknown direction: {e.args[0]}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error in manipulate: {str(e)}")
         logger.debug(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
+def get_dataset(name: str, must_exist: bool = True) -> "LatentDataset":
+    """
+    The dataset called name under DATASET_DIR
+    """
+    if not HAS_CORE:
+        raise HTTPException(status_code=501, detail="Datasets are unavailable")
+    if not re.fullmatch(r"[A-Za-z0-9_.-]{1,128}", name) or name.startswith("."):
+        raise HTTPException(status_code=400, detail="Dataset names are letters, digits, '_', '-' and '.'")
+    dataset = LatentDataset(os.path.join(DATASET_DIR, name))
+    if must_exist and not len(dataset):
+        raise HTTPException(status_code=404, detail=f"Unknown dataset: {name}")
+    return dataset
+
+def dataset_info(name: str, dataset: "LatentDataset") -> dict:
+    return {"name": name, "rows": len(dataset), "dim": dataset.dim, "chunks": len(dataset.entries),
+            "label_columns": dataset.label_columns, "hash": dataset.hash}
+
+@app.post("/datasets/{name}")
+async def append_dataset(name: str, request: Request):
+    """
+    Append latents to a dataset (created by the first append). The body is a binary .npy file of (N, D) latents,
+    or an .npz file with "latents" and optionally "labels" (N,) or (N, K). Upload big corpora in several requests
+    """
+    body = await request.body()
+    # Parsing and writing the chunk is blocking disk work, keep it off the event loop
+    return await run_in_threadpool(append_dataset_body, name, body)
+
+def append_dataset_body(name: str, body: bytes) -> dict:
+    dataset = get_dataset(name, must_exist=False)
+    try:
+        loaded = np.load(io.BytesIO(body), allow_pickle=False)
+        if isinstance(loaded, np.ndarray):
+            latents, labels = loaded, None
+        else:
+            latents, labels = loaded["latents"], loaded["labels"] if "labels" in loaded.files else None
+        dataset.append(latents, labels)
+    except (ValueError, KeyError, OSError) as e: # Not an .npy / .npz file, or arrays that don't fit the dataset
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"appended": len(latents), **dataset_info(name, dataset)}
+
+@app.get("/datasets/{name}")
+def describe_dataset(name: str):
+    return dataset_info(name, get_dataset(name))
+
 @app.post("/attribute_direction")
-def attribute_direction(req: AttributeDirectionRequest):
+def attribute_direction(req: AttributeDirectionRequest, request: Request, response: Response,
+                        profiler=Depends(request_profiler)):
+    """
+    Directions from latents posted in the request, or from an uploaded dataset (read in chunks, with repeat fits
+    looked up by the dataset's hash)
+    """
+    if HAS_CORE and req.solver not in LatentDirectionFinder.SOLVERS:
+        raise HTTPException(status_code=400, detail=f"Unknown solver: {req.solver}")
+    if (req.latents is None) == (req.dataset is None):
+        raise HTTPException(status_code=400, detail="Pass either latents or a dataset")
+    dataset = get_dataset(req.dataset) if req.dataset is not None else None
+    if req.dataset_labels and (dataset is None or not dataset.label_columns):
+        raise HTTPException(status_code=400, detail="dataset_labels needs a dataset with labels")
+    label_matrix = dataset.labels() if req.dataset_labels else req.label_matrix
+    n_latents = len(dataset) if dataset is not None else len(req.latents)
+    if label_matrix is not None and req.labels is not None:
+        raise HTTPException(status_code=400, detail="Pass either labels or label_matrix")
+    if label_matrix is not None and (len(label_matrix) == 0 or len(label_matrix) != n_latents or not len(label_matrix[0])):
+        raise HTTPException(status_code=400, detail="label_matrix needs one non-empty row of labels per latent")
+    if req.store and direction_registry is None:
+        raise HTTPException(status_code=501, detail="The direction registry is unavailable")
     try:
         logger.debug(f"Attribute direction request: {json.dumps(req.dict(), default=str)}")
-        latents = np.array(req.latents)
-        
-        finder = LatentDirectionFinder(latents) if HAS_CORE else MockLatentDirectionFinder(latents)
-        
-        if req.labels is not None:
-            logger.debug("Using classifier-based direction finding")
-            direction = finder.classifier_direction(req.labels)
-            logger.debug("Direction found successfully")
-            return {"direction": direction.tolist()}
-        else:
-            logger.debug(f"Using PCA with {req.n_components} components")
-            components, explained = finder.pca_direction(n_components=req.n_components)
-            logger.debug("PCA completed successfully")
-            return {"components": components.tolist(), "explained_variance": explained.tolist()}
+        with profiled(profiler):
+            latents = dataset if dataset is not None else np.array(req.latents)
+
+            finder = LatentDirectionFinder(latents) if HAS_CORE else MockLatentDirectionFinder(latents)
+
+            if label_matrix is not None:
+                logger.debug(f"Using classifier-based direction finding for {len(label_matrix[0])} attributes")
+                directions = finder.classifier_directions(np.array(label_matrix), solver=req.solver)
+                logger.debug("Directions found successfully")
+                result = {"directions": directions.tolist()}
+            elif req.labels is not None:
+                logger.debug("Using classifier-based direction finding")
+                direction = finder.classifier_direction(req.labels, solver=req.solver)
+                logger.debug("Direction found successfully")
+                result = {"direction": direction.tolist()}
+            else:
+                logger.debug(f"Using PCA with {req.n_components} components")
+                components, explained = finder.pca_direction(n_components=req.n_components)
+                logger.debug("PCA completed successfully")
+                result = {"components": components.tolist(), "explained_variance": explained.tolist()}
+            if req.store:
+                source = dataset.hash if dataset is not None else dataset_hash(latents)
+                result["direction_ids"] = register_directions(req, finder, source, result)
+        meta = {"n_latents": n_latents, "dataset": req.dataset, "labels": req.labels is not None, "solver": req.solver,
+                "attributes": len(label_matrix[0]) if label_matrix is not None else None}
+        response.headers.update(store_profile(request, profiler, meta))
+        return result
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e: # i.e. labels that aren't 0/1 or have a single class
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error in attribute_direction: {str(e)}")
         logger.debug(traceback.format_exc())
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e)) 
+
+def register_directions(req: AttributeDirectionRequest, finder, source: str, result: dict) -> List[str]:
+    """
+    Store the directions of an /attribute_direction result in the registry, returns their ids
+    :param source: Content hash of the latents they were fitted on
+    """
+    if "components" in result:
+        directions, solver, variances = np.array(result["components"]), "pca", result["explained_variance"]
+    else:
+        directions = np.array(result["directions"] if "directions" in result else [result["direction"]])
+        solver = req.solver
+        variances = finder.explained_variance(directions).tolist()
+    if req.names is not None and len(req.names) != len(directions):
+        raise ValueError(f"Got {len(req.names)} names for {len(directions)} directions")
+    return [
+        direction_registry.register(d, req.names[i] if req.names else None, dataset_hash=source, solver=solver,
+                                    explained_variance=variances[i])
+        for i, d in enumerate(directions)
+    ]
+
+@app.get("/directions")
+def list_directions():
+    """
+    Metadata of every registered direction
+    """
+    if direction_registry is None:
+        raise HTTPException(status_code=501, detail="The direction registry is unavailable")
+    return {"directions": direction_registry.list()}
+
+@app.get("/directions/{direction_id}")
+def get_direction(direction_id: str, values: bool = False):
+    """
+    Metadata of a registered direction, with its values if asked for
+    """
+    if direction_registry is None:
+        raise HTTPException(status_code=501, detail="The direction registry is unavailable")
+    try:
+        result = direction_registry.metadata(direction_id)
+        if values:
+            result["direction"] = direction_registry.get(direction_id).astype(np.float32).tolist()
+        return result
+    except UnknownDirection:
+        raise HTTPException(status_code=404, detail=f"Unknown direction: {direction_id}")
+
+@app.get("/profiles/{profile_id}", name="download_profile")
+def download_profile(profile_id: str, request: Request):
+    """
+    Download a stored request profile (zip with cProfile stats, torch operator summary and a chrome trace). Needs the admin token
+    """
+    check_admin(request)
+    if not re.fullmatch(r"[0-9a-f]{32}", profile_id):
+        raise HTTPException(status_code=404, detail="Unknown profile")
+    path = os.path.join(PROFILE_DIR, f"{profile_id}.zip")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Unknown profile")
+    return FileResponse(path, media_type="application/zip", filename=f"faceforge_profile_{profile_id}.zip")
@@ -1,4 +1,5 @@
-from typing import List
+from typing import Any, List, Optional
+from collections import OrderedDict
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
@@ -8,6 +9,10 @@ try:
     from .latent_explorer import LatentSpaceExplorer
     from .attribute_directions import LatentDirectionFinder
     from .custom_loss import attribute_preserving_loss
+    from .edit_strength import EditStrengthOptimizer
+    from .direction_registry import DirectionRegistry
+    from .latent_dataset import LatentDataset
+    from .encoding_compression import CompressedTensor
     from .game_objects import Point, TextPrompt
     HAS_CORE_MODULES = True
 except ImportError as e:
@@ -18,6 +23,11 @@ except ImportError as e:
 try:
     from dataclasses import dataclass
     from .fast_sd import fast_diffusion_pipeline
+    from .embedding_store import EmbeddingStore
+    from .preview import AnchorLatentCache
+    from .render_worker import RenderWorker
+    from .telemetry import LatencyStats, StageTimer, adaptive_interval
+    from .encoding_compression import anchor_memory, batch, compress_encoding
     HAS_DIFFUSION = True
 except ImportError as e:
     logger.warning(f"Failed to import diffusion modules: {e}")
@@ -59,16 +69,54 @@ class GameConfig:
     sample_width : int = 512
     sample_height : int = 512
 
+    model_id : str = "stabilityai/sdxl-turbo" # Diffusion model to load. "tiny" is a small random stand-in for profiling without weights
     compile : bool = False # compile the sd model with torch.compile?
+    device : Optional[str] = None # Device to run the model on. None picks cuda > mps > cpu
+    dtype : Optional[str] = None # Model precision ("fp32", "fp16", "bf16"). None is fp16 on accelerators, fp32 on cpu
+    quantize : Optional[str] = None # None, "dynamic" or "weight_only" int8 quantization of the unet and text encoders
+    backend : Optional[str] = None # None (torch), "onnxruntime" or "openvino" for the unet and decoder
+    onnx_dir : Optional[str] = None # Exported graphs for the backend (python -m faceforge_core.onnx_backend export)
+    embedding_store : Optional[str] = None # Directory of a persistent prompt embedding store. Not used if None
+    encoding_compression : Optional[str] = None # None, "fp16" or "int8" (per-channel scales). Points keep their encodings compressed, blends decompress on the fly
     sampler : str = "distance" # "distance" or "circle"
     seed : int = 0 # Seed for initial latent noise
-    call_every : int = 90 # Only calls draw function every *this many* ms. This is to prevent lag. Set this to be around the latency of the model
+    call_every : int = 90 # Only calls draw function every *this many* ms. This is to prevent lag. Set this to be around the latency of the model. When threaded, only renders while moving are spaced by this
+    adaptive_call_every : bool = True # Set call_every from the measured p50/p95 latency of renders while moving
+    latency_window : int = 120 # Number of recent renders latency percentiles are computed over
+    show_hud : bool = False # Overlay latency stats on screen (toggle with h, export to latency.csv with l)
+    preview : bool = False # While dragging, decode blended per-anchor latents (decoder only) instead of running the full model
+    progressive : bool = False # While dragging, render at low_resolution instead of full resolution
+    low_resolution : int = 256 # Resolution of progressive renders while moving
+    resolution : Optional[int] = None # Resolution of full renders. None is the model's default
+    preview_idle_ms : int = 250 # With preview or progressive on, do a full render once the player hasn't moved for this many ms
+    render_cache_size : int = 256 # Full renders kept per player position, so returning to a spot is instant. 0 disables
+    threaded : bool = True # Render on a background thread (newest position wins) so the window stays responsive
+
+@dataclass
+class RenderJob:
+    """
+    Snapshot of what a render needs, so it can run off the main thread while points keep changing
+    """
+    tier : str # "full", "low" or "preview"
+    point : Any # [2,] player position in R2
+    prompts : List[str]
+    encodings : List[tuple] # Per point encoding tuples
+    positions : Any # [N, 2] point positions in R2
+    sampler : Any # EncodingSampler subclass
+    key : tuple # Render cache key
+    generation : int # Value of render_generation when submitted, stale renders aren't cached
 
 class LatentSpaceExplorer:
     def __init__(self, config : GameConfig = GameConfig()):
         self.config = config
 
-        self.pipe = fast_diffusion_pipeline(compile = self.config.compile)
+        self.pipe = fast_diffusion_pipeline(
+            model_id = self.config.model_id, compile = self.config.compile, device = self.config.device, dtype = self.config.dtype,
+            quantize = self.config.quantize, backend = self.config.backend, onnx_dir = self.config.onnx_dir
+        )
+        self.embedding_store = EmbeddingStore(self.config.embedding_store) if self.config.embedding_store else None
+        self.anchor_latents = AnchorLatentCache(self.pipe, seed = self.config.seed)
+        self.render_worker = RenderWorker(self.render) if self.config.threaded else None
         self.points : List[Point] = []
         self.player_pos = None # [2,] np array in R2 space
 
@@ -91,12 +139,27 @@ class LatentSpaceExplorer:
         self.screen = pygame.display.set_mode((self.config.width, self.config.height))
         self.clock = pygame.time.Clock()
         self.ms_elapsed = 0
+        self.ms_since_move = 0
+        self.pending_full_render = False # Last sample was a preview
 
         # (n_samples, running average)
         self.avg_latency = (0, 0) # Track average latency of generation for debug
+        self.latency = LatencyStats(self.config.latency_window) # Recent renders per tier, with per-stage times
+        self.hud_surfaces = [] # Rendered HUD lines, for latency.version hud_version
+        self.hud_version = None
+        self.render_cache = OrderedDict() # rounded player position -> full render, for the current points
+        self.render_generation = 0 # Bumped whenever points change
         
         self.sample_image = None
+        self.sample_key = None # (render_key, render_generation) of a full render on screen, None for anything else
         self.sample_font = pygame.font.Font(None, self.config.point_font_size)
+
+        # Drawing caches
+        self.text_surfaces = {} # (text, color) -> rendered label
+        self.scaled_sample = None # sample_image scaled to the sample size, rebuilt when sample_image changes
+        self.scaled_sample_source = None
+        self.dirty_rects = [] # Screen regions drawn last frame, cleared and updated on the next one
+        self.full_redraw = True # Clear and flip the whole screen next frame
         
         # User input
         self.input_font = pygame.font.Font(None, self.config.prompt_font_size)
@@ -107,11 +170,22 @@ class LatentSpaceExplorer:
     def tick(self):
         self.clock.tick()
         self.ms_elapsed += self.clock.get_time()
+        self.ms_since_move += self.clock.get_time()
 
-    def update_latency(self, new_observation):
+    def update_latency(self, new_observation, tier = "full", stages = None):
         n = self.avg_latency[0]
         old_avg = self.avg_latency[1]
         self.avg_latency = (n + 1, (old_avg * n + new_observation) / (n + 1))
+        self.latency.record(new_observation, tier, stages)
+
+        if self.config.adaptive_call_every:
+            interval = adaptive_interval(self.latency, self.moving_tier)
+            if interval is not None:
+                self.config.call_every = int(interval)
+
+    def export_latency(self, path = "latency.csv"):
+        self.latency.to_csv(path)
+        logger.info(f"Wrote latency of the last {len(self.latency)} renders to {path}")
 
     def create_text_prompt(self, prompt_text):
         self.text_prompt = TextPrompt(prompt_text, self.input_font, self.screen)
@@ -134,13 +208,25 @@ class LatentSpaceExplorer:
         """
         if not self.points:
             return None
-        encode_list = [p.encoding for p in self.points] # list of N-tuples
+        return self.batch_encodings([p.encoding for p in self.points])
+
+    @staticmethod
+    def batch_encodings(encode_list):
+        """
+        List of per point N-tuples into an N-tuple of batched encodings
+        """
         n = len(encode_list[0])
         res = []
         for i in range(n):
-            res.append(torch.cat([e[i] for e in encode_list], dim = 0) if encode_list[0][i] is not None else None)
+            res.append(batch([e[i] for e in encode_list])) # Compressed encodings stay compressed
 
         return tuple(res)
+
+    def anchor_memory(self):
+        """
+        Memory held by the points' encodings: {"compression", "anchors", "bytes", "bytes_per_anchor"}
+        """
+        return anchor_memory([p.encoding for p in self.points], self.config.encoding_compression)
     
     @property
     def prompts(self):
@@ -186,13 +272,33 @@ class LatentSpaceExplorer:
         """
         Controls random number generator for initial latent noise
         """
-        return torch.Generator('cuda').manual_seed(self.config.seed)
+        return torch.Generator(self.pipe.device).manual_seed(self.config.seed)
+
+    def initial_latents(self, resolution = None, dtype = None):
+        """
+        Initial latent noise for the seed. Cached by the pipeline, so no random numbers are drawn per frame
+        """
+        dtype = dtype or self.encodes[0].dtype
+        return self.pipe.initial_latents(self.config.seed, height = resolution, width = resolution, dtype = dtype)
     
     def get_encodes(self, text):
+        """
+        Get text encodings for some prompts, going through the embedding store if there is one.
+        Compressed with config.encoding_compression, if set
+        """
+        if self.embedding_store is not None:
+            encodes = self.embedding_store.cached_encodes(self.config.model_id, text, self.encode_prompts, device = self.pipe.device)
+        else:
+            encodes = self.encode_prompts(text)
+        if self.config.encoding_compression is None:
+            return encodes
+        return [compress_encoding(e, self.config.encoding_compression) for e in encodes]
+
+    def encode_prompts(self, text):
         """
         Get text encodings for some prompt then split them so we can associate points with thier encodings
         """
-        encodes = self.pipe.get_encodes(text, generator = self.fixed_seed())
+        encodes = self.pipe.get_encodes(text)
         # (n-tuple of lists) into (list of n-tuples)
         if not isinstance(encodes, tuple) and not isinstance(encodes, list):
             return encodes # Already a tensor, no problem
@@ -204,20 +310,145 @@ class LatentSpaceExplorer:
 
         return res_list
     
-    def draw_sample(self):
+    @property
+    def render_key(self):
+        """
+        Key of the player position in the render cache
+        """
+        return tuple(np.round(self.player_pos, 3))
+
+    def invalidate_renders(self):
+        """
+        Call when points change, cached renders are for the old points
         """
-        Draw sample with current points and player position
+        self.render_cache.clear()
+        self.render_generation += 1
+
+    def render_job(self, tier):
+        """
+        :param tier: "full", "low" (full model at config.low_resolution) or "preview" (decode blended anchor latents)
+        """
+        return RenderJob(
+            tier = tier, point = np.array(self.player_pos), prompts = self.prompts, encodings = [p.encoding for p in self.points],
+            positions = self.r2_points, sampler = self.sampler, key = self.render_key, generation = self.render_generation,
+        )
+
+    def render(self, job : RenderJob):
+        """
+        Render a job. Only reads the job and the pipeline, so it's safe to call from the render worker.
+        Returns the image as an [H, W, 3] uint8 array and the time (ms) of each stage.
+        """
+        timer = StageTimer(self.pipe.device)
+        if job.tier == "preview":
+            resolution = self.config.resolution
+            with timer.stage("latents"):
+                latents = self.anchor_latents.latents(job.prompts, job.encodings, height = resolution, width = resolution)
+            with timer.stage("blend"):
+                latents = job.sampler(latents, normalize = True)(job.point, job.positions).unsqueeze(0)
+        else:
+            resolution = self.config.low_resolution if job.tier == "low" else self.config.resolution
+            with timer.stage("blend"):
+                encodes = self.batch_encodings(job.encodings)
+                encoding = job.sampler(encodes)(job.point, job.positions)
+            with timer.stage("unet"):
+                latents = self.pipe.generate_from_encodes(
+                    encoding, latents = self.initial_latents(resolution, encodes[0].dtype), height = resolution, width = resolution, output_type = "latent"
+                ).images
+        with timer.stage("decode"):
+            image = self.pipe.decode(latents, output_type = "uint8")[0]
+        return image, timer.stages
+
+    def draw_sample(self, tier = "full", moving = False):
+        """
+        Draw sample with current points and player position. Anything but a full render is followed by
+        a full render once the player stops moving (see update). Full renders are cached per position.
+
+        With a render worker the job is only posted (replacing any older pending one) and the image shows up
+        in a later frame, see collect_sample. Jobs posted while moving are spaced by call_every, so positions
+        the worker would only render to throw away aren't queued; a skipped one is covered by the full render
+        once the player stops.
+
+        :param tier: See render_job
+        :param moving: Whether the player is moving, i.e. the render may be skipped to respect call_every
         """
         if self.player_pos is not None and self.encodes is not None:
-            if self.ms_elapsed >= self.config.call_every:
+            cached = self.render_cache.get(self.render_key)
+            if cached is not None:
+                self.render_cache.move_to_end(self.render_key)
+                self.sample_image = cached
+                self.sample_key = (self.render_key, self.render_generation)
+                self.pending_full_render = False
+                if self.render_worker is not None:
+                    self.render_worker.cancel() # Older positions' renders mustn't replace this frame
+                return
+
+            if self.render_worker is not None:
+                if moving and self.ms_elapsed < self.config.call_every:
+                    self.pending_full_render = True
+                    return
+                self.render_worker.submit(self.render_job(tier))
+                self.ms_elapsed = 0
+                self.pending_full_render = tier != "full"
+            elif self.ms_elapsed >= self.config.call_every:
+                job = self.render_job(tier)
                 time_start = time.time()
-                encoding = self.sampler(self.encodes)(self.player_pos, self.r2_points)
-                self.sample_image = self.pipe.generate_from_encodes(encoding, generator = self.fixed_seed()).images[0]
+                result = self.render(job)
                 time_total = float(time.time() - time_start) * 1000 # s -> ms
 
-                self.update_latency(time_total)
-
+                self.finish_sample(job, result, time_total)
                 self.ms_elapsed = 0
+                self.pending_full_render = tier != "full"
+
+    def finish_sample(self, job : RenderJob, result, ms):
+        """
+        Show a finished render and record it. Renders of old points (an outdated render_generation) are dropped,
+        and so are renders of other positions once the full render of the current position is on screen.
+        Renders of positions the player has since moved past are still shown while nothing better is.
+
+        :param result: (image, stage times) as returned by render
+        """
+        image, stages = result
+        self.update_latency(ms, job.tier, stages)
+        if job.generation != self.render_generation:
+            return
+        current = (self.render_key, self.render_generation)
+        if job.key != self.render_key and self.sample_key == current:
+            return
+
+        self.sample_image = image
+        self.sample_key = (job.key, job.generation) if job.tier == "full" else None
+        if job.tier == "full" and self.config.render_cache_size > 0:
+            self.render_cache[job.key] = image
+            while len(self.render_cache) > self.config.render_cache_size:
+                self.render_cache.popitem(last = False)
+
+    def collect_sample(self):
+        """
+        Swap in the render worker's newest finished image, if there is one
+        """
+        if self.render_worker is not None:
+            finished = self.render_worker.poll()
+            if finished is not None:
+                self.finish_sample(*finished)
+
+    @property
+    def moving_tier(self):
+        """
+        Render tier while the player is moving
+        """
+        if self.config.preview:
+            return "preview"
+        if self.config.progressive:
+            return "low"
+        return "full"
+
+    def move_player(self):
+        """
+        Move player to the mouse and draw (a cheaper version of) the sample there
+        """
+        self.get_player_pos_r2()
+        self.ms_since_move = 0
+        self.draw_sample(self.moving_tier, moving = True)
 
     def get_player_pos_r2(self):
         """
@@ -293,14 +524,27 @@ class LatentSpaceExplorer:
             self.text_prompt = None
             self.inputting_text = False
 
+    def diff_encodes(self, prompts : List[str]):
+        """
+        Get encodings for prompts, reusing the ones existing points already have.
+        Only prompts that are new (or were modified) are sent to the text encoders, in a single batch.
+        """
+        known = {p.text : p.encoding for p in self.points}
+        missing = [prompt for prompt in dict.fromkeys(prompts) if prompt not in known]
+
+        if missing:
+            known.update(zip(missing, self.get_encodes(missing)))
+        return [known[prompt] for prompt in prompts]
+
     def set_prompts(self, prompts : List[str], reset : bool = False):
         """
         :param prompts: New prompts to update to
         :param reset: Reset xy positions of points?
         """
 
-        if len(prompts) > 0:
-            encodes = self.get_encodes(prompts)
+        encodes = self.diff_encodes(prompts)
+        self.invalidate_renders()
+        self.text_surfaces.clear()
 
         # First call
         if not self.points or reset:
@@ -329,10 +573,14 @@ class LatentSpaceExplorer:
 
     def handle_event_controls(self):
         """
-        Handles discrete (i.e. keydown, mousedown) controls through events
+        Handles discrete (i.e. keydown, mousedown) controls through events.
+        Motion events are coalesced, only the newest mouse position of the frame is acted on.
         """
+        moved, dragged = False, False
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
+                if self.render_worker is not None:
+                    self.render_worker.stop()
                 pygame.quit()
                 quit()
             elif event.type == pygame.MOUSEBUTTONDOWN:
@@ -351,11 +599,9 @@ class LatentSpaceExplorer:
                     self.dragging_point_idx = None # Disable drag
             elif event.type == pygame.MOUSEMOTION:
                 if self.dragging_point_idx is not None:
-                    # Drag point
-                    self.points[self.dragging_point_idx].move(self.invert_screen_space(self.mouse_pos))
+                    dragged = True
                 elif pygame.mouse.get_pressed()[0]:
-                    self.get_player_pos_r2()
-                    self.draw_sample()
+                    moved = True
             elif event.type == pygame.KEYDOWN:
                 keys = pygame.key.get_pressed()
                 if keys[pygame.K_r]:
@@ -371,11 +617,21 @@ class LatentSpaceExplorer:
                     self.del_node()
                 elif keys[pygame.K_g]:
                     if self.sample_image is not None:
-                        self.sample_image.save("sample.png")
+                        Image.fromarray(self.sample_image).save("sample.png")
                 elif keys[pygame.K_m]:
                     # Change sampler mode
                     self.switch_sampler()
-
+                elif keys[pygame.K_h]:
+                    self.config.show_hud = not self.config.show_hud
+                elif keys[pygame.K_l]:
+                    self.export_latency()
+
+        if dragged:
+            # Drag point
+            self.points[self.dragging_point_idx].move(self.invert_screen_space(self.mouse_pos))
+            self.invalidate_renders()
+        elif moved:
+            self.move_player()
 
     def handle_continuous_controls(self):
         """
@@ -404,10 +660,34 @@ class LatentSpaceExplorer:
 
     # === DRAWING THINGS ===
 
+    def text_surface(self, text, color):
+        """
+        Rendered point label, cached since font rendering is the slowest part of drawing a frame
+        """
+        key = (text, color)
+        surface = self.text_surfaces.get(key)
+        if surface is None:
+            surface = self.sample_font.render(text, True, color)
+            self.text_surfaces[key] = surface
+        return surface
+
+    def sample_surface(self):
+        """
+        Sample image scaled for the screen, only rebuilt when a new image arrives
+        """
+        if self.sample_image is not self.scaled_sample_source:
+            # Wraps the pipeline's uint8 output without copying it
+            height, width = self.sample_image.shape[:2]
+            pygame_image = pygame.image.frombuffer(self.sample_image, (width, height), "RGB")
+            self.scaled_sample = pygame.transform.scale(pygame_image, (self.config.sample_width, self.config.sample_height))
+            self.scaled_sample_source = self.sample_image
+        return self.scaled_sample
+
     def draw_main_screen(self):
         """
-        Draw main screen. Sample image, points, etc.
+        Draw main screen. Sample image, points, etc. Returns the rects that were drawn to.
         """
+        rects = []
         def get_point_color(idx):
             color = (255, 255, 255) # default to white
             if idx == self.selected_point_idx:
@@ -425,22 +705,45 @@ class LatentSpaceExplorer:
             border = self.screen_space(border)
             radius = abs(border[0] - center[0])
 
-            pygame.draw.circle(self.screen, (255, 255, 255), center, int(radius), 1)
+            rects.append(pygame.draw.circle(self.screen, (255, 255, 255), center, int(radius), 1))
         
         if len(self.points) > 0:
             for idx, point in enumerate(self.screen_space_points):
-                pygame.draw.circle(self.screen, get_point_color(idx), point, self.config.point_thickness)
-                text = self.sample_font.render(self.points[idx].text, True, get_point_color(idx))
-                self.screen.blit(text, point)
+                color = get_point_color(idx)
+                rects.append(pygame.draw.circle(self.screen, color, point, self.config.point_thickness))
+                rects.append(self.screen.blit(self.text_surface(self.points[idx].text, color), point))
         
         player_pos = self.get_player_pos_screenspace()
         if player_pos is not None:
-            pygame.draw.circle(self.screen, (0, 255, 0), player_pos, self.config.point_thickness/2)
+            rects.append(pygame.draw.circle(self.screen, (0, 255, 0), player_pos, self.config.point_thickness/2))
         
         if self.sample_image is not None:
-            pygame_image = pygame.image.fromstring(self.sample_image.tobytes(), self.sample_image.size, self.sample_image.mode)
-            pygame_image = pygame.transform.scale(pygame_image, (self.config.sample_width, self.config.sample_height))
-            self.screen.blit(pygame_image, (0, 0))
+            rects.append(self.screen.blit(self.sample_surface(), (0, 0)))
+
+        if self.config.show_hud:
+            rects += self.draw_hud()
+        return rects
+
+    def draw_hud(self):
+        """
+        Latency stats (and with encoding_compression, memory per anchor) in the bottom left corner.
+        Lines are only re-rendered after new renders or changes of points
+        """
+        version = (self.latency.version, self.render_generation)
+        if self.hud_version != version:
+            lines = self.latency.lines()
+            if self.config.encoding_compression and self.points:
+                memory = self.anchor_memory()
+                lines.append(f"anchors: {memory['anchors']} x {memory['bytes_per_anchor'] / 1024:.0f} KB ({memory['compression']})")
+            self.hud_surfaces = [self.sample_font.render(line, True, (255, 255, 0)) for line in lines]
+            self.hud_version = version
+
+        rects = []
+        y = self.config.height
+        for surface in reversed(self.hud_surfaces):
+            y -= surface.get_height()
+            rects.append(self.screen.blit(surface, (0, y)))
+        return rects
 
     def update(self):
         """
@@ -451,11 +754,29 @@ class LatentSpaceExplorer:
             self.handle_event_controls()
             self.handle_continuous_controls()
         self.tick()
+        self.collect_sample()
+
+        # Player stopped moving, replace the preview or low resolution render with the full render
+        if self.pending_full_render and self.ms_since_move >= self.config.preview_idle_ms:
+            self.draw_sample()
         
-        self.screen.fill((0,0,0))
-        self.draw_main_screen()
+        # Only clear and push the regions drawn last frame and this frame, unless the whole screen needs redrawing
+        full_redraw = self.full_redraw or self.inputting_text
+        if full_redraw:
+            self.screen.fill((0,0,0))
+        else:
+            for rect in self.dirty_rects:
+                self.screen.fill((0,0,0), rect)
+        rects = self.draw_main_screen()
 
         # Handle prompt after so it can be drawn over the main screen
+        # The text box isn't tracked as a dirty rect, so the frame after it closes is a full redraw too
+        self.full_redraw = self.inputting_text
         if self.inputting_text:
             self.handle_prompt()
-        pygame.display.flip()
+
+        if full_redraw:
+            pygame.display.flip()
+        else:
+            pygame.display.update(self.dirty_rects + rects)
+        self.dirty_rects = rects
@@ -0,0 +1,101 @@
+"""
+Append-only index files, the scheme the on-disk stores share (embedding store, direction registry, latent datasets)
+
+A store directory has a JSONL index that only ever grows, data its lines point at, and a lock file flock'd by writers.
+Readers never take the lock. Writers put the data in place before appending the index line pointing at it, and readers
+only consume complete lines, so a reader sees either the whole entry or none of it. Replacing the index with os.replace
+(i.e. compaction) gives it a new inode, which readers notice and read from the start.
+"""
+
+import os
+import json
+import fcntl
+import threading
+from contextlib import contextmanager
+from typing import List, Sequence, Tuple
+
+ALIGNMENT = 64 # Byte alignment of every blob appended with append_aligned
+
+class AppendOnlyIndex:
+    """
+    JSONL index read incrementally, and the writer lock of the store it belongs to
+
+    :param path: Index file. May not exist yet
+    :param lock_path: File flock'd by writers. Its directory is created on the first write
+    """
+    def __init__(self, path : str, lock_path : str):
+        self.path = path
+        self.lock_path = lock_path
+        self.thread_lock = threading.RLock() # Held for reads and writes, so threads sharing a store see consistent state
+        self.reset()
+
+    def reset(self):
+        """
+        Read the index from its start again on the next read
+        """
+        self.pos = 0
+        self.ino = None
+
+    def read(self) -> Tuple[List[dict], bool]:
+        """
+        Records appended (by any process) since the last read, and whether the index was replaced in the meantime.
+        If it was, the records start from the beginning of the new index and the caller drops what it read before.
+        No records while the index doesn't exist
+        """
+        with self.thread_lock:
+            try:
+                f = open(self.path, "rb")
+            except FileNotFoundError:
+                return [], False
+            with f:
+                ino = os.fstat(f.fileno()).st_ino
+                replaced = self.ino is not None and ino != self.ino
+                if replaced:
+                    self.pos = 0
+                self.ino = ino
+                f.seek(self.pos)
+                chunk = f.read()
+
+            # Only consume complete lines, a writer may be in the middle of appending the last one
+            end = chunk.rfind(b"\n") + 1
+            self.pos += end
+            return [json.loads(line) for line in chunk[:end].splitlines()], replaced
+
+    @contextmanager
+    def locked(self):
+        """
+        Exclusive writer lock, against other threads and other processes
+        """
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok = True)
+        with self.thread_lock, open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def append(self, records : Sequence[dict]):
+        """
+        Append records in one write. The caller holds the lock and has written the data they point at
+        """
+        with open(self.path, "a") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+
+    def replace(self, records : Sequence[dict]):
+        """
+        Swap in a new index holding only records. The caller holds the lock
+        """
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+        os.replace(tmp_path, self.path)
+
+def append_aligned(f, data : bytes, alignment : int = ALIGNMENT) -> int:
+    """
+    Append data to a file opened for binary appending, zero padded to start at a multiple of alignment.
+    Returns the offset it starts at
+    """
+    offset = f.seek(0, os.SEEK_END)
+    pad = -offset % alignment
+    f.write(b"\0" * pad + data)
+    return offset + pad
@@ -1,35 +1,338 @@
 import numpy as np
-from typing import Tuple, List, Optional
+import torch
+from typing import Iterator, Tuple, List, Optional, Union
 from sklearn.decomposition import PCA
 from sklearn.linear_model import LogisticRegression
+from sklearn.utils.extmath import randomized_svd
+from .direction_registry import dataset_hash
+from .latent_dataset import LatentDataset
 
 class LatentDirectionFinder:
     """
     Provides methods to discover semantic directions in latent space using PCA or classifier-based approaches.
+    Latents are an in-memory array, or a LatentDataset on disk that is read chunk by chunk (bounded memory: a D x D
+    covariance only up to dense_max_dim dimensions, D x rank sketches beyond), with the results of fits stored
+    alongside it by dataset hash and parameters.
     """
-    def __init__(self, latent_vectors: np.ndarray):
+    # Solvers for classifier_direction, fastest first:
+    # - "mean_diff": difference of the class means. One pass over the data
+    # - "lda": shrinkage LDA, the class mean difference whitened by a low-rank + diagonal estimate of the covariance
+    # - "sgd": L2 logistic regression (same objective as "logistic") fit by minibatch Adam in torch, with early stopping
+    # - "logistic": sklearn's LogisticRegression (lbfgs). Slow and often unconverged at SDXL embedding widths
+    SOLVERS = ("mean_diff", "lda", "sgd", "logistic")
+
+    def __init__(self, latent_vectors: Union[np.ndarray, LatentDataset], chunk_rows: int = 65536, dense_max_dim: int = 2048):
         """
-        :param latent_vectors: Array of shape (N, D) where N is the number of samples and D is the latent dimension.
+        :param latent_vectors: Array of shape (N, D) where N is the number of samples and D is the latent dimension,
+            or a LatentDataset of them
+        :param chunk_rows: Rows per block when streaming over an in-memory array (datasets use their own chunks)
+        :param dense_max_dim: Widest datasets whose D x D covariance is formed (exact eigenpairs). Wider ones get
+            their top eigenpairs from a streamed randomized range finder (see low_rank_covariance)
         """
         self.latent_vectors = latent_vectors
+        self.dataset = latent_vectors if isinstance(latent_vectors, LatentDataset) else None
+        self.chunk_rows = chunk_rows
+        self.dense_max_dim = dense_max_dim
+        self.cache = {} # Label independent statistics (covariance, standardized latents), shared by every fit
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return tuple(self.latent_vectors.shape)
+
+    def chunks(self) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        The latents in blocks of rows, as (offset of the first row, block): the dataset's chunks or slices of the array
+        """
+        if self.dataset is None:
+            for start in range(0, len(self.latent_vectors), self.chunk_rows):
+                yield start, self.latent_vectors[start:start + self.chunk_rows]
+            return
+        start = 0
+        for chunk in self.dataset.chunks():
+            yield start, chunk
+            start += len(chunk)
+
+    def cached(self, key: dict, fit):
+        """
+        fit() (a dict of arrays), looked up in / stored to the dataset's fits by key. Not stored for in-memory latents
+        """
+        return self.dataset.cached_fit(key, fit) if self.dataset is not None else fit()
 
     def pca_direction(self, n_components: int = 10) -> Tuple[np.ndarray, np.ndarray]:
         """
         Perform PCA on the latent vectors to find principal directions.
         :return: (components, explained_variance)
         """
+        if self.dataset is not None:
+            components, eig, trace = self.low_rank_covariance(n_components)
+            return components, eig / trace
         pca = PCA(n_components=n_components)
         pca.fit(self.latent_vectors)
         return pca.components_, pca.explained_variance_ratio_
 
-    def classifier_direction(self, labels: List[int]) -> np.ndarray:
+    def moments(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Mean (D,) and covariance (D, D) of the latents in one pass over the chunks (float64).
+        Only up to dense_max_dim dimensions, wider latents go through low_rank_covariance
+        """
+        if self.shape[1] > self.dense_max_dim:
+            raise ValueError(f"A {self.shape[1]} x {self.shape[1]} covariance is over dense_max_dim, use low_rank_covariance")
+        if "moments" not in self.cache:
+            def fit():
+                n, shift, total, outer = 0, None, 0.0, 0.0
+                for _, x in self.chunks():
+                    x = np.asarray(x, dtype=np.float64)
+                    shift = x[0] if shift is None else shift # Shifted sums against cancellation
+                    centered = x - shift
+                    n, total, outer = n + len(x), total + centered.sum(0), outer + centered.T @ centered
+                mean = total / n
+                return {"mean": shift + mean, "cov": outer / n - np.outer(mean, mean)}
+            result = self.cached({"method": "moments"}, fit)
+            self.cache["moments"] = (result["mean"], result["cov"])
+        return self.cache["moments"]
+
+    def low_rank_covariance(self, rank: int, n_iter: int = 4, oversample: int = 10, seed: int = 0):
+        """
+        Top `rank` eigenpairs of the latents' covariance and its trace, exact from moments() up to dense_max_dim
+        dimensions. Wider latents never form the D x D matrix: a randomized range finder streamed over the chunks,
+        subspace iteration Q <- orth(C Q) from a random (D, rank + oversample) Q with one pass per iteration
+        (C Q = Xc^T (Xc Q) / N, chunk by chunk), then the eigenpairs of C within the last subspace (Rayleigh-Ritz).
+        Memory is O(D (rank + oversample)) besides a chunk, and n_iter passes of O(N D (rank + oversample)).
+        :return: (eigenvectors [rank, D], eigenvalues [rank], trace of the covariance)
+        """
+        key = ("low_rank_covariance", rank, n_iter, oversample, seed)
+        if key in self.cache:
+            return self.cache[key]
+        n, d = self.shape
+        if d <= self.dense_max_dim:
+            _, cov = self.moments()
+            eig, vecs = np.linalg.eigh(cov)
+            top = np.argsort(eig)[::-1][:rank]
+            self.cache[key] = (vecs[:, top].T, eig[top], np.trace(cov))
+            return self.cache[key]
+
+        def fit():
+            mean, std = self.feature_stats()
+            q, _ = np.linalg.qr(np.random.default_rng(seed).standard_normal((d, min(rank + oversample, d))))
+            rows = max(1, 2 ** 27 // d) # float64 copies of at most ~1 GB, however wide the chunks are
+            for _ in range(max(n_iter, 1)):
+                basis, cq = q, np.zeros_like(q)
+                for _, chunk in self.chunks():
+                    for start in range(0, len(chunk), rows):
+                        centered = np.asarray(chunk[start:start + rows], dtype=np.float64) - mean
+                        cq += centered.T @ (centered @ basis)
+                cq /= n
+                q, _ = np.linalg.qr(cq)
+            # C restricted to the last basis: basis^T C basis
+            eig, vecs = np.linalg.eigh(basis.T @ cq)
+            top = np.argsort(eig)[::-1][:rank]
+            return {"components": (basis @ vecs[:, top]).T, "eigenvalues": eig[top],
+                    "trace": np.array((std ** 2).sum() * (n - 1) / n)}
+        key_dict = {"method": "low_rank_covariance", "rank": rank, "n_iter": n_iter, "oversample": oversample, "seed": seed}
+        result = self.cached(key_dict, fit)
+        self.cache[key] = (result["components"], result["eigenvalues"], float(result["trace"]))
+        return self.cache[key]
+
+    def feature_stats(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Mean (D,) and standard deviation (D,) of every dimension, in one pass over the chunks
+        """
+        if "feature_stats" not in self.cache:
+            n, shift, total, squares = 0, None, 0.0, 0.0
+            for _, x in self.chunks():
+                x = np.asarray(x, dtype=np.float64)
+                shift = x[0] if shift is None else shift
+                centered = x - shift
+                n, total, squares = n + len(x), total + centered.sum(0), squares + (centered ** 2).sum(0)
+            mean = total / n
+            var = (squares / n - mean ** 2) * n / max(n - 1, 1)
+            self.cache["feature_stats"] = (shift + mean, np.sqrt(np.maximum(var, 0)))
+        return self.cache["feature_stats"]
+
+    def explained_variance(self, directions: np.ndarray) -> np.ndarray:
+        """
+        Share of the latents' total variance along each unit direction (K, D), in one pass over the chunks
+        """
+        directions = np.atleast_2d(directions)
+        mean, _ = self.feature_stats()
+        along, total = 0.0, 0.0
+        for _, x in self.chunks():
+            centered = np.asarray(x, dtype=np.float64) - mean
+            along, total = along + ((centered @ directions.T) ** 2).sum(0), total + (centered ** 2).sum()
+        return along / total if total > 0 else np.zeros(len(directions))
+
+    def classifier_direction(self, labels: List[int], solver: str = "logistic", **kwargs) -> np.ndarray:
         """
         Fit a linear classifier to find a direction separating two classes in latent space.
-        :param labels: List of 0/1 labels for each latent vector.
-        :return: Normalized direction vector (D,)
-        """
-        clf = LogisticRegression()
-        clf.fit(self.latent_vectors, labels)
-        direction = clf.coef_[0]
-        direction = direction / np.linalg.norm(direction)
-        return direction 
\ No newline at end of file
+        :param labels: List of 0/1 labels for each latent vector (or any two values, the larger one is class 1).
+        :param solver: One of SOLVERS. Extra keyword arguments go to the solver's method
+        :return: Normalized direction vector (D,), pointing towards class 1
+        """
+        return self.classifier_directions(np.asarray(labels)[:, None], solver, **kwargs)[0]
+
+    def classifier_directions(self, labels: np.ndarray, solver: str = "logistic", **kwargs) -> np.ndarray:
+        """
+        Directions for several attributes of the same latents at once. Statistics that don't depend on the labels
+        (covariance, standardized features) are computed once and shared, so K attributes cost little more than one
+        (except with "logistic", which fits K sklearn models).
+        :param labels: (N, K) array of 0/1 labels, one column per attribute
+        :param solver: One of SOLVERS. Extra keyword arguments go to the solver's method
+        :return: (K, D) normalized directions, each pointing towards its class 1
+        """
+        labels = self.check_labels(labels)
+        if solver not in self.SOLVERS:
+            raise ValueError(f"Unknown solver: {solver}, expected one of {self.SOLVERS}")
+        if self.dataset is not None:
+            if solver == "logistic":
+                raise ValueError("The logistic solver needs the latents in memory, use sgd (the same objective) for datasets")
+            key = {"method": "classifier", "solver": solver, "labels": dataset_hash(labels), "kwargs": kwargs,
+                   "dense": self.shape[1] <= self.dense_max_dim}
+            return self.cached(key, lambda: {"directions": self.fit_directions(labels, solver, **kwargs)})["directions"]
+        return self.fit_directions(labels, solver, **kwargs)
+
+    def fit_directions(self, labels: np.ndarray, solver: str, **kwargs) -> np.ndarray:
+        if solver == "logistic":
+            directions = np.stack([LogisticRegression(**kwargs).fit(self.latent_vectors, y).coef_[0] for y in labels.T])
+        elif solver == "mean_diff":
+            directions = self.mean_differences(labels)
+        elif solver == "lda":
+            directions = self.lda_directions(labels, **kwargs)
+        else:
+            directions = self.sgd_logistic_directions(labels, **kwargs)
+        return directions / np.linalg.norm(directions, axis=1, keepdims=True)
+
+    def check_labels(self, labels) -> np.ndarray:
+        """
+        (N, K) 0/1 labels from labels with two distinct values per attribute (i.e. -1/1 or 0/1, as LogisticRegression
+        takes them). The larger value is class 1
+        """
+        labels = np.asarray(labels)
+        if labels.ndim != 2 or len(labels) != self.shape[0]:
+            raise ValueError(f"Expected labels of shape ({self.shape[0]}, K), got {labels.shape}")
+        classes = [np.unique(column) for column in labels.T]
+        if any(len(c) < 2 for c in classes):
+            raise ValueError("Labels need samples of both classes for every attribute")
+        if any(len(c) > 2 for c in classes):
+            raise ValueError("Labels must take two values per attribute")
+        return np.stack([column == c[1] for column, c in zip(labels.T, classes)], axis=1).astype(np.int64)
+
+    def mean_differences(self, labels: np.ndarray) -> np.ndarray:
+        """
+        (K, D) mean of class 1 minus mean of class 0 per attribute (not normalized), from (K, rows) x (rows, D)
+        products over the chunks
+        """
+        counts = labels.sum(0)[:, None]
+        pos_sums, total = 0.0, 0.0
+        for start, x in self.chunks():
+            pos_sums = pos_sums + labels[start:start + len(x)].T.astype(np.float64) @ x
+            total = total + x.sum(0, dtype=np.float64)
+        return pos_sums / counts - (total - pos_sums) / (self.shape[0] - counts)
+
+    def covariance_model(self, rank: int = 64, shrinkage: float = 0.1, seed: int = 0):
+        """
+        Low-rank + diagonal estimate of the latents' covariance, shrunk towards a multiple of the identity:
+        the top `rank` eigenpairs (randomized SVD, or low_rank_covariance for datasets), with the mean of the
+        remaining eigenvalues for the rest.
+        :return: (eigenvectors [rank, D], eigenvalues [rank], eigenvalue of the orthogonal complement)
+        """
+        key = ("covariance", rank, shrinkage, seed)
+        if key not in self.cache:
+            n, d = self.shape
+            rank = max(1, min(rank, n - 1, d - 1))
+            if self.dataset is not None:
+                vt, eig, total = self.low_rank_covariance(rank, seed=seed)
+            else:
+                centered = self.latent_vectors - self.latent_vectors.mean(0)
+                _, s, vt = randomized_svd(centered, n_components=rank, random_state=seed)
+                eig = s ** 2 / n
+                total = (centered ** 2).sum() / n # Trace of the covariance
+
+            residual = max(total - eig.sum(), 0) / (d - rank) # Mean of the dropped eigenvalues
+            target = total / d
+            eig = (1 - shrinkage) * eig + shrinkage * target
+            residual = max((1 - shrinkage) * residual + shrinkage * target, 1e-12)
+            self.cache[key] = (vt, eig, residual)
+        return self.cache[key]
+
+    def lda_directions(self, labels: np.ndarray, rank: int = 64, shrinkage: float = 0.1, seed: int = 0) -> np.ndarray:
+        """
+        Shrinkage LDA: Sigma^-1 (mu_1 - mu_0) per attribute, never forming the D x D matrix (O(N D rank)).
+        Sigma is the total covariance (covariance_model), shared by all attributes. It differs from an attribute's
+        within-class covariance by a rank one term along mu_1 - mu_0, which only rescales Sigma^-1 (mu_1 - mu_0)
+        (Sherman-Morrison), so the direction is the same.
+        :param rank: Number of covariance eigenpairs kept
+        :param shrinkage: Weight of the identity target, in [0, 1]
+        """
+        vt, eig, residual = self.covariance_model(rank, shrinkage, seed)
+        diffs = self.mean_differences(labels)
+        proj = diffs @ vt.T
+        return (proj / eig) @ vt + (diffs - proj @ vt) / residual
+
+    def standardized(self):
+        """
+        Latents as a float32 tensor standardized per dimension, with the (mean, std) used
+        """
+        if "standardized" not in self.cache:
+            x = torch.as_tensor(self.latent_vectors, dtype=torch.float32)
+            mean, std = x.mean(0), x.std(0).clamp_min(1e-6)
+            self.cache["standardized"] = ((x - mean) / std, mean, std)
+        return self.cache["standardized"]
+
+    def sgd_logistic_directions(self, labels: np.ndarray, C: float = 1.0, batch_size: int = 256, lr: float = 0.05,
+                                max_epochs: int = 200, tol: float = 1e-4, patience: int = 4, seed: int = 0) -> np.ndarray:
+        """
+        L2 regularized logistic regression per attribute (one-vs-rest), the objective of sklearn's
+        LogisticRegression(C = C), fit by minibatch Adam in torch on standardized features. All attributes are fit
+        together as the columns of one (D, K) weight matrix, so each minibatch is read once for all of them.
+        Whenever an epoch improves the full objective by less than tol (relative), the learning rate is halved,
+        and fitting stops after `patience` such plateaus. Datasets are read a chunk at a time, shuffled within chunks.
+        :param C: Inverse regularization strength, as in sklearn
+        """
+        # Standardized features are better conditioned. Weights are mapped back (w / std) for the penalty and the result
+        if self.dataset is None:
+            x, _, std = self.standardized()
+        else:
+            mean, std = (torch.as_tensor(s, dtype=torch.float32) for s in self.feature_stats())
+            std = std.clamp_min(1e-6)
+        y = torch.as_tensor(labels, dtype=torch.float32)
+        n, k = y.shape
+        l2 = 1.0 / (C * n) # sklearn's 0.5 ||w||^2 + C * sum(loss), divided by C * n
+
+        def blocks():
+            # (standardized latents, labels) blocks: all of them in memory, or one per dataset chunk
+            if self.dataset is None:
+                yield x, y
+                return
+            for start, chunk in self.chunks():
+                yield (torch.from_numpy(np.array(chunk, dtype=np.float32)) - mean) / std, y[start:start + len(chunk)]
+
+        generator = torch.Generator().manual_seed(seed)
+        w = torch.zeros(self.shape[1], k, requires_grad=True)
+        b = torch.zeros(k, requires_grad=True)
+        optimizer = torch.optim.Adam([w, b], lr=lr)
+
+        def data_loss(xb, yb):
+            # Sum over samples of the per attribute losses, summed over attributes
+            return torch.nn.functional.binary_cross_entropy_with_logits(xb @ w + b, yb, reduction="sum")
+
+        def penalty():
+            return 0.5 * l2 * ((w / std[:, None]) ** 2).sum()
+
+        best, plateaus = float("inf"), 0
+        for _ in range(max_epochs):
+            for xb, yb in blocks():
+                for idx in torch.randperm(len(xb), generator=generator).split(batch_size):
+                    optimizer.zero_grad()
+                    (data_loss(xb[idx], yb[idx]) / len(idx) + penalty()).backward()
+                    optimizer.step()
+            with torch.no_grad():
+                loss = (sum(data_loss(xb, yb) for xb, yb in blocks()) / n + penalty()).item()
+            if loss < best * (1 - tol):
+                best = loss
+            else:
+                plateaus += 1
+                if plateaus >= patience:
+                    break
+                for group in optimizer.param_groups:
+                    group["lr"] /= 2
+        return (w.detach() / std[:, None]).T.double().numpy()
@@ -8,7 +8,8 @@ def attribute_preserving_loss(
     attr_predictor: Callable[[torch.Tensor], torch.Tensor],
     y_target: torch.Tensor,
     lambda_pred: float = 1.0,
-    lambda_recon: float = 1.0
+    lambda_recon: float = 1.0,
+    reduction: str = "mean"
 ) -> torch.Tensor:
     """
     Custom loss enforcing attribute fidelity and identity preservation.
@@ -19,8 +20,16 @@ def attribute_preserving_loss(
     :param y_target: Target attribute value tensor (B, ...)
     :param lambda_pred: Weight for attribute prediction loss
     :param lambda_recon: Weight for reconstruction loss
-    :return: Scalar loss tensor
+    :param reduction: "mean" for the batch mean, "none" for the loss of each sample (B,)
+    :return: Scalar loss tensor, or (B,) with reduction="none"
     """
-    pred_loss = torch.nn.functional.mse_loss(attr_predictor(generated), y_target)
-    recon_loss = torch.nn.functional.mse_loss(generated, original)
-    return lambda_pred * pred_loss + lambda_recon * recon_loss 
\ No newline at end of file
+    if reduction == "mean":
+        pred_loss = torch.nn.functional.mse_loss(attr_predictor(generated), y_target)
+        recon_loss = torch.nn.functional.mse_loss(generated, original)
+    elif reduction == "none":
+        pred = attr_predictor(generated)
+        pred_loss = torch.nn.functional.mse_loss(pred, y_target.expand_as(pred), reduction="none").reshape(len(pred), -1).mean(1)
+        recon_loss = torch.nn.functional.mse_loss(generated, original, reduction="none").flatten(1).mean(1)
+    else:
+        raise ValueError(f"Unknown reduction: {reduction}")
+    return lambda_pred * pred_loss + lambda_recon * recon_loss
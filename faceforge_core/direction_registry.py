@@ -0,0 +1,181 @@
+"""
+Persistent registry of fitted latent directions, so clients refer to directions by id instead of posting them around
+
+Layout of a registry directory (see append_only.py for how readers and writers share it):
+- directions.bin: append-only blob of normalized direction vectors (fp16 or fp32), memory-mapped for lookups
+- index.jsonl: append-only index, one line per registered (or removed) direction with its metadata
+- lock: flock'd by writers
+
+Nothing is read until the first lookup, and directions are views into the mapped file. Metadata of a direction:
+the hash of the data it was fitted on (dataset_hash), the solver, the share of the data's variance along it
+(explained_variance), its dimension and dtype, plus anything else the caller passes.
+"""
+
+import os
+import time
+import hashlib
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .append_only import AppendOnlyIndex, append_aligned
+
+DTYPES = {"float16" : np.float16, "float32" : np.float32}
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "faceforge", "directions")
+
+class UnknownDirection(KeyError):
+    """
+    No direction is registered under the id
+    """
+
+def dataset_hash(*arrays) -> str:
+    """
+    Content hash of the arrays a direction was fitted on (i.e. latents and labels). Shape and dtype count
+    """
+    h = hashlib.sha256()
+    for array in arrays:
+        if array is None:
+            continue
+        array = np.ascontiguousarray(array)
+        h.update(f"{array.dtype.str}{array.shape}".encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+def explained_variance(latents : np.ndarray, direction : np.ndarray) -> float:
+    """
+    Share of the latents' total variance along a unit direction
+    """
+    centered = latents - latents.mean(0)
+    total = (centered ** 2).sum()
+    return float(((centered @ direction) ** 2).sum() / total) if total > 0 else 0.0
+
+class DirectionRegistry:
+    """
+    Memory-mapped, append-only store of unit direction vectors with metadata, keyed by id
+
+    :param path: Directory of the registry, created on the first write
+    :param dtype: "float16" or "float32", precision directions are stored in
+    """
+    def __init__(self, path : str = DEFAULT_PATH, dtype : str = "float32"):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown direction dtype: {dtype}")
+        self.path = path
+        self.dtype = dtype
+        self.index_path = os.path.join(path, "index.jsonl")
+        self.data_path = os.path.join(path, "directions.bin")
+        self.lock_path = os.path.join(path, "lock")
+        self._log = AppendOnlyIndex(self.index_path, self.lock_path)
+        self._thread_lock = self._log.thread_lock
+        self.index : Dict[str, dict] = {} # id -> metadata, with the direction's offset in the data file
+        self._data = None # np.memmap over the data file (uint8)
+
+    # === READING ===
+
+    def _refresh(self):
+        """
+        Pick up directions registered (by any process) since the last refresh
+        """
+        with self._thread_lock:
+            records, _ = self._log.read() # Never replaced, removals are appended
+            for record in records:
+                if record.get("removed"):
+                    self.index.pop(record["id"], None)
+                else:
+                    self.index[record["id"]] = record
+
+    def _load(self, record : dict) -> np.ndarray:
+        np_dtype = DTYPES[record["dtype"]]
+        end = record["offset"] + record["dim"] * np.dtype(np_dtype).itemsize
+        if self._data is None or len(self._data) < end:
+            self._data = np.memmap(self.data_path, dtype = np.uint8, mode = "r")
+        return self._data[record["offset"]:end].view(np_dtype)
+
+    def _record(self, direction_id : str) -> dict:
+        self._refresh()
+        record = self.index.get(direction_id)
+        if record is None:
+            raise UnknownDirection(direction_id)
+        return record
+
+    def get(self, direction_id : str) -> np.ndarray:
+        """
+        Direction (D,) as stored (read-only view into the mapped file). UnknownDirection if there is none
+        """
+        with self._thread_lock:
+            return self._load(self._record(direction_id))
+
+    def metadata(self, direction_id : str) -> dict:
+        with self._thread_lock:
+            record = self._record(direction_id)
+            return {k : v for k, v in record.items() if k != "offset"}
+
+    def list(self) -> List[dict]:
+        with self._thread_lock:
+            self._refresh()
+            return [{k : v for k, v in record.items() if k != "offset"} for record in self.index.values()]
+
+    def __contains__(self, direction_id : str) -> bool:
+        with self._thread_lock:
+            self._refresh()
+            return direction_id in self.index
+
+    def __len__(self) -> int:
+        with self._thread_lock:
+            self._refresh()
+            return len(self.index)
+
+    def combine(self, edits : Sequence[Tuple[str, float]]) -> np.ndarray:
+        """
+        Fused update sum_i alpha_i * direction_i (fp32) for [(id, alpha)], as one (K,) x (K, D) product
+        """
+        with self._thread_lock:
+            directions = [self.get(direction_id) for direction_id, _ in edits]
+        dims = {len(d) for d in directions}
+        if len(dims) != 1:
+            raise ValueError(f"Directions of different dimensions can't be combined: {sorted(dims)}")
+        alphas = np.array([alpha for _, alpha in edits], dtype = np.float32)
+        return alphas @ np.stack(directions).astype(np.float32, copy = False)
+
+    # === WRITING ===
+
+    def register(self, direction : np.ndarray, direction_id : Optional[str] = None, dataset_hash : Optional[str] = None,
+                 solver : Optional[str] = None, explained_variance : Optional[float] = None, **meta) -> str:
+        """
+        Normalize and store a direction. Returns its id, by default a hash of the stored vector (so re-registering
+        the same direction is a no-op). Registering an existing id replaces it.
+        :param meta: Extra JSON serializable metadata, i.e. the attribute name
+        """
+        direction = np.asarray(direction, dtype = np.float64).ravel()
+        norm = np.linalg.norm(direction)
+        if not np.isfinite(norm) or norm == 0:
+            raise ValueError("Can't register a zero or non-finite direction")
+        stored = (direction / norm).astype(DTYPES[self.dtype])
+        data = stored.tobytes()
+        if direction_id is None:
+            direction_id = hashlib.sha256(data).hexdigest()[:16]
+
+        with self._log.locked():
+            self._refresh()
+            if direction_id in self.index and bytes(self._load(self.index[direction_id])) == data:
+                return direction_id
+            with open(self.data_path, "ab") as f:
+                offset = append_aligned(f, data)
+            record = {
+                "id" : direction_id, "offset" : offset, "dim" : len(stored), "dtype" : self.dtype,
+                "dataset_hash" : dataset_hash, "solver" : solver, "explained_variance" : explained_variance,
+                "created" : time.time(), **meta,
+            }
+            # The index line goes in only after its data is in the file
+            self._log.append([record])
+            self._refresh()
+        return direction_id
+
+    def remove(self, direction_id : str):
+        """
+        Drop a direction from the index (its bytes stay in the data file)
+        """
+        with self._log.locked():
+            self._record(direction_id)
+            self._log.append([{"id" : direction_id, "removed" : True}])
+            self._refresh()
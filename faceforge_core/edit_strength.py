@@ -0,0 +1,189 @@
+"""
+Per-sample edit strengths: for latents z and a direction d, the alpha of each sample whose edit G(z + alpha d) best
+trades hitting an attribute target against staying close to G(z), by gradient descent on attribute_preserving_loss
+
+The whole batch is optimized at once, each sample with its own alpha and Adam state (the loss of a sample only
+depends on its own alpha, so one backward pass gives every sample's gradient). Whenever a step doesn't improve a
+sample's loss its learning rate is halved, and it stops after `patience` such steps in a row. Only the samples still
+running are generated in later steps.
+The generator runs under autocast (bf16 on cpu by default) and is checkpointed, so its activations are recomputed in
+the backward pass instead of kept, and micro_batch bounds how many samples go through it at once.
+"""
+
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+from .custom_loss import attribute_preserving_loss
+
+def latent_decoder(pipe) -> Callable[[torch.Tensor], torch.Tensor]:
+    """
+    Differentiable generator from a pipeline's denoised latents to images in [-1, 1] (its vae decoder),
+    i.e. the tiny stand-in pipeline's for quick runs on cpu
+    """
+    if getattr(pipe, "backend", None) is not None:
+        raise ValueError("The decoder runs through a graph backend, which can't be differentiated")
+    return lambda latents: pipe.vae.decode(pipe.unscale_latents(latents), return_dict = False)[0]
+
+@dataclass
+class EditStrengthResult:
+    alphas : torch.Tensor # (B,) Best alpha of each sample
+    losses : torch.Tensor # (B,) Loss at that alpha
+    initial_losses : torch.Tensor # (B,) Loss at the initial alpha
+    steps : torch.Tensor # (B,) Steps each sample ran
+    converged : torch.Tensor # (B,) Stopped early, rather than at max_steps
+    seconds : float
+    sample_steps : int # Forward and backward passes of single samples, summed over steps
+    peak_memory_mb : Optional[float] = None # Peak cuda memory, None on cpu
+
+    def summary(self) -> dict:
+        return {
+            "samples" : len(self.alphas),
+            "seconds" : self.seconds,
+            "samples_per_s" : len(self.alphas) / self.seconds,
+            "sample_steps_per_s" : self.sample_steps / self.seconds,
+            "mean_steps" : float(self.steps.float().mean()),
+            "max_steps" : int(self.steps.max()),
+            "converged" : float(self.converged.float().mean()),
+            "initial_loss" : float(self.initial_losses.mean()),
+            "loss" : float(self.losses.mean()),
+            "peak_memory_mb" : self.peak_memory_mb,
+        }
+
+class EditStrengthOptimizer:
+    """
+    Finds the alpha per sample minimizing attribute_preserving_loss(G(z + alpha d), G(z), attr_predictor, y_target)
+
+    :param generator: Differentiable map from latents (B, ...) to images (B, ...), i.e. latent_decoder(pipe)
+    :param attr_predictor: Differentiable map from images to attribute predictions (B, ...)
+    :param lr: Adam learning rate of the alphas
+    :param max_steps: Steps after which every sample stops
+    :param tol: Relative loss improvement below which a step counts as no improvement
+    :param patience: Steps in a row without improvement after which a sample stops
+    :param lr_decay: Factor of a sample's learning rate after a step without improvement
+    :param amp_dtype: Autocast dtype of the generator and predictor (bf16, or fp16 on cuda), None for full precision
+    :param checkpoint: Recompute the generator's activations in the backward pass instead of keeping them
+    :param micro_batch: Most samples generated at once, all of them if None
+    :param max_alpha: Optional bound on |alpha|
+    :param loss_scale: Loss scaling against fp16 gradient underflow (only used with amp_dtype fp16)
+    """
+    def __init__(self, generator : Callable, attr_predictor : Callable, lambda_pred : float = 1.0, lambda_recon : float = 1.0,
+                 lr : float = 0.05, max_steps : int = 200, tol : float = 1e-4, patience : int = 10, lr_decay : float = 0.5,
+                 amp_dtype : Optional[torch.dtype] = torch.bfloat16, checkpoint : bool = True, micro_batch : Optional[int] = None,
+                 max_alpha : Optional[float] = None, loss_scale : float = 1024.0, betas = (0.9, 0.999), eps : float = 1e-8):
+        self.generator = generator
+        self.attr_predictor = attr_predictor
+        self.lambda_pred = lambda_pred
+        self.lambda_recon = lambda_recon
+        self.lr = lr
+        self.max_steps = max_steps
+        self.tol = tol
+        self.patience = patience
+        self.lr_decay = lr_decay
+        self.amp_dtype = amp_dtype
+        self.checkpoint = checkpoint
+        self.micro_batch = micro_batch
+        self.max_alpha = max_alpha
+        self.loss_scale = loss_scale if amp_dtype == torch.float16 else 1.0
+        self.betas = betas
+        self.eps = eps
+
+    def autocast(self, device):
+        return torch.autocast(torch.device(device).type, dtype = self.amp_dtype, enabled = self.amp_dtype is not None)
+
+    def generate(self, latents):
+        if self.checkpoint and torch.is_grad_enabled():
+            return checkpoint(self.generator, latents, use_reentrant = False)
+        return self.generator(latents)
+
+    def losses_and_grads(self, alphas, latents, direction, original, y_target):
+        """
+        Loss (B,) of each sample at its alpha and its derivative by the alpha, in micro batches
+        """
+        losses, grads = [], []
+        size = self.micro_batch or len(alphas)
+        for start in range(0, len(alphas), size):
+            chunk = slice(start, start + size)
+            alpha = alphas[chunk].clone().requires_grad_()
+            with self.autocast(latents.device):
+                shift = alpha.view(-1, *[1] * (latents.dim() - 1)) * direction[chunk]
+                generated = self.generate(latents[chunk] + shift.to(latents.dtype))
+                loss = attribute_preserving_loss(
+                    generated.float(), original[chunk].float(), lambda x: self.attr_predictor(x).float(), y_target[chunk],
+                    lambda_pred = self.lambda_pred, lambda_recon = self.lambda_recon, reduction = "none"
+                )
+            grad, = torch.autograd.grad(loss.sum() * self.loss_scale, alpha)
+            losses.append(loss.detach())
+            grads.append(grad / self.loss_scale)
+        return torch.cat(losses), torch.cat(grads)
+
+    def optimize(self, latents : torch.Tensor, direction : torch.Tensor, y_target : torch.Tensor, alpha_init = 0.0) -> EditStrengthResult:
+        """
+        :param latents: (B, ...) latents to edit
+        :param direction: Direction, shaped like one latent or like the batch (a direction per sample)
+        :param y_target: (B, ...) attribute targets
+        :param alpha_init: Initial alpha, a float or (B,)
+        """
+        n = len(latents)
+        device = latents.device
+        direction = torch.as_tensor(direction, dtype = latents.dtype, device = device)
+        if direction.shape == latents.shape[1:]:
+            direction = direction.expand_as(latents)
+        elif direction.shape != latents.shape:
+            raise ValueError(f"Direction of shape {tuple(direction.shape)} doesn't fit latents of shape {tuple(latents.shape)}")
+        y_target = torch.as_tensor(y_target, dtype = torch.float32, device = device)
+        if torch.cuda.is_available() and device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+
+        start = time.perf_counter()
+        with torch.no_grad(), self.autocast(device):
+            original = torch.cat([self.generator(latents[i:i + (self.micro_batch or n)]) for i in range(0, n, self.micro_batch or n)])
+
+        alphas = torch.zeros(n, device = device) + torch.as_tensor(alpha_init, dtype = torch.float32, device = device)
+        best_alphas, best_losses = alphas.clone(), torch.full((n,), float("inf"), device = device)
+        m, v = torch.zeros(n, device = device), torch.zeros(n, device = device) # Adam moments
+        lrs = torch.full((n,), self.lr, device = device)
+        steps = torch.zeros(n, dtype = torch.long, device = device)
+        stalled = torch.zeros(n, dtype = torch.long, device = device)
+        active = torch.ones(n, dtype = torch.bool, device = device)
+        initial_losses, sample_steps = None, 0
+        beta1, beta2 = self.betas
+
+        for _ in range(self.max_steps):
+            idx = active.nonzero().squeeze(1)
+            if len(idx) == 0:
+                break
+            loss, grad = self.losses_and_grads(alphas[idx], latents[idx], direction[idx], original[idx], y_target[idx])
+            if initial_losses is None:
+                initial_losses = loss.clone()
+            sample_steps += len(idx)
+
+            # Keep the best alpha seen, count steps without improvement
+            finite = torch.isfinite(loss) & torch.isfinite(grad)
+            improved = finite & ~(loss >= best_losses[idx] - self.tol * best_losses[idx].abs())
+            best_alphas[idx[improved]] = alphas[idx[improved]]
+            best_losses[idx[improved]] = loss[improved]
+            stalled[idx] = torch.where(improved, 0, stalled[idx] + 1)
+            lrs[idx] = torch.where(improved, lrs[idx], lrs[idx] * self.lr_decay)
+            steps[idx] += 1
+
+            # Adam step of each sample's alpha, skipped where the loss or gradient overflowed
+            grad = torch.where(finite, grad, 0)
+            m[idx] = beta1 * m[idx] + (1 - beta1) * grad
+            v[idx] = beta2 * v[idx] + (1 - beta2) * grad ** 2
+            t = steps[idx].float()
+            update = lrs[idx] * (m[idx] / (1 - beta1 ** t)) / ((v[idx] / (1 - beta2 ** t)).sqrt() + self.eps)
+            alphas[idx] -= torch.where(finite, update, 0)
+            if self.max_alpha is not None:
+                alphas.clamp_(-self.max_alpha, self.max_alpha)
+
+            active[idx[stalled[idx] >= self.patience]] = False
+
+        peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == "cuda" else None
+        return EditStrengthResult(
+            alphas = best_alphas, losses = best_losses, initial_losses = initial_losses, steps = steps, converged = ~active,
+            seconds = time.perf_counter() - start, sample_steps = sample_steps, peak_memory_mb = peak,
+        )
@@ -0,0 +1,273 @@
+"""
+Persistent on-disk store for prompt embeddings, so restarts don't have to re-run the text encoders
+
+Layout of a store directory (see append_only.py for how readers and writers share it):
+- data-<generation>.bin: append-only blob of raw tensor bytes, memory-mapped for lookups
+- index.jsonl: append-only index. First line names the data file, every other line is one entry
+- lock: flock'd by writers (appends and compaction)
+
+Compaction writes a new generation and swaps the index in, readers notice and reload.
+"""
+
+import os
+import hashlib
+import argparse
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from .append_only import ALIGNMENT, AppendOnlyIndex, append_aligned
+
+READ_ATTEMPTS = 3 # Reads retried after the data file was compacted away under them
+
+# torch dtype -> (name in index, numpy dtype used for storage)
+# numpy has no bfloat16, so it is stored as raw int16 and viewed back on load
+_DTYPES = {
+    torch.float32 : ("float32", np.float32),
+    torch.float16 : ("float16", np.float16),
+    torch.bfloat16 : ("bfloat16", np.int16),
+}
+_DTYPES_BY_NAME = {name : (dtype, np_dtype) for dtype, (name, np_dtype) in _DTYPES.items()}
+
+def prompt_key(model_id : str, prompt : str) -> str:
+    """
+    Key for a prompt's embeddings. Embeddings depend on the text encoders, so the model id is part of the key.
+    """
+    digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    return f"{model_id}:{digest}"
+
+class EmbeddingStore:
+    """
+    Memory-mapped, append-only store of encoding tuples (i.e. prompt_embeds, negative_prompt_embeds, pooled, negative_pooled).
+    Entries of a tuple may be None. Lookups return CPU tensors that are views into the mapped file.
+
+    :param path: Directory of the store, created if needed
+    :param max_bytes: Size cap for the data file. Oldest entries are compacted away once a write would exceed it
+    """
+    def __init__(self, path : str, max_bytes : int = 4 * 1024 ** 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(path, "index.jsonl")
+        self.lock_path = os.path.join(path, "lock")
+        self._log = AppendOnlyIndex(self.index_path, self.lock_path)
+        self._thread_lock = self._log.thread_lock
+
+        with self._log.locked():
+            if not os.path.exists(self.index_path):
+                self._write_generation(0, [])
+        self._reset()
+
+    # === READING ===
+
+    def _reset(self):
+        self.index : Dict[str, list] = {} # key -> list of array specs (or None)
+        self.order : List[str] = [] # keys, oldest first
+        self.data_file = None
+        self._data = None # np.memmap over data file (uint8)
+
+    def _refresh(self):
+        """
+        Pick up entries appended by other processes since the last refresh. Reloads everything after a compaction.
+        """
+        with self._thread_lock:
+            records, replaced = self._log.read()
+            if replaced:
+                self._reset()
+            for record in records:
+                if "data_file" in record:
+                    self.data_file = os.path.join(self.path, record["data_file"])
+                    continue
+                key = record["key"]
+                if key in self.index:
+                    self.order.remove(key)
+                self.index[key] = record["arrays"]
+                self.order.append(key)
+
+    def _mapped(self, end : int) -> np.memmap:
+        """
+        Memory map of the data file covering at least `end` bytes
+        """
+        if self._data is None or len(self._data) < end:
+            # copy-on-write mapping: tensors can be handed out as writable without ever touching the file
+            self._data = np.memmap(self.data_file, dtype = np.uint8, mode = "c")
+        return self._data
+
+    def _load(self, arrays : list) -> Tuple[Optional[torch.Tensor], ...]:
+        res = []
+        for spec in arrays:
+            if spec is None:
+                res.append(None)
+                continue
+            dtype, np_dtype = _DTYPES_BY_NAME[spec["dtype"]]
+            nbytes = int(np.prod(spec["shape"])) * np.dtype(np_dtype).itemsize
+            data = self._mapped(spec["offset"] + nbytes)
+            array = data[spec["offset"]:spec["offset"] + nbytes].view(np_dtype).reshape(spec["shape"])
+            res.append(torch.from_numpy(array).view(dtype))
+        return tuple(res)
+
+    def get(self, model_id : str, prompt : str) -> Optional[Tuple[Optional[torch.Tensor], ...]]:
+        """
+        Stored encodings for a prompt, or None if the prompt hasn't been stored for this model
+        """
+        return self.get_many(model_id, [prompt])[0]
+
+    def get_many(self, model_id : str, prompts : Sequence[str]) -> List[Optional[Tuple[Optional[torch.Tensor], ...]]]:
+        with self._thread_lock:
+            for attempt in range(READ_ATTEMPTS):
+                self._refresh()
+                try:
+                    res = []
+                    for prompt in prompts:
+                        arrays = self.index.get(prompt_key(model_id, prompt))
+                        res.append(self._load(arrays) if arrays is not None else None)
+                    return res
+                except FileNotFoundError:
+                    # Another process compacted the store and removed the data file between the refresh and mapping it.
+                    # The index was swapped before the removal, so reading it again finds the new generation
+                    if attempt == READ_ATTEMPTS - 1:
+                        raise
+                    self._reset()
+                    self._log.reset()
+
+    def __contains__(self, key : str) -> bool:
+        self._refresh()
+        return key in self.index
+
+    def __len__(self) -> int:
+        self._refresh()
+        return len(self.index)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Current size of the data file in bytes (including superseded entries not yet compacted)
+        """
+        self._refresh()
+        return os.path.getsize(self.data_file)
+
+    # === WRITING ===
+
+    @staticmethod
+    def _nbytes(encodes) -> int:
+        return sum(ALIGNMENT + e.numel() * e.element_size() for e in encodes if e is not None)
+
+    @staticmethod
+    def _append(f, encodes) -> list:
+        """
+        Append tensors to an open data file, return their specs for the index
+        """
+        arrays = []
+        for e in encodes:
+            if e is None:
+                arrays.append(None)
+                continue
+            if e.dtype not in _DTYPES:
+                raise ValueError(f"Embedding store can't hold tensors of dtype {e.dtype}")
+            name, np_dtype = _DTYPES[e.dtype]
+            array = e.detach().to("cpu").contiguous().view(torch.int16 if e.dtype == torch.bfloat16 else e.dtype).numpy()
+            offset = append_aligned(f, array.astype(np_dtype, copy = False).tobytes())
+            arrays.append({"offset" : offset, "shape" : list(e.shape), "dtype" : name})
+        return arrays
+
+    def put(self, model_id : str, prompt : str, encodes : Sequence[Optional[torch.Tensor]]):
+        self.put_many(model_id, [prompt], [encodes])
+
+    def put_many(self, model_id : str, prompts : Sequence[str], encodes : Sequence[Sequence[Optional[torch.Tensor]]]):
+        """
+        Append encodings for prompts. Re-putting a prompt supersedes the old entry.
+        A batch larger than max_bytes on its own is not stored, as it would evict everything and still not fit.
+        """
+        incoming = sum(self._nbytes(e) for e in encodes)
+        if incoming > self.max_bytes:
+            return
+        with self._log.locked():
+            self._refresh()
+            if os.path.getsize(self.data_file) + incoming > self.max_bytes:
+                self._compact(self.max_bytes - incoming)
+
+            records = []
+            with open(self.data_file, "ab") as f:
+                for prompt, encodes_i in zip(prompts, encodes):
+                    records.append({"key" : prompt_key(model_id, prompt), "arrays" : self._append(f, encodes_i)})
+            # Index lines go in only after their data is in the file
+            self._log.append(records)
+            self._refresh()
+
+    def cached_encodes(self, model_id : str, prompts : Sequence[str], encode_fn : Callable[[List[str]], list], device = None) -> list:
+        """
+        Encodings for each prompt, running encode_fn once (batched) over prompts that aren't stored yet.
+        :param encode_fn: Maps a list of prompts to a list of per-prompt encoding tuples
+        :param device: Device to move stored encodings to
+        """
+        res = self.get_many(model_id, prompts)
+        missing = list(dict.fromkeys(p for p, r in zip(prompts, res) if r is None))
+        if missing:
+            encoded = dict(zip(missing, encode_fn(missing)))
+            self.put_many(model_id, missing, [encoded[p] for p in missing])
+            res = [r if r is not None else encoded[p] for p, r in zip(prompts, res)]
+
+        if device is not None:
+            res = [tuple(e.to(device) if e is not None else None for e in r) for r in res]
+        return res
+
+    # === COMPACTION ===
+
+    def _write_generation(self, generation : int, entries : List[Tuple[str, list]]):
+        """
+        Write a fresh data file + index holding `entries` ([(key, tensors)]) and swap it in
+        """
+        data_name = f"data-{generation}.bin"
+        records = [{"data_file" : data_name}]
+        with open(os.path.join(self.path, data_name), "wb") as f:
+            for key, encodes in entries:
+                records.append({"key" : key, "arrays" : self._append(f, encodes)})
+        self._log.replace(records)
+
+    def _compact(self, max_bytes : int):
+        """
+        Rewrite the store without superseded entries, dropping the oldest entries until it fits in max_bytes.
+        Caller must hold the lock.
+        """
+        self._refresh()
+        old_data_file = self.data_file
+        generation = int(os.path.basename(old_data_file)[len("data-"):-len(".bin")]) + 1
+
+        kept, total = [], 0
+        for key in reversed(self.order):
+            encodes = self._load(self.index[key])
+            size = self._nbytes(encodes)
+            if total + size > max_bytes:
+                break
+            kept.append((key, encodes))
+            total += size
+
+        self._write_generation(generation, kept[::-1])
+        self._reset()
+        self._refresh()
+        # Readers that still have the old generation mapped keep their (unlinked) mapping alive
+        os.remove(old_data_file)
+
+    def compact(self, max_bytes : Optional[int] = None):
+        """
+        Drop superseded entries, and the oldest entries beyond max_bytes (defaults to the store's cap)
+        """
+        with self._log.locked():
+            self._compact(self.max_bytes if max_bytes is None else max_bytes)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Maintenance for prompt embedding stores")
+    parser.add_argument("command", choices = ["stats", "compact"])
+    parser.add_argument("path", help = "Store directory")
+    parser.add_argument("--max-bytes", type = int, default = None, help = "Size cap to compact down to")
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.path)
+    if args.command == "compact":
+        before = store.nbytes
+        store.compact(args.max_bytes)
+        print(f"Compacted {before} -> {store.nbytes} bytes")
+    print(f"{len(store)} entries, {store.nbytes} bytes in {store.data_file}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Compressed in-memory encodings: fp16, or int8 with per-channel scales, for the anchors explorers hold
+
+An SDXL anchor is a (1, 77, 2048) prompt embedding and a (1, 1280) pooled embedding, ~640 KB in fp32. fp16 halves that,
+int8 quarters it (plus the scales: one fp32 per channel, 8 KB for SDXL's prompt embeddings and 5 KB for its pooled one).
+
+int8 scales are the absmax of each anchor's channels (last dimension) over its tokens, so a few outlier channels get a
+scale of their own instead of costing every other channel its precision. An outlier token (i.e. a high norm BOS token)
+sets the scale of every channel though, and the other tokens lose precision. Check the error on a real checkpoint with
+benchmarks/encoding_compression.py --model-id. Vectors, i.e. pooled embeddings (N, C), have per-channel scales too,
+over the batch. An anchor compressed alone gets a scale per value, which is exact and small next to the prompt embedding.
+
+Blends don't decompress the batch: anchors are weighted a block at a time (int8 scales folded into the weights) and
+accumulated in fp32, so the only fp32 copies besides the result are of one block of anchors.
+"""
+
+from typing import Any, Optional, Sequence
+
+import numpy as np
+import torch
+
+MODES = ("fp16", "int8")
+
+class CompressedTensor:
+    """
+    Tensor (or numpy array) of shape (N, ..., C) held in fp16 or int8. Decompresses to what was compressed
+
+    :param data: fp16 or int8 values
+    :param scale: fp32 scales data is multiplied by, None for fp16. Broadcasts against data, with N or 1 (shared by the
+        batch) in the first dimension
+    :param dtype: dtype of the original
+    :param numpy: Whether the original was a numpy array
+    """
+    def __init__(self, data : torch.Tensor, scale : Optional[torch.Tensor], dtype, numpy : bool = False):
+        self.data = data
+        self.scale = scale
+        self.original_dtype = dtype
+        self.numpy = numpy
+
+    @classmethod
+    def compress(cls, x, mode : str) -> "CompressedTensor":
+        """
+        :param x: Tensor or numpy array. Batched (N, ...) to be concatenated or blended with others
+        :param mode: "fp16" or "int8"
+        """
+        numpy = isinstance(x, np.ndarray)
+        tensor = torch.from_numpy(np.ascontiguousarray(x)) if numpy else x
+        if mode == "fp16":
+            return cls(tensor.to(torch.float16), None, x.dtype, numpy)
+        if mode != "int8":
+            raise ValueError(f"Unknown compression: {mode}. Choose one of {MODES}")
+
+        tensor = tensor.float()
+        if tensor.dim() <= 2: # One scale per channel, over the batch of vectors. A single vector gets one scale
+            dims = (0,)
+        else: # One scale per anchor and channel, over the tokens
+            dims = tuple(range(1, tensor.dim() - 1))
+        scale = tensor.abs().amax(dim = dims, keepdim = True) / 127
+        scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+        data = (tensor / scale).round_().clamp_(-127, 127).to(torch.int8)
+        return cls(data, scale, x.dtype, numpy)
+
+    @property
+    def mode(self) -> str:
+        return "fp16" if self.scale is None else "int8"
+
+    @property
+    def shape(self):
+        return tuple(self.data.shape)
+
+    @property
+    def dtype(self):
+        return self.original_dtype
+
+    @property
+    def device(self):
+        return self.data.device
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Bytes held, scales included
+        """
+        scale = self.scale.numel() * self.scale.element_size() if self.scale is not None else 0
+        return self.data.numel() * self.data.element_size() + scale
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def _output(self, tensor : torch.Tensor):
+        if self.numpy:
+            return tensor.numpy().astype(self.original_dtype, copy = False)
+        return tensor.to(self.original_dtype)
+
+    def _float(self) -> torch.Tensor:
+        tensor = self.data.float()
+        if self.scale is not None:
+            tensor *= self.scale
+        return tensor
+
+    def float(self):
+        """
+        Decompressed to fp32, a tensor or a numpy array like the original
+        """
+        return self._float().numpy() if self.numpy else self._float()
+
+    def decompress(self):
+        """
+        The tensor (or numpy array) in its original dtype
+        """
+        return self._output(self._float())
+
+    def blend(self, coefs, block : int = 8):
+        """
+        Linear combination of the N entries (sum_i coefs[i] * x[i]) with fp32 accumulation, in the original dtype
+
+        :param coefs: (N,) coefficients, numpy or torch
+        :param block: Entries converted to fp32 at once
+        """
+        coefs = torch.as_tensor(coefs).float().to(self.device) # float64 -> float32 before moving, for devices without f64
+        if len(coefs) != len(self.data):
+            raise ValueError(f"Got {len(coefs)} coefs for {len(self.data)} encodings")
+        weights = coefs.view(-1, *[1] * (self.data.dim() - 1))
+        if self.scale is not None:
+            weights = weights * self.scale
+
+        out = torch.zeros(self.data.shape[1:], dtype = torch.float32, device = self.device)
+        for start in range(0, len(self.data), block):
+            chunk = slice(start, start + block)
+            out += (weights[chunk] * self.data[chunk].float()).sum(0)
+        return self._output(out)
+
+    @classmethod
+    def cat(cls, items : Sequence["CompressedTensor"]) -> "CompressedTensor":
+        """
+        Concatenate along the first dimension, i.e. per anchor encodings into a batch
+        """
+        if len({item.mode for item in items}) != 1:
+            raise ValueError("Can't concatenate fp16 and int8 encodings")
+        scale = None
+        if items[0].scale is not None: # Scales shared by a batch are repeated for each of its entries
+            scale = torch.cat([item.scale.expand(len(item), *item.scale.shape[1:]) for item in items], dim = 0)
+        return cls(torch.cat([item.data for item in items], dim = 0), scale, items[0].original_dtype, items[0].numpy)
+
+    def __repr__(self):
+        return f"CompressedTensor(shape={self.shape}, mode={self.mode}, dtype={self.original_dtype}, nbytes={self.nbytes})"
+
+def compress_encoding(encoding : Any, mode : Optional[str]):
+    """
+    Compress an encoding: a tensor, an array, or a tuple / list of them (and Nones), as the explorers store them.
+    Returns it as is if mode is None or it's compressed already
+    """
+    if mode is None or encoding is None or isinstance(encoding, CompressedTensor):
+        return encoding
+    if isinstance(encoding, (tuple, list)):
+        return type(encoding)(compress_encoding(e, mode) for e in encoding)
+    return CompressedTensor.compress(encoding, mode)
+
+def decompress_encoding(encoding : Any):
+    """
+    Inverse of compress_encoding. Uncompressed encodings are returned as is
+    """
+    if isinstance(encoding, (tuple, list)):
+        return type(encoding)(decompress_encoding(e) for e in encoding)
+    return encoding.decompress() if isinstance(encoding, CompressedTensor) else encoding
+
+def encoding_nbytes(encoding : Any) -> int:
+    """
+    Bytes held by an encoding (compressed or not)
+    """
+    if encoding is None:
+        return 0
+    if isinstance(encoding, (tuple, list)):
+        return sum(encoding_nbytes(e) for e in encoding)
+    if isinstance(encoding, torch.Tensor):
+        return encoding.numel() * encoding.element_size()
+    return int(encoding.nbytes)
+
+def batch(items : Sequence[Any]):
+    """
+    Concatenate per anchor tensors or CompressedTensors along the first dimension. None if the entries are None
+    """
+    if items[0] is None:
+        return None
+    if isinstance(items[0], CompressedTensor):
+        return CompressedTensor.cat(items)
+    return torch.cat(items, dim = 0)
+
+def anchor_memory(encodings : Sequence[Any], mode : Optional[str] = None) -> dict:
+    """
+    Memory report of a list of per anchor encodings
+    """
+    total = sum(encoding_nbytes(e) for e in encodings)
+    return {
+        "compression" : mode, "anchors" : len(encodings), "bytes" : total,
+        "bytes_per_anchor" : total / len(encodings) if encodings else 0.0,
+    }
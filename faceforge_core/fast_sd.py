@@ -1,19 +1,191 @@
-from diffusers import AutoencoderTiny, StableDiffusionXLPipeline
+from diffusers import AutoencoderTiny, StableDiffusionXLPipeline, UNet2DConditionModel, EulerAncestralDiscreteScheduler
+from diffusers.models.attention_processor import AttnProcessor2_0
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
 from .hacked_sdxl_pipeline import HackedSDXLPipeline
+from .onnx_backend import GraphBackend
+from .quantization import DEFAULT_CACHE_DIR, quantize_pipeline, load_quantized_components, save_quantized_components
+import os
+import json
+import logging
+import tempfile
 import torch
 
-def fast_diffusion_pipeline(model_id = "stabilityai/sdxl-turbo", vae_id = "madebyollin/taesdxl", compile = False):
+logger = logging.getLogger("faceforge_core")
+
+DTYPES = {
+    "float32" : torch.float32,
+    "fp32" : torch.float32,
+    "float16" : torch.float16,
+    "fp16" : torch.float16,
+    "bfloat16" : torch.bfloat16,
+    "bf16" : torch.bfloat16,
+}
+
+def default_device():
+    """
+    Best available device: cuda > mps > cpu
+    """
+    if torch.cuda.is_available():
+        return "cuda"
+    if hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+def resolve_dtype(dtype, device):
+    """
+    :param dtype: torch dtype, name of one (i.e. "bf16"), or None for the device's default (fp16 on accelerators, fp32 on cpu)
+    """
+    if dtype is None:
+        return torch.float32 if torch.device(device).type == "cpu" else torch.float16
+    if isinstance(dtype, str):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown dtype: {dtype}")
+        return DTYPES[dtype]
+    return dtype
+
+def set_cpu_threads(num_threads = None, num_interop_threads = None):
+    """
+    Tune torch's intra-op (within an op) and inter-op (between ops) thread pools. None leaves the default.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            # Can only be set once, before any inter-op parallel work has started
+            logger.warning(f"Couldn't set inter-op threads: {e}")
+
+# model_id of the stand-in pipeline built by tiny_diffusion_pipeline
+TINY_MODEL_ID = "tiny"
+
+def byte_level_tokenizer(max_length = 77):
+    """
+    CLIP tokenizer over single bytes (no merges), so the stand-in pipeline tokenizes real prompts without downloading a vocabulary
+    """
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    chars = list(bytes_to_unicode().values())
+    vocab = {token : i for i, token in enumerate(chars + [c + "</w>" for c in chars] + ["<|startoftext|>", "<|endoftext|>"])}
+    with tempfile.TemporaryDirectory() as tmp:
+        vocab_file, merges_file = os.path.join(tmp, "vocab.json"), os.path.join(tmp, "merges.txt")
+        with open(vocab_file, "w") as f:
+            json.dump(vocab, f)
+        with open(merges_file, "w") as f:
+            f.write("#version: 0.2\n")
+        return CLIPTokenizer(vocab_file, merges_file, model_max_length = max_length, clean_up_tokenization_spaces = False)
+
+def tiny_diffusion_pipeline(seed = 0, resolution = 64, hidden_size = 8, dtype = torch.float32):
+    """
+    Stand-in for fast_diffusion_pipeline with tiny randomly initialized components, for profiling on any machine without weights.
+    Keeps SDXL's interfaces and layouts: two CLIP text encoders (per-token embeddings concatenated, pooled embedding from the second),
+    77 token prompts, a text_time conditioned unet, TAESD decoder with 8x downsampling and the sdxl-turbo scheduler.
+    Images are noise, but every stage of a render runs. Deterministic for a seed.
+
+    :param seed: Seed of the random weights
+    :param resolution: Default image resolution (renders can still ask for any multiple of 8)
+    :param hidden_size: Width of each text encoder, the unet's cross attention dim is twice this
+    """
+    def text_encoder(cls):
+        config = CLIPTextConfig(
+            vocab_size = len(tokenizer), hidden_size = hidden_size, intermediate_size = 2 * hidden_size, projection_dim = hidden_size,
+            num_hidden_layers = 2, num_attention_heads = 2, max_position_embeddings = tokenizer.model_max_length,
+            bos_token_id = tokenizer.bos_token_id, eos_token_id = tokenizer.eos_token_id, pad_token_id = tokenizer.pad_token_id,
+        )
+        return cls(config).eval()
+
+    tokenizer = byte_level_tokenizer()
+    with torch.random.fork_rng(devices = []):
+        torch.manual_seed(seed)
+        unet = UNet2DConditionModel(
+            sample_size = resolution // 8, in_channels = 4, out_channels = 4, layers_per_block = 1,
+            block_out_channels = (8, 16), down_block_types = ("DownBlock2D", "CrossAttnDownBlock2D"),
+            up_block_types = ("CrossAttnUpBlock2D", "UpBlock2D"), cross_attention_dim = 2 * hidden_size, attention_head_dim = 2,
+            norm_num_groups = 4, addition_embed_type = "text_time", addition_time_embed_dim = 4,
+            projection_class_embeddings_input_dim = 4 * 6 + hidden_size,
+        )
+        vae = AutoencoderTiny(
+            encoder_block_out_channels = (4, 4, 4, 4), decoder_block_out_channels = (4, 4, 4, 4),
+            num_encoder_blocks = (1, 1, 1, 1), num_decoder_blocks = (1, 1, 1, 1),
+        )
+        # With the default init the decoder's output barely depends on the latents (and is mostly clipped). Scaled He init
+        # and a centered output keep images in range and sensitive to their latents, i.e. to optimize through the decoder
+        decoder_convs = [m for m in vae.decoder.modules() if isinstance(m, torch.nn.Conv2d)]
+        for conv in decoder_convs:
+            torch.nn.init.kaiming_normal_(conv.weight, nonlinearity = "relu")
+            conv.weight.data.mul_(0.7)
+            if conv.bias is not None:
+                torch.nn.init.zeros_(conv.bias)
+        decoder_convs[-1].bias.data.fill_(0.5)
+        pipe = HackedSDXLPipeline(
+            vae = vae, text_encoder = text_encoder(CLIPTextModel), text_encoder_2 = text_encoder(CLIPTextModelWithProjection),
+            tokenizer = tokenizer, tokenizer_2 = tokenizer, unet = unet,
+            scheduler = EulerAncestralDiscreteScheduler(timestep_spacing = "trailing"), add_watermarker = False,
+        )
+    pipe.set_progress_bar_config(disable = True)
+    return pipe.to(dtype = dtype)
+
+def fast_diffusion_pipeline(
+        model_id = "stabilityai/sdxl-turbo", vae_id = "madebyollin/taesdxl", compile = False,
+        device = None, dtype = None, num_threads = None, num_interop_threads = None, channels_last = None,
+        quantize = None, quantize_cache_dir = DEFAULT_CACHE_DIR, backend = None, onnx_dir = None
+    ):
     """
     :param compile: If true, does a bunch of stuff to make calls fast, but the first call will be very slow as a consequence
         - If you use this, don't vary the batch size (probably)
+    :param device: Device to run on. Defaults to the best one available (see default_device)
+    :param dtype: Precision of the models. Defaults to fp16 on accelerators and fp32 on cpu. bf16 is a good choice for recent cpus
+    :param num_threads: Intra-op threads for cpu inference. Defaults to torch's choice (number of physical cores)
+    :param num_interop_threads: Inter-op threads for cpu inference
+    :param channels_last: Use channels_last memory format for the convolutional models. Defaults to True on cpu
+    :param quantize: None, "dynamic" or "weight_only". Int8 quantizes the linear layers of the unet and text encoders (see quantization.py)
+    :param quantize_cache_dir: Where quantized components are cached between startups. None disables the cache
+    :param backend: None (torch), "onnxruntime" or "openvino". Graph runtimes run the unet and decoder exported to onnx_dir on cpu.
+        The torch unet and decoder they replace keep their configs but not their weights, so the pipeline can't go back to torch
+    :param onnx_dir: Directory written by `python -m faceforge_core.onnx_backend export`
+
+    model_id = "tiny" (TINY_MODEL_ID) builds the stand-in from tiny_diffusion_pipeline instead of loading weights, with all the other options applied
     """
+    device = device or default_device()
+    dtype = resolve_dtype(dtype, device)
+    on_cpu = torch.device(device).type == "cpu"
+    if channels_last is None:
+        channels_last = on_cpu
+    if on_cpu:
+        set_cpu_threads(num_threads, num_interop_threads)
+    if quantize == "dynamic" and not on_cpu:
+        raise ValueError("Dynamic quantization only runs on cpu, use quantize = \"weight_only\" on accelerators")
+
+    if model_id == TINY_MODEL_ID:
+        pipe = tiny_diffusion_pipeline(dtype = dtype)
+        if quantize:
+            quantize_pipeline(pipe, quantize)
+    else:
+        # Cached quantized components are passed in so their full precision weights are never loaded
+        quantized = load_quantized_components(quantize_cache_dir, model_id, quantize, dtype) if quantize and quantize_cache_dir else {}
+        pipe = HackedSDXLPipeline.from_pretrained(model_id, torch_dtype = dtype, **quantized)
+        if quantize and not quantized:
+            quantize_pipeline(pipe, quantize)
+            if quantize_cache_dir:
+                save_quantized_components(pipe, quantize_cache_dir, model_id, quantize, dtype)
+        pipe.set_progress_bar_config(disable=True)
+        pipe.vae = AutoencoderTiny.from_pretrained(vae_id, torch_dtype = dtype)
+
+    pipe.to(device)
 
-    pipe = HackedSDXLPipeline.from_pretrained(model_id, torch_dtype = torch.float16)
-    pipe.set_progress_bar_config(disable=True)
-    pipe.cached_encode = None
-    pipe.vae = AutoencoderTiny.from_pretrained(vae_id, torch_dtype=torch.float16)
+    # Fused scaled dot product attention kernels (flash/memory efficient on gpu, fused on cpu)
+    pipe.unet.set_attn_processor(AttnProcessor2_0())
+    if channels_last:
+        pipe.unet.to(memory_format = torch.channels_last)
+        pipe.vae.to(memory_format = torch.channels_last)
 
-    pipe.to('cuda')
+    if backend is not None:
+        if onnx_dir is None:
+            raise ValueError("Graph backends need onnx_dir, export one with `python -m faceforge_core.onnx_backend export`")
+        pipe.set_backend(GraphBackend(onnx_dir, backend, num_threads = num_threads))
+        # Free the weights the graphs replace. The modules stay (on the meta device) for their configs and dtypes
+        pipe.unet.to("meta")
+        pipe.vae.decoder.to("meta")
 
     if compile:
         pipe.unet = torch.compile(pipe.unet)
@@ -3,39 +3,176 @@ SDXL pipeline hacked to cache embeddings for later use
 
 Summary of changes:
 - __call__ takes "mode" that can be "cache" or "call"
-    - If "cache", just computes embeddings and returns nothing
-    - If "call", uses pre-computed embeddings ()
+    - If "cache", just computes embeddings and returns them
+    - If "call", uses pre-computed embeddings (prompt_embeds, pooled_prompt_embeds, ...) without re-encoding
     - Otherwise just has normal behaviour
+- If `backend` is set, the unet and vae decoder run through it (i.e. ONNX Runtime/OpenVINO, see onnx_backend.py)
+- output_type = "uint8" gives a [N, H, W, 3] uint8 ndarray, converted on the device and copied to the host once
+  (no float ndarray or PIL images in between). Wrap it directly, i.e. with pygame.image.frombuffer
+- Stages (prompt encoding, unet, scheduler step, decode, postprocessing) are labelled for torch.profiler traces
+  (see profiling.py)
+- Calls are reentrant: guidance settings are locals of each call (not attributes of the pipeline, as in diffusers),
+  each call steps its own copy of the scheduler and decode never changes the vae (fp16 vaes that need upcasting
+  decode through an fp32 copy made once), so threads can share one loaded model
+- Classifier-free guidance (guidance_scale > 1) uses the negative embeddings, zeros if none were given
 
 - There's a few custom methods after the init that you should look at if using
 """
 
+import copy
+import threading
+
+import numpy as np
+
 from diffusers.pipelines.stable_diffusion_xl.pipeline_stable_diffusion_xl import *
 
+from .profiling import profile_stage
+
+def to_uint8(image : torch.Tensor) -> np.ndarray:
+    """
+    Decoder output ([N, 3, H, W] in [-1, 1]) to a contiguous [N, H, W, 3] uint8 ndarray.
+    Everything before the final host copy runs on the image's device.
+    """
+    image = (image / 2 + 0.5).clamp(0, 1).mul(255).round().to(torch.uint8)
+    return image.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+
 class HackedSDXLPipeline(StableDiffusionXLPipeline):
+    backend = None # Optional graph runtime that runs the unet and decoder instead of torch (see onnx_backend.GraphBackend)
+    _upcast_lock = threading.Lock()
+
+    def set_backend(self, backend):
+        """
+        Run the unet and decoder through a graph runtime backend. None goes back to torch.
+        """
+        self.backend = backend
+
     def get_encodes(self, *args, **kwargs):
         """
         Get encodings/latents for given prompt. Inputs are identical to if you were calling the pipeline.
+        Returns (prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds)
         """
 
-        self.__call__(*args, mode="cache", guidance_scale = 0.0, num_inference_steps = 1, **kwargs)
-        return self.cached_encodes
+        return self.__call__(*args, mode="cache", guidance_scale = 0.0, num_inference_steps = 1, **kwargs)
     
     def generate_from_encodes(self, encodes, *args, **kwargs):
         """
         Assuming you have some encodings/latents, pass here to generate from them.
+        Unbatched encodings (no leading batch dimension) are treated as a batch of one. `encodes` isn't modified.
         """
 
-        if len(encodes[0].shape) == 2:
-            encodes[0] = encodes[0].unsqueeze(0)
-        if len(encodes[2].shape) == 1:
-            encodes[2] = encodes[2].unsqueeze(0)
+        prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds = encodes
+        if len(prompt_embeds.shape) == 2:
+            prompt_embeds = prompt_embeds.unsqueeze(0)
+        if len(pooled_prompt_embeds.shape) == 1:
+            pooled_prompt_embeds = pooled_prompt_embeds.unsqueeze(0)
 
-        self.cached_encodes = encodes
         if 'prompt' in kwargs:
             del kwargs['prompt']
 
-        return self.__call__(*args, prompt = [""] * len(self.cached_encodes[0]), guidance_scale = 0.0, num_inference_steps = 1, mode = "call", **kwargs)
+        return self.__call__(
+            *args,
+            prompt_embeds = prompt_embeds,
+            negative_prompt_embeds = negative_prompt_embeds,
+            pooled_prompt_embeds = pooled_prompt_embeds,
+            negative_pooled_prompt_embeds = negative_pooled_prompt_embeds,
+            guidance_scale = 0.0, num_inference_steps = 1, mode = "call", **kwargs
+        )
+
+    def initial_latents(self, seed, batch_size = 1, height = None, width = None, dtype = None):
+        """
+        Initial latent noise for a seed, generated on the pipeline's device and cached so repeated calls
+        with the same seed/resolution don't redo any random number generation. Pass the result as `latents`.
+        """
+        height = height or self.default_sample_size * self.vae_scale_factor
+        width = width or self.default_sample_size * self.vae_scale_factor
+        dtype = dtype or self.unet.dtype
+        device = self._execution_device
+
+        cache = self.__dict__.setdefault("_initial_latents", {})
+        key = (seed, height, width, batch_size, dtype, device)
+        if key not in cache:
+            shape = (batch_size, self.unet.config.in_channels, height // self.vae_scale_factor, width // self.vae_scale_factor)
+            generator = torch.Generator(device).manual_seed(seed)
+            # Unscaled noise, prepare_latents multiplies by the scheduler's init_noise_sigma
+            cache[key] = randn_tensor(shape, generator = generator, device = device, dtype = dtype)
+        return cache[key]
+
+    def unscale_latents(self, latents):
+        """
+        Undo the scaling (and normalization, if the vae has one) of denoised latents, as the vae decoder expects them.
+        Differentiable, unlike decode
+        """
+        # denormalize with the mean and std if available and not None
+        has_latents_mean = hasattr(self.vae.config, "latents_mean") and self.vae.config.latents_mean is not None
+        has_latents_std = hasattr(self.vae.config, "latents_std") and self.vae.config.latents_std is not None
+        if has_latents_mean and has_latents_std:
+            latents_mean = (
+                torch.tensor(self.vae.config.latents_mean).view(1, 4, 1, 1).to(latents.device, latents.dtype)
+            )
+            latents_std = (
+                torch.tensor(self.vae.config.latents_std).view(1, 4, 1, 1).to(latents.device, latents.dtype)
+            )
+            return latents * latents_std / self.vae.config.scaling_factor + latents_mean
+        return latents / self.vae.config.scaling_factor
+
+    @torch.no_grad()
+    def decode(self, latents, output_type = "pil"):
+        """
+        Decode denoised latents (as returned with output_type = "latent") into images. This is the last stage of
+        __call__ on its own, i.e. to decode latents that were blended directly.
+        """
+        # The VAE overflows in float16, decode with a float32 copy of it (the shared vae is never cast)
+        vae = self.vae
+        if self.backend is None and self.vae.dtype == torch.float16 and self.vae.config.force_upcast:
+            vae = self.upcast_vae_copy()
+            latents = latents.to(torch.float32)
+
+        latents = self.unscale_latents(latents)
+
+        with profile_stage("faceforge.decode"):
+            if self.backend is not None:
+                image = self.backend.decode(latents)
+            else:
+                image = vae.decode(latents, return_dict=False)[0]
+
+        # apply watermark if available
+        if self.watermark is not None:
+            image = self.watermark.apply_watermark(image)
+
+        with profile_stage("faceforge.postprocess"):
+            if output_type == "uint8":
+                return to_uint8(image)
+            return self.image_processor.postprocess(image, output_type=output_type)
+
+    def upcast_vae_copy(self):
+        """
+        float32 copy of the vae, made on first use and kept, for decoding fp16 vaes that overflow
+        """
+        with self._upcast_lock:
+            if self.__dict__.get("_vae_fp32") is None:
+                self.__dict__["_vae_fp32"] = copy.deepcopy(self.vae).to(dtype = torch.float32)
+            return self.__dict__["_vae_fp32"]
+
+    def prepare_latents(self, batch_size, num_channels_latents, height, width, dtype, device, generator, latents=None, scheduler=None):
+        """
+        Same as diffusers, but scales the noise with the scheduler of the current call
+        """
+        scheduler = scheduler or self.scheduler
+        shape = (batch_size, num_channels_latents, height // self.vae_scale_factor, width // self.vae_scale_factor)
+        if isinstance(generator, list) and len(generator) != batch_size:
+            raise ValueError(
+                f"You have passed a list of generators of length {len(generator)}, but requested an effective batch"
+                f" size of {batch_size}. Make sure the batch size matches the length of the generators."
+            )
+
+        if latents is None:
+            latents = randn_tensor(shape, generator=generator, device=device, dtype=dtype)
+        else:
+            latents = latents.to(device)
+
+        # scale the initial noise by the standard deviation required by the scheduler
+        latents = latents * scheduler.init_noise_sigma
+        return latents
 
     @torch.no_grad()
     @replace_example_docstring(EXAMPLE_DOC_STRING)
@@ -159,6 +296,7 @@ class HackedSDXLPipeline(StableDiffusionXLPipeline):
             output_type (`str`, *optional*, defaults to `"pil"`):
                 The output format of the generate image. Choose between
                 [PIL](https://pillow.readthedocs.io/en/stable/): `PIL.Image.Image` or `np.array`.
+                "uint8" gives a `[N, H, W, 3]` uint8 `np.array` without going through float arrays or PIL.
             return_dict (`bool`, *optional*, defaults to `True`):
                 Whether or not to return a [`~pipelines.stable_diffusion_xl.StableDiffusionXLPipelineOutput`] instead
                 of a plain tuple.
@@ -234,12 +372,8 @@ class HackedSDXLPipeline(StableDiffusionXLPipeline):
             callback_on_step_end_tensor_inputs,
         )
 
-        self._guidance_scale = guidance_scale
-        self._guidance_rescale = guidance_rescale
-        self._clip_skip = clip_skip
-        self._cross_attention_kwargs = cross_attention_kwargs
-        self._denoising_end = denoising_end
-        self._interrupt = False
+        # Per-call settings stay local (diffusers keeps them on the pipeline, where concurrent calls overwrite them)
+        do_classifier_free_guidance = guidance_scale > 1 and self.unet.config.time_cond_proj_dim is None
 
         # 2. Define call parameters
         if prompt is not None and isinstance(prompt, str):
@@ -253,71 +387,71 @@ class HackedSDXLPipeline(StableDiffusionXLPipeline):
 
         # 3. Encode input prompt
         lora_scale = (
-            self.cross_attention_kwargs.get("scale", None) if self.cross_attention_kwargs is not None else None
+            cross_attention_kwargs.get("scale", None) if cross_attention_kwargs is not None else None
         )
 
 
         if mode == "cache":
-            self.cached_encodes = self.encode_prompt(
-                prompt=prompt,
-                prompt_2=prompt_2,
-                device=device,
-                num_images_per_prompt=num_images_per_prompt,
-                do_classifier_free_guidance=self.do_classifier_free_guidance,
-                negative_prompt=negative_prompt,
-                negative_prompt_2=negative_prompt_2,
-                prompt_embeds=prompt_embeds,
-                negative_prompt_embeds=negative_prompt_embeds,
-                pooled_prompt_embeds=pooled_prompt_embeds,
-                negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
-                lora_scale=lora_scale,
-                clip_skip=self.clip_skip,
-            )
-            return None
+            with profile_stage("faceforge.encode_prompt"):
+                return self.encode_prompt(
+                    prompt=prompt,
+                    prompt_2=prompt_2,
+                    device=device,
+                    num_images_per_prompt=num_images_per_prompt,
+                    do_classifier_free_guidance=do_classifier_free_guidance,
+                    negative_prompt=negative_prompt,
+                    negative_prompt_2=negative_prompt_2,
+                    prompt_embeds=prompt_embeds,
+                    negative_prompt_embeds=negative_prompt_embeds,
+                    pooled_prompt_embeds=pooled_prompt_embeds,
+                    negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
+                    lora_scale=lora_scale,
+                    clip_skip=clip_skip,
+                )
         elif mode == "call":
-            (
-                prompt_embeds,
-                negative_prompt_embeds,
-                pooled_prompt_embeds,
-                negative_pooled_prompt_embeds,
-            ) = self.cached_encodes
+            pass # Embeddings were passed in as arguments
         else: # Normal behaviour
-            (
-                prompt_embeds,
-                negative_prompt_embeds,
-                pooled_prompt_embeds,
-                negative_pooled_prompt_embeds,
-            ) = self.encode_prompt(
-                prompt=prompt,
-                prompt_2=prompt_2,
-                device=device,
-                num_images_per_prompt=num_images_per_prompt,
-                do_classifier_free_guidance=self.do_classifier_free_guidance,
-                negative_prompt=negative_prompt,
-                negative_prompt_2=negative_prompt_2,
-                prompt_embeds=prompt_embeds,
-                negative_prompt_embeds=negative_prompt_embeds,
-                pooled_prompt_embeds=pooled_prompt_embeds,
-                negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
-                lora_scale=lora_scale,
-                clip_skip=self.clip_skip,
-            )          
+            with profile_stage("faceforge.encode_prompt"):
+                (
+                    prompt_embeds,
+                    negative_prompt_embeds,
+                    pooled_prompt_embeds,
+                    negative_pooled_prompt_embeds,
+                ) = self.encode_prompt(
+                    prompt=prompt,
+                    prompt_2=prompt_2,
+                    device=device,
+                    num_images_per_prompt=num_images_per_prompt,
+                    do_classifier_free_guidance=do_classifier_free_guidance,
+                    negative_prompt=negative_prompt,
+                    negative_prompt_2=negative_prompt_2,
+                    prompt_embeds=prompt_embeds,
+                    negative_prompt_embeds=negative_prompt_embeds,
+                    pooled_prompt_embeds=pooled_prompt_embeds,
+                    negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
+                    lora_scale=lora_scale,
+                    clip_skip=clip_skip,
+                )          
 
         # 4. Prepare timesteps
-        timesteps, num_inference_steps = retrieve_timesteps(self.scheduler, num_inference_steps, device, timesteps)
+        # Schedulers keep their timesteps and step index as state, so every call steps its own (shallow) copy
+        scheduler = copy.copy(self.scheduler)
+        timesteps, num_inference_steps = retrieve_timesteps(scheduler, num_inference_steps, device, timesteps)
 
         # 5. Prepare latent variables
         num_channels_latents = self.unet.config.in_channels
-        latents = self.prepare_latents(
-            batch_size * num_images_per_prompt,
-            num_channels_latents,
-            height,
-            width,
-            prompt_embeds.dtype,
-            device,
-            generator,
-            latents,
-        )
+        with profile_stage("faceforge.prepare_latents"):
+            latents = self.prepare_latents(
+                batch_size * num_images_per_prompt,
+                num_channels_latents,
+                height,
+                width,
+                prompt_embeds.dtype,
+                device,
+                generator,
+                latents,
+                scheduler,
+            )
 
         # 6. Prepare extra step kwargs. TODO: Logic should ideally just be moved out of the pipeline
         extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
@@ -347,7 +481,11 @@ class HackedSDXLPipeline(StableDiffusionXLPipeline):
         else:
             negative_add_time_ids = add_time_ids
 
-        if False:#self.do_classifier_free_guidance:
+        if do_classifier_free_guidance:
+            if negative_prompt_embeds is None:
+                negative_prompt_embeds = torch.zeros_like(prompt_embeds)
+            if negative_pooled_prompt_embeds is None:
+                negative_pooled_prompt_embeds = torch.zeros_like(add_text_embeds)
             prompt_embeds = torch.cat([negative_prompt_embeds, prompt_embeds], dim=0)
             add_text_embeds = torch.cat([negative_pooled_prompt_embeds, add_text_embeds], dim=0)
             add_time_ids = torch.cat([negative_add_time_ids, add_time_ids], dim=0)
@@ -362,23 +500,23 @@ class HackedSDXLPipeline(StableDiffusionXLPipeline):
                 ip_adapter_image_embeds,
                 device,
                 batch_size * num_images_per_prompt,
-                self.do_classifier_free_guidance,
+                do_classifier_free_guidance,
             )
 
         # 8. Denoising loop
-        num_warmup_steps = max(len(timesteps) - num_inference_steps * self.scheduler.order, 0)
+        num_warmup_steps = max(len(timesteps) - num_inference_steps * scheduler.order, 0)
 
         # 8.1 Apply denoising_end
         if (
-            self.denoising_end is not None
-            and isinstance(self.denoising_end, float)
-            and self.denoising_end > 0
-            and self.denoising_end < 1
+            denoising_end is not None
+            and isinstance(denoising_end, float)
+            and denoising_end > 0
+            and denoising_end < 1
         ):
             discrete_timestep_cutoff = int(
                 round(
-                    self.scheduler.config.num_train_timesteps
-                    - (self.denoising_end * self.scheduler.config.num_train_timesteps)
+                    scheduler.config.num_train_timesteps
+                    - (denoising_end * scheduler.config.num_train_timesteps)
                 )
             )
             num_inference_steps = len(list(filter(lambda ts: ts >= discrete_timestep_cutoff, timesteps)))
@@ -387,47 +525,48 @@ class HackedSDXLPipeline(StableDiffusionXLPipeline):
         # 9. Optionally get Guidance Scale Embedding
         timestep_cond = None
         if self.unet.config.time_cond_proj_dim is not None:
-            guidance_scale_tensor = torch.tensor(self.guidance_scale - 1).repeat(batch_size * num_images_per_prompt)
+            guidance_scale_tensor = torch.tensor(guidance_scale - 1).repeat(batch_size * num_images_per_prompt)
             timestep_cond = self.get_guidance_scale_embedding(
                 guidance_scale_tensor, embedding_dim=self.unet.config.time_cond_proj_dim
             ).to(device=device, dtype=latents.dtype)
 
-        self._num_timesteps = len(timesteps)
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
-                if self.interrupt:
-                    continue
-
                 # expand the latents if we are doing classifier free guidance
-                latent_model_input = torch.cat([latents] * 2) if self.do_classifier_free_guidance else latents
+                latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
 
-                latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
+                latent_model_input = scheduler.scale_model_input(latent_model_input, t)
 
                 # predict the noise residual
                 added_cond_kwargs = {"text_embeds": add_text_embeds, "time_ids": add_time_ids}
                 if ip_adapter_image is not None or ip_adapter_image_embeds is not None:
                     added_cond_kwargs["image_embeds"] = image_embeds
-                noise_pred = self.unet(
-                    latent_model_input,
-                    t,
-                    encoder_hidden_states=prompt_embeds,
-                    timestep_cond=timestep_cond,
-                    cross_attention_kwargs=self.cross_attention_kwargs,
-                    added_cond_kwargs=added_cond_kwargs,
-                    return_dict=False,
-                )[0]
+                with profile_stage("faceforge.unet"):
+                    if self.backend is not None:
+                        noise_pred = self.backend.unet(latent_model_input, t, prompt_embeds, add_text_embeds, add_time_ids)
+                    else:
+                        noise_pred = self.unet(
+                            latent_model_input,
+                            t,
+                            encoder_hidden_states=prompt_embeds,
+                            timestep_cond=timestep_cond,
+                            cross_attention_kwargs=cross_attention_kwargs,
+                            added_cond_kwargs=added_cond_kwargs,
+                            return_dict=False,
+                        )[0]
 
                 # perform guidance
-                if self.do_classifier_free_guidance:
+                if do_classifier_free_guidance:
                     noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                    noise_pred = noise_pred_uncond + self.guidance_scale * (noise_pred_text - noise_pred_uncond)
+                    noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
 
-                if self.do_classifier_free_guidance and self.guidance_rescale > 0.0:
+                if do_classifier_free_guidance and guidance_rescale > 0.0:
                     # Based on 3.4. in https://arxiv.org/pdf/2305.08891.pdf
-                    noise_pred = rescale_noise_cfg(noise_pred, noise_pred_text, guidance_rescale=self.guidance_rescale)
+                    noise_pred = rescale_noise_cfg(noise_pred, noise_pred_text, guidance_rescale=guidance_rescale)
 
                 # compute the previous noisy sample x_t -> x_t-1
-                latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs, return_dict=False)[0]
+                with profile_stage("faceforge.scheduler_step"):
+                    latents = scheduler.step(noise_pred, t, latents, **extra_step_kwargs, return_dict=False)[0]
 
                 if callback_on_step_end is not None:
                     callback_kwargs = {}
@@ -446,53 +585,20 @@ class HackedSDXLPipeline(StableDiffusionXLPipeline):
                     negative_add_time_ids = callback_outputs.pop("negative_add_time_ids", negative_add_time_ids)
 
                 # call the callback, if provided
-                if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
+                if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % scheduler.order == 0):
                     progress_bar.update()
                     if callback is not None and i % callback_steps == 0:
-                        step_idx = i // getattr(self.scheduler, "order", 1)
+                        step_idx = i // getattr(scheduler, "order", 1)
                         callback(step_idx, t, latents)
 
                 if XLA_AVAILABLE:
                     xm.mark_step()
 
         if not output_type == "latent":
-            # make sure the VAE is in float32 mode, as it overflows in float16
-            needs_upcasting = self.vae.dtype == torch.float16 and self.vae.config.force_upcast
-
-            if needs_upcasting:
-                self.upcast_vae()
-                latents = latents.to(next(iter(self.vae.post_quant_conv.parameters())).dtype)
-
-            # unscale/denormalize the latents
-            # denormalize with the mean and std if available and not None
-            has_latents_mean = hasattr(self.vae.config, "latents_mean") and self.vae.config.latents_mean is not None
-            has_latents_std = hasattr(self.vae.config, "latents_std") and self.vae.config.latents_std is not None
-            if has_latents_mean and has_latents_std:
-                latents_mean = (
-                    torch.tensor(self.vae.config.latents_mean).view(1, 4, 1, 1).to(latents.device, latents.dtype)
-                )
-                latents_std = (
-                    torch.tensor(self.vae.config.latents_std).view(1, 4, 1, 1).to(latents.device, latents.dtype)
-                )
-                latents = latents * latents_std / self.vae.config.scaling_factor + latents_mean
-            else:
-                latents = latents / self.vae.config.scaling_factor
-
-            image = self.vae.decode(latents, return_dict=False)[0]
-
-            # cast back to fp16 if needed
-            if needs_upcasting:
-                self.vae.to(dtype=torch.float16)
+            image = self.decode(latents, output_type=output_type)
         else:
             image = latents
 
-        if not output_type == "latent":
-            # apply watermark if available
-            if self.watermark is not None:
-                image = self.watermark.apply_watermark(image)
-
-            image = self.image_processor.postprocess(image, output_type=output_type)
-
         # Offload all models
         self.maybe_free_model_hooks()
 
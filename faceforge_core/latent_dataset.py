@@ -0,0 +1,220 @@
+"""
+Out-of-core latent datasets: latent corpora too big for memory (or for a JSON request), kept on disk in chunks
+
+Layout of a dataset directory:
+- chunk-<n>.npy: (rows, D) latents, memory-mapped when read. labels-<n>.npy: their (rows, K) labels, if the dataset has labels
+- manifest.jsonl: append-only manifest. The first line describes the dataset ({"dim", "dtype", "label_columns"}),
+  every later line a chunk ({"chunk", "rows", "sha256", "hash"}) once its files are complete
+- fits/: results of fits on the dataset, by dataset hash and fit parameters (see cached_fit)
+- lock: flock'd by writers (see append_only.py for how readers and writers share the directory)
+
+Chunks are only ever added. The hash of a dataset chains the content hashes of its chunks, so it's known after every
+append without rereading anything, and any change of content gives a new one.
+"""
+
+import os
+import json
+import hashlib
+import argparse
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .append_only import AppendOnlyIndex
+from .direction_registry import dataset_hash
+
+class LatentDataset:
+    """
+    Append-only, chunked store of latent vectors (and optionally labels) on disk
+
+    :param path: Directory of the dataset, created on the first append
+    :param chunk_rows: Most rows per chunk file written by append
+    :param dtype: Dtype latents are stored in, fixed by the first append. Defaults to float32
+    """
+    def __init__(self, path : str, chunk_rows : int = 65536, dtype : str = "float32"):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.default_dtype = dtype
+        self.manifest_path = os.path.join(path, "manifest.jsonl")
+        self.lock_path = os.path.join(path, "lock")
+        self.fits_path = os.path.join(path, "fits")
+        self._log = AppendOnlyIndex(self.manifest_path, self.lock_path)
+        self._thread_lock = self._log.thread_lock
+        self.header : Optional[dict] = None
+        self.entries : List[dict] = []
+
+    # === READING ===
+
+    def _refresh(self):
+        """
+        Pick up chunks appended (by any process) since the last refresh
+        """
+        with self._thread_lock:
+            records, _ = self._log.read() # Never replaced, chunks are only added
+            for record in records:
+                if self.header is None:
+                    self.header = record
+                else:
+                    self.entries.append(record)
+
+    def __len__(self) -> int:
+        with self._thread_lock:
+            self._refresh()
+            return sum(entry["rows"] for entry in self.entries)
+
+    @property
+    def dim(self) -> Optional[int]:
+        self._refresh()
+        return self.header["dim"] if self.header else None
+
+    @property
+    def dtype(self) -> np.dtype:
+        self._refresh()
+        return np.dtype(self.header["dtype"] if self.header else self.default_dtype)
+
+    @property
+    def label_columns(self) -> Optional[int]:
+        """
+        Number of label columns, None if the dataset has no labels
+        """
+        self._refresh()
+        return self.header["label_columns"] if self.header else None
+
+    @property
+    def hash(self) -> Optional[str]:
+        """
+        Content hash of the dataset, None while it's empty
+        """
+        with self._thread_lock:
+            self._refresh()
+            return self.entries[-1]["hash"] if self.entries else None
+
+    @property
+    def shape(self) -> Tuple[int, Optional[int]]:
+        return (len(self), self.dim)
+
+    def _file(self, kind : str, chunk : int) -> str:
+        return os.path.join(self.path, f"{kind}-{chunk:06d}.npy")
+
+    def chunks(self, labels : bool = False) -> Iterator:
+        """
+        Iterate over the latents chunk by chunk, as read-only memory-mapped (rows, D) arrays,
+        or (latents, labels) pairs with labels. Chunks appended while iterating aren't included
+        """
+        with self._thread_lock:
+            self._refresh()
+            entries = list(self.entries)
+        if labels and not self.label_columns:
+            raise ValueError("The dataset has no labels")
+        for entry in entries:
+            latents = np.load(self._file("chunk", entry["chunk"]), mmap_mode = "r")
+            yield (latents, np.load(self._file("labels", entry["chunk"]))) if labels else latents
+
+    def labels(self) -> np.ndarray:
+        """
+        All labels (N, K), read into memory (they are small next to the latents)
+        """
+        return np.concatenate([y for _, y in self.chunks(labels = True)])
+
+    def load(self) -> np.ndarray:
+        """
+        All latents (N, D) in memory, for datasets that fit
+        """
+        return np.concatenate(list(self.chunks())) if len(self) else np.zeros((0, self.dim or 0), dtype = self.dtype)
+
+    # === WRITING ===
+
+    @staticmethod
+    def _save(path : str, array : np.ndarray):
+        # Complete files only: write next to the target and rename
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp, path)
+
+    def append(self, latents : np.ndarray, labels : Optional[np.ndarray] = None) -> str:
+        """
+        Add latents (N, D), and their labels (N,) or (N, K) if the dataset has labels. Works on memory-mapped inputs
+        (i.e. np.load(path, mmap_mode = "r")) chunk_rows at a time, so inputs don't need to fit in memory.
+        :return: Hash of the dataset after the append
+        """
+        if latents.ndim != 2:
+            raise ValueError(f"Expected latents of shape (N, D), got {latents.shape}")
+        if labels is not None:
+            labels = np.asarray(labels)
+            labels = labels[:, None] if labels.ndim == 1 else labels
+            if len(labels) != len(latents):
+                raise ValueError(f"Got {len(labels)} labels for {len(latents)} latents")
+
+        with self._log.locked():
+            self._refresh()
+            if self.header is None:
+                header = {"dim" : latents.shape[1], "dtype" : self.default_dtype,
+                          "label_columns" : labels.shape[1] if labels is not None else None}
+                self._log.append([header])
+                self._refresh()
+            if latents.shape[1] != self.header["dim"]:
+                raise ValueError(f"Latents of dimension {latents.shape[1]} don't fit the dataset's {self.header['dim']}")
+            if (labels.shape[1] if labels is not None else None) != self.header["label_columns"]:
+                raise ValueError(f"The dataset has {self.header['label_columns']} label columns")
+
+            for start in range(0, len(latents), self.chunk_rows):
+                chunk = len(self.entries)
+                x = np.ascontiguousarray(latents[start:start + self.chunk_rows], dtype = self.header["dtype"])
+                y = np.ascontiguousarray(labels[start:start + self.chunk_rows]) if labels is not None else None
+                self._save(self._file("chunk", chunk), x)
+                if y is not None:
+                    self._save(self._file("labels", chunk), y)
+                content = dataset_hash(x, y)
+                previous = self.entries[-1]["hash"] if self.entries else ""
+                entry = {"chunk" : chunk, "rows" : len(x), "sha256" : content,
+                         "hash" : hashlib.sha256(f"{previous}{content}".encode()).hexdigest()}
+                # The manifest line goes in only after the chunk's files are complete
+                self._log.append([entry])
+                self._refresh()
+            return self.hash
+
+    # === FITS ===
+
+    def cached_fit(self, key : dict, fit : Callable[[], Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+        """
+        Result of fit() on the dataset as it is now, from fits/ if the same fit (key) already ran on the same content
+        :param key: JSON serializable description of the fit (method and parameters)
+        :param fit: Computes the result, a dict of arrays
+        """
+        if not len(self):
+            return fit()
+        name = hashlib.sha256(json.dumps({"dataset" : self.hash, **key}, sort_keys = True, default = str).encode()).hexdigest()
+        path = os.path.join(self.fits_path, f"{name}.npz")
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                return dict(cached)
+        result = fit()
+        os.makedirs(self.fits_path, exist_ok = True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **result)
+        os.replace(tmp, path)
+        return result
+
+def main():
+    parser = argparse.ArgumentParser(description = "Ingest latents into out-of-core datasets")
+    parser.add_argument("command", choices = ["stats", "ingest"])
+    parser.add_argument("path", help = "Dataset directory")
+    parser.add_argument("latents", nargs = "*", help = ".npy files of (N, D) latents to ingest, read memory-mapped")
+    parser.add_argument("--labels", nargs = "*", default = None, help = ".npy files of their labels, one per latents file")
+    parser.add_argument("--chunk-rows", type = int, default = 65536)
+    args = parser.parse_args()
+
+    dataset = LatentDataset(args.path, chunk_rows = args.chunk_rows)
+    if args.command == "ingest":
+        if args.labels is not None and len(args.labels) != len(args.latents):
+            parser.error("Pass one labels file per latents file")
+        for i, path in enumerate(args.latents):
+            labels = np.load(args.labels[i]) if args.labels is not None else None
+            dataset.append(np.load(path, mmap_mode = "r"), labels)
+            print(f"Ingested {path}")
+    print(f"{len(dataset)} x {dataset.dim} latents, {len(dataset.entries)} chunks, hash {dataset.hash}")
+
+if __name__ == "__main__":
+    main()
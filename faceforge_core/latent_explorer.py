@@ -1,6 +1,8 @@
 import numpy as np
 from typing import List, Optional, Tuple
 
+from .encoding_compression import CompressedTensor, anchor_memory, compress_encoding, decompress_encoding
+
 class LatentPoint:
     """
     Represents a point in latent space with an associated prompt and encoding.
@@ -16,13 +18,17 @@ class LatentPoint:
 class LatentSpaceExplorer:
     """
     Core logic for managing points in latent space and sampling new points.
+
+    :param compression: None, "fp16" or "int8" (per-channel scales). Encodings are stored compressed and
+        decompressed on the fly when sampled, see encoding_compression
     """
-    def __init__(self):
+    def __init__(self, compression: Optional[str] = None):
         self.points: List[LatentPoint] = []
         self.selected_point_idx: Optional[int] = None
+        self.compression = compression
 
     def add_point(self, text: str, encoding: Optional[np.ndarray], xy_pos: Optional[Tuple[float, float]] = None):
-        self.points.append(LatentPoint(text, encoding, xy_pos))
+        self.points.append(LatentPoint(text, compress_encoding(encoding, self.compression), xy_pos))
 
     def delete_point(self, idx: int):
         if 0 <= idx < len(self.points):
@@ -31,10 +37,21 @@ class LatentSpaceExplorer:
     def modify_point(self, idx: int, new_text: str, new_encoding: Optional[np.ndarray]):
         if 0 <= idx < len(self.points):
             self.points[idx].text = new_text
-            self.points[idx].encoding = new_encoding
+            self.points[idx].encoding = compress_encoding(new_encoding, self.compression)
 
-    def get_encodings(self) -> List[Optional[np.ndarray]]:
-        return [p.encoding for p in self.points]
+    def get_encodings(self, decompress: bool = True) -> List[Optional[np.ndarray]]:
+        """
+        Encodings of the points, decompressed unless decompress is False
+        """
+        if not decompress:
+            return [p.encoding for p in self.points]
+        return [decompress_encoding(p.encoding) for p in self.points]
+
+    def memory_per_anchor(self) -> dict:
+        """
+        Memory held by the points' encodings: {"compression", "anchors", "bytes", "bytes_per_anchor"}
+        """
+        return anchor_memory(self.get_encodings(decompress=False), self.compression)
 
     def get_prompts(self) -> List[str]:
         return [p.text for p in self.points]
@@ -46,7 +63,7 @@ class LatentSpaceExplorer:
         """
         Sample a new encoding based on the given point and mode.
         """
-        encodings = self.get_encodings()
+        encodings = self.get_encodings(decompress=False)
         positions = self.get_positions()
         if not encodings or len(encodings) == 0:
             return None
@@ -60,12 +77,18 @@ class LatentSpaceExplorer:
         else:
             raise ValueError(f"Unknown sampling mode: {mode}")
         coefs = coefs / np.sum(coefs)
-        # Weighted sum of encodings
+        # Weighted sum of encodings. Compressed ones are decompressed one at a time, into an fp32 sum
         result = None
+        dtype = None
         for coef, enc in zip(coefs, encodings):
             if enc is not None:
+                if isinstance(enc, CompressedTensor):
+                    dtype = enc.dtype
+                    coef, enc = np.float32(coef), enc.float()
                 if result is None:
                     result = coef * enc
                 else:
                     result += coef * enc
+        if dtype is not None and result is not None:
+            result = result.astype(dtype)
         return result 
\ No newline at end of file
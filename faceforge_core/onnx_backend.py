@@ -0,0 +1,167 @@
+"""
+Export the UNet and TAESD decoder to ONNX and run them through ONNX Runtime or OpenVINO instead of torch
+
+Export once (fp32, on cpu):
+    python -m faceforge_core.onnx_backend export --out-dir onnx/sdxl-turbo
+
+Then select the backend when building the pipeline:
+    fast_diffusion_pipeline(device = "cpu", backend = "onnxruntime", onnx_dir = "onnx/sdxl-turbo")
+
+Text encoding, the scheduler and latent scaling stay in torch, only the two heavy graphs move to the runtime.
+"""
+
+import os
+import copy
+import argparse
+import logging
+
+import numpy as np
+import torch
+
+logger = logging.getLogger("faceforge_core")
+
+RUNTIMES = ("onnxruntime", "openvino")
+UNET_FILE = "unet.onnx"
+DECODER_FILE = "vae_decoder.onnx"
+UNET_INPUTS = ["sample", "timestep", "encoder_hidden_states", "text_embeds", "time_ids"]
+
+class UNetGraph(torch.nn.Module):
+    """
+    UNet with SDXL's added conditioning (pooled text embeds and time ids) as plain positional inputs
+    """
+    def __init__(self, unet):
+        super().__init__()
+        self.unet = unet
+
+    def forward(self, sample, timestep, encoder_hidden_states, text_embeds, time_ids):
+        added_cond_kwargs = {"text_embeds" : text_embeds, "time_ids" : time_ids}
+        return self.unet(sample, timestep, encoder_hidden_states = encoder_hidden_states, added_cond_kwargs = added_cond_kwargs, return_dict = False)[0]
+
+class DecoderGraph(torch.nn.Module):
+    def __init__(self, vae):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, latents):
+        return self.vae.decode(latents, return_dict = False)[0]
+
+def export_onnx(pipe, out_dir : str, opset : int = 17):
+    """
+    Write unet.onnx and vae_decoder.onnx for a pipeline to out_dir. Batch size, resolution and prompt length are dynamic.
+    """
+    os.makedirs(out_dir, exist_ok = True)
+    unet = copy.deepcopy(pipe.unet).to("cpu", torch.float32).eval()
+    vae = copy.deepcopy(pipe.vae).to("cpu", torch.float32).eval()
+
+    config = unet.config
+    latent_size = config.sample_size
+    text_embeds_dim = config.projection_class_embeddings_input_dim - 6 * config.addition_time_embed_dim
+    unet_args = (
+        torch.randn(1, config.in_channels, latent_size, latent_size),
+        torch.tensor([999.]),
+        torch.randn(1, 77, config.cross_attention_dim),
+        torch.randn(1, text_embeds_dim),
+        torch.randn(1, 6),
+    )
+    latent_axes = {0 : "batch", 2 : "latent_height", 3 : "latent_width"}
+
+    # TorchScript based exporter: it copes with diffusers' shape dependent branches under dynamic axes
+    logger.info(f"Exporting unet to {out_dir}")
+    with torch.no_grad():
+        torch.onnx.export(
+            UNetGraph(unet), unet_args, os.path.join(out_dir, UNET_FILE),
+            input_names = UNET_INPUTS, output_names = ["noise_pred"],
+            dynamic_axes = {
+                "sample" : latent_axes,
+                "encoder_hidden_states" : {0 : "batch", 1 : "sequence"},
+                "text_embeds" : {0 : "batch"},
+                "time_ids" : {0 : "batch"},
+                "noise_pred" : latent_axes,
+            },
+            opset_version = opset, dynamo = False,
+        )
+
+        logger.info(f"Exporting decoder to {out_dir}")
+        torch.onnx.export(
+            DecoderGraph(vae), (torch.randn(1, vae.config.latent_channels, latent_size, latent_size),), os.path.join(out_dir, DECODER_FILE),
+            input_names = ["latents"], output_names = ["image"],
+            dynamic_axes = {"latents" : latent_axes, "image" : {0 : "batch", 2 : "height", 3 : "width"}},
+            opset_version = opset, dynamo = False,
+        )
+
+class OnnxRuntimeGraph:
+    def __init__(self, path : str, num_threads = None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers = ["CPUExecutionProvider"])
+
+    def __call__(self, **inputs) -> np.ndarray:
+        return self.session.run(None, inputs)[0]
+
+class OpenVINOGraph:
+    def __init__(self, path : str, num_threads = None):
+        import openvino as ov
+
+        config = {"INFERENCE_NUM_THREADS" : num_threads} if num_threads is not None else {}
+        self.model = ov.Core().compile_model(path, "CPU", config)
+
+    def __call__(self, **inputs) -> np.ndarray:
+        return self.model(inputs)[0]
+
+class GraphBackend:
+    """
+    Exported UNet and decoder behind the calls HackedSDXLPipeline makes. Takes and returns torch tensors.
+
+    :param onnx_dir: Directory written by export_onnx
+    :param runtime: "onnxruntime" or "openvino"
+    :param num_threads: Threads for the runtime, defaults to the runtime's choice
+    """
+    def __init__(self, onnx_dir : str, runtime : str = "onnxruntime", num_threads = None):
+        if runtime == "onnxruntime":
+            graph_cls = OnnxRuntimeGraph
+        elif runtime == "openvino":
+            graph_cls = OpenVINOGraph
+        else:
+            raise ValueError(f"Unknown graph runtime: {runtime}")
+        self.runtime = runtime
+        self.unet_graph = graph_cls(os.path.join(onnx_dir, UNET_FILE), num_threads)
+        self.decoder_graph = graph_cls(os.path.join(onnx_dir, DECODER_FILE), num_threads)
+
+    @staticmethod
+    def _numpy(x : torch.Tensor) -> np.ndarray:
+        return x.detach().to("cpu", torch.float32).numpy()
+
+    def unet(self, sample, timestep, encoder_hidden_states, text_embeds, time_ids) -> torch.Tensor:
+        noise_pred = self.unet_graph(
+            sample = self._numpy(sample),
+            timestep = self._numpy(torch.as_tensor(timestep).reshape(1)),
+            encoder_hidden_states = self._numpy(encoder_hidden_states),
+            text_embeds = self._numpy(text_embeds),
+            time_ids = self._numpy(time_ids),
+        )
+        return torch.from_numpy(noise_pred).to(sample.device, sample.dtype)
+
+    def decode(self, latents) -> torch.Tensor:
+        image = self.decoder_graph(latents = self._numpy(latents))
+        return torch.from_numpy(image).to(latents.device, latents.dtype)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Export the unet and TAESD decoder of a pipeline to ONNX")
+    parser.add_argument("command", choices = ["export"])
+    parser.add_argument("--model-id", default = "stabilityai/sdxl-turbo")
+    parser.add_argument("--vae-id", default = "madebyollin/taesdxl")
+    parser.add_argument("--out-dir", required = True)
+    parser.add_argument("--opset", type = int, default = 17)
+    args = parser.parse_args()
+
+    from .fast_sd import fast_diffusion_pipeline
+    pipe = fast_diffusion_pipeline(model_id = args.model_id, vae_id = args.vae_id, device = "cpu", dtype = "fp32", channels_last = False)
+    export_onnx(pipe, args.out_dir, opset = args.opset)
+    print(f"Wrote {UNET_FILE} and {DECODER_FILE} to {args.out_dir}")
+
+if __name__ == "__main__":
+    main()
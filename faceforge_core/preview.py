@@ -0,0 +1,80 @@
+"""
+Decode-only previews
+
+Every anchor (prompt) is rendered once to its denoised latents. A preview blends those cached latents with the
+sampler's coefficients and only runs the decoder, so its cost is the decoder's rather than text encoding + unet.
+The result is an approximation: blending denoised latents is not the same as denoising a blended encoding.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import List
+
+import torch
+
+from .encoding_compression import batch, decompress_encoding
+
+class AnchorLatentCache:
+    """
+    Denoised latents for each anchor, rendered from the same initial noise as full renders
+
+    :param pipe: HackedSDXLPipeline
+    :param seed: Seed of the initial latent noise
+    :param max_size: Most anchors to keep latents for, least recently used are evicted first
+    """
+    def __init__(self, pipe, seed : int = 0, max_size : int = 1024):
+        self.pipe = pipe
+        self.seed = seed
+        self.max_size = max_size
+        self.cache = OrderedDict() # (prompt, height, width) -> [C, H, W] latents
+        self._lock = threading.Lock() # Shared by the API's request threads and the UI, rendering misses once
+
+    def __len__(self):
+        with self._lock:
+            return len(self.cache)
+
+    def clear(self):
+        with self._lock:
+            self.cache.clear()
+
+    def latents(self, prompts : List[str], encodings : List[tuple], height = None, width = None) -> torch.Tensor:
+        """
+        [N, C, H, W] denoised latents for the anchors. Anchors that aren't cached are rendered in one batch.
+
+        :param prompts: Anchor prompts, used as cache keys
+        :param encodings: Per anchor encodings (tuples of batch size 1 tensors or CompressedTensors, as the explorers store them)
+        """
+        with self._lock:
+            keys = [(prompt, height, width) for prompt in prompts]
+            missing = [keys.index(key) for key in dict.fromkeys(keys) if key not in self.cache]
+
+            if missing:
+                encodes = [
+                    decompress_encoding(batch([encodings[i][j] for i in missing])) for j in range(len(encodings[missing[0]]))
+                ]
+                noise = self.pipe.initial_latents(self.seed, height = height, width = width, dtype = encodes[0].dtype)
+                denoised = self.pipe.generate_from_encodes(
+                    encodes, latents = noise.expand(len(missing), -1, -1, -1), height = height, width = width, output_type = "latent"
+                ).images
+                for i, latents in zip(missing, denoised):
+                    self.cache[keys[i]] = latents
+
+            for key in keys:
+                self.cache.move_to_end(key)
+            res = torch.stack([self.cache[key] for key in keys], dim = 0)
+
+            while len(self.cache) > max(self.max_size, len(set(keys))):
+                self.cache.popitem(last = False)
+            return res
+
+    def preview(self, sampler_cls, prompts, encodings, point, other_points, height = None, width = None, output_type = "pil"):
+        """
+        Blend the anchors' cached latents at point and decode
+
+        :param sampler_cls: EncodingSampler subclass, the same one used for full renders
+        :param point: Point in low space ([2,] array)
+        :param other_points: Anchor points in low space ([N, 2] array)
+        """
+        latents = self.latents(prompts, encodings, height = height, width = width)
+        blended = sampler_cls(latents, normalize = True)(point, other_points)
+        return self.pipe.decode(blended.unsqueeze(0), output_type = output_type)
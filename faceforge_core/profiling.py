@@ -0,0 +1,113 @@
+"""
+On-demand profiling of a single request or render
+
+RequestProfiler runs cProfile (Python time) and torch.profiler (operator time) around a block and saves both
+into one zip:
+- python.prof: cProfile stats, open with `python -m pstats` or snakeviz
+- python.txt: top functions by cumulative time
+- torch_ops.txt: top operators by self time, grouped by input shape
+- torch_trace.json: chrome trace with the stages labelled by profile_stage, open in chrome://tracing or Perfetto
+- meta.json: whatever the caller passes, i.e. the request
+
+Stages are labelled with profile_stage, which does nothing unless a profiler is running.
+"""
+
+import os
+import io
+import json
+import time
+import pstats
+import zipfile
+import cProfile
+import tempfile
+import threading
+from contextlib import nullcontext
+
+import torch
+from torch.profiler import ProfilerActivity, profile, record_function
+
+class ProfilerBusy(RuntimeError):
+    """
+    Another block is already being profiled (profilers can't nest)
+    """
+
+def profile_stage(name : str):
+    """
+    Label a stage in torch.profiler traces, i.e. `with profile_stage("faceforge.unet"): ...`. Free when not profiling
+    """
+    return record_function(name) if torch.autograd._profiler_enabled() else nullcontext()
+
+class RequestProfiler:
+    """
+    Context manager profiling its block with cProfile and torch.profiler. Only one can run at a time per process.
+    torch.profiler records every thread of the process, so operators of requests running alongside the profiled one
+    show up in its trace and operator summary too (cProfile only sees the thread that entered the block)
+
+    :param record_shapes: Record operator input shapes (groups torch_ops.txt by shape)
+    :param with_stack: Record Python stacks of operators. Much bigger traces
+    :param row_limit: Rows in the text summaries
+    """
+    lock = threading.Lock()
+
+    def __init__(self, record_shapes : bool = True, with_stack : bool = False, row_limit : int = 50):
+        self.record_shapes = record_shapes
+        self.with_stack = with_stack
+        self.row_limit = row_limit
+        self.python = None
+        self.torch = None
+        self.ms = None
+
+    def __enter__(self):
+        if not self.lock.acquire(blocking = False):
+            raise ProfilerBusy("Another request is being profiled")
+        torch_started = False
+        try:
+            activities = [ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(ProfilerActivity.CUDA)
+            self.torch = profile(activities = activities, record_shapes = self.record_shapes, with_stack = self.with_stack)
+            self.python = cProfile.Profile()
+            self.torch.__enter__()
+            torch_started = True
+            self.python.enable()
+        except BaseException:
+            # __exit__ won't run, so undo what started and free the profiler for later requests
+            if torch_started:
+                self.torch.__exit__(None, None, None)
+            self.lock.release()
+            raise
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self.ms = (time.perf_counter() - self.start) * 1000
+            self.python.disable()
+            self.torch.__exit__(*exc)
+        finally:
+            self.lock.release()
+        return False
+
+    def python_summary(self, sort : str = "cumulative") -> str:
+        out = io.StringIO()
+        pstats.Stats(self.python, stream = out).sort_stats(sort).print_stats(self.row_limit)
+        return out.getvalue()
+
+    def torch_summary(self, sort_by : str = "self_cpu_time_total") -> str:
+        return self.torch.key_averages(group_by_input_shape = self.record_shapes).table(sort_by = sort_by, row_limit = self.row_limit)
+
+    def save(self, path : str, meta : dict = None) -> str:
+        """
+        Write the profile as a zip to path (see the module docstring for its contents)
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            stats_file, trace_file = os.path.join(tmp, "python.prof"), os.path.join(tmp, "torch_trace.json")
+            pstats.Stats(self.python).dump_stats(stats_file)
+            self.torch.export_chrome_trace(trace_file)
+            with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+                zf.write(stats_file, "python.prof")
+                zf.write(trace_file, "torch_trace.json")
+                zf.writestr("python.txt", self.python_summary())
+                zf.writestr("torch_ops.txt", self.torch_summary())
+                zf.writestr("meta.json", json.dumps({"ms" : self.ms, **(meta or {})}, indent = 2, default = str))
+        return path
@@ -0,0 +1,145 @@
+"""
+Int8 quantization of the Linear layers in the UNet and text encoders, mostly for cpu inference
+
+Modes:
+- "dynamic": int8 weights, activations are quantized on the fly and the matmuls run in int8 (fbgemm/onednn).
+  Only for fp32 models on cpu
+- "weight_only": int8 weights with per output channel scales, dequantized to the compute dtype on the fly.
+  Works for any device/dtype. Saves memory, not compute
+
+Quantized components are pickled to a cache directory so later startups skip both loading the full precision
+weights and the conversion.
+"""
+
+import os
+import hashlib
+import logging
+from typing import Dict
+
+import torch
+import torch.nn.functional as F
+import diffusers
+
+logger = logging.getLogger("faceforge_core")
+
+MODES = ("dynamic", "weight_only")
+QUANTIZED_COMPONENTS = ("unet", "text_encoder", "text_encoder_2") # pipeline attributes that get quantized
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "faceforge", "quantized")
+
+class Int8WeightOnlyLinear(torch.nn.Module):
+    """
+    Linear layer holding int8 weights and per output channel scales
+    """
+    def __init__(self, in_features, out_features, bias = True, dtype = torch.float32):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("qweight", torch.zeros(out_features, in_features, dtype = torch.int8))
+        self.register_buffer("scale", torch.ones(out_features, dtype = dtype))
+        self.bias = torch.nn.Parameter(torch.zeros(out_features, dtype = dtype), requires_grad = False) if bias else None
+
+    @classmethod
+    def from_linear(cls, linear : torch.nn.Linear):
+        weight = linear.weight.detach().float()
+        res = cls(linear.in_features, linear.out_features, linear.bias is not None, dtype = linear.weight.dtype).to(linear.weight.device)
+        # Symmetric per channel: the largest weight of each row maps to 127
+        scale = weight.abs().amax(dim = 1).clamp(min = 1e-8) / 127.
+        res.qweight.copy_(torch.round(weight / scale[:,None]).clamp(-127, 127).to(torch.int8))
+        res.scale.copy_(scale)
+        if linear.bias is not None:
+            res.bias.data.copy_(linear.bias.detach())
+        return res
+
+    def forward(self, x, *args):
+        # *args: diffusers' LoRA compatible linear layers get called with an extra scale
+        weight = self.qweight.to(x.dtype) * self.scale.to(x.dtype)[:,None]
+        return F.linear(x, weight, self.bias)
+
+class DynamicInt8Linear(torch.nn.Module):
+    """
+    Wrapper around torch's dynamically quantized Linear that accepts the extra args diffusers passes to its linear layers
+    """
+    def __init__(self, linear : torch.nn.Linear):
+        super().__init__()
+        from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+        from torch.ao.quantization import per_channel_dynamic_qconfig
+
+        # Read by diffusers (i.e. to check add_embedding sizes)
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        linear.qconfig = per_channel_dynamic_qconfig
+        self.linear = DynamicQuantizedLinear.from_float(linear)
+
+    def forward(self, x, *args):
+        return self.linear(x)
+
+def quantize_linear_layers(module : torch.nn.Module, mode : str = "dynamic") -> int:
+    """
+    Replace every Linear layer in module (in place) with an int8 one. Returns the number of layers replaced.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown quantization mode: {mode}")
+
+    count = 0
+    for name, child in module.named_children():
+        if isinstance(child, torch.nn.Linear):
+            if mode == "dynamic":
+                if child.weight.dtype != torch.float32 or child.weight.device.type != "cpu":
+                    raise ValueError("Dynamic quantization needs an fp32 model on cpu, use weight_only otherwise")
+                setattr(module, name, DynamicInt8Linear(child))
+            else:
+                setattr(module, name, Int8WeightOnlyLinear.from_linear(child))
+            count += 1
+        else:
+            count += quantize_linear_layers(child, mode)
+    return count
+
+def quantize_pipeline(pipe, mode : str = "dynamic"):
+    """
+    Quantize the Linear layers of the pipeline's UNet and text encoders in place
+    """
+    for name in QUANTIZED_COMPONENTS:
+        component = getattr(pipe, name, None)
+        if component is not None:
+            count = quantize_linear_layers(component, mode)
+            logger.info(f"Quantized {count} linear layers in {name} ({mode})")
+    return pipe
+
+def module_nbytes(module : torch.nn.Module) -> int:
+    """
+    Bytes held by a module's state (parameters, buffers and packed quantized weights)
+    """
+    def nbytes(x):
+        if isinstance(x, torch.Tensor):
+            return x.numel() * x.element_size()
+        if isinstance(x, (tuple, list)):
+            return sum(nbytes(i) for i in x)
+        return 0
+    return sum(nbytes(v) for v in module.state_dict().values())
+
+def cache_path(cache_dir : str, model_id : str, mode : str, dtype : torch.dtype) -> str:
+    """
+    Cached components are pickled modules, so the key includes the library versions they were pickled with
+    """
+    key = f"{model_id}|{mode}|{dtype}|torch={torch.__version__}|diffusers={diffusers.__version__}"
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{model_id.replace('/', '--')}-{mode}-{digest}.pt")
+
+def load_quantized_components(cache_dir : str, model_id : str, mode : str, dtype : torch.dtype) -> Dict[str, torch.nn.Module]:
+    """
+    Quantized components from the cache, keyed by pipeline attribute. Empty if nothing is cached yet.
+    """
+    path = cache_path(cache_dir, model_id, mode, dtype)
+    if not os.path.exists(path):
+        return {}
+    logger.info(f"Loading quantized components from {path}")
+    return torch.load(path, weights_only = False)
+
+def save_quantized_components(pipe, cache_dir : str, model_id : str, mode : str, dtype : torch.dtype):
+    path = cache_path(cache_dir, model_id, mode, dtype)
+    os.makedirs(cache_dir, exist_ok = True)
+    components = {name : getattr(pipe, name) for name in QUANTIZED_COMPONENTS if getattr(pipe, name, None) is not None}
+    tmp_path = path + ".tmp"
+    torch.save(components, tmp_path)
+    os.replace(tmp_path, path)
+    logger.info(f"Saved quantized components to {path}")
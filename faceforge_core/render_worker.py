@@ -0,0 +1,95 @@
+"""
+Background rendering with a single-slot mailbox
+
+The pygame loop posts render jobs without waiting for them. Only the newest pending job is kept (latest wins):
+positions the player has already moved past are dropped instead of queued, so the image catches up with the
+cursor as fast as the model allows while the loop keeps drawing frames.
+"""
+
+import time
+import logging
+import threading
+
+logger = logging.getLogger("faceforge_core")
+
+class RenderWorker:
+    """
+    Thread running render_fn on submitted jobs, newest job first and only
+
+    :param render_fn: Called with a job on the worker thread, returns the result
+    """
+    def __init__(self, render_fn):
+        self.render_fn = render_fn
+        self.cond = threading.Condition()
+        self.job = None # Pending job, overwritten by newer submits
+        self.result = None # (job, result, ms) of the newest finished job, until polled
+        self.busy = False
+        self.running = True
+        self.thread = threading.Thread(target = self.run, name = "faceforge-render", daemon = True)
+        self.thread.start()
+
+    def submit(self, job):
+        """
+        Replace the pending job (if any) with job
+        """
+        with self.cond:
+            self.job = job
+            self.cond.notify_all()
+
+    def cancel(self):
+        """
+        Drop the pending job and any finished result not polled yet. A job already running still finishes
+        """
+        with self.cond:
+            self.job = None
+            self.result = None
+            self.cond.notify_all()
+
+    def poll(self):
+        """
+        (job, result, ms) for the newest job finished since the last poll, None if there is none
+        """
+        with self.cond:
+            res, self.result = self.result, None
+        return res
+
+    @property
+    def idle(self):
+        with self.cond:
+            return self.job is None and not self.busy
+
+    def wait(self, timeout = None) -> bool:
+        """
+        Block until no job is pending or running. Returns False on timeout
+        """
+        with self.cond:
+            return self.cond.wait_for(lambda: self.job is None and not self.busy, timeout = timeout)
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.job is not None or not self.running)
+                if not self.running:
+                    return
+                job, self.job = self.job, None
+                self.busy = True
+
+            result = None
+            start = time.perf_counter()
+            try:
+                result = self.render_fn(job)
+            except Exception:
+                logger.exception("Background render failed")
+            ms = (time.perf_counter() - start) * 1000
+
+            with self.cond:
+                self.busy = False
+                if result is not None:
+                    self.result = (job, result, ms)
+                self.cond.notify_all()
@@ -4,18 +4,29 @@ import torch
 import numpy as np
 
 from .utils import recursive_find_device, recursive_find_dtype
+from .encoding_compression import CompressedTensor
 
 class EncodingSampler:
     """
     Class to sample encodings given low dimensional spatial relationships.
+
+    :param encodes: Encodings (or anything batched the same way, i.e. latents) to combine. Entries can be CompressedTensors,
+        which are blended without decompressing them as a whole (see encoding_compression)
+    :param normalize: Scale coefs so their absolute values sum to 1. Use for things with a fixed scale like latents.
+        When every coef is 0 (e.g. circle sampling at the origin) the result is the mean of the encodings
     """
-    def __init__(self, encodes):
+    def __init__(self, encodes, normalize = False):
         self.encodes = encodes
+        self.normalize = normalize
 
     def apply_coefs(self, coefs):
         """
         Linear combination of encodings given coefs
         """
+        if self.normalize:
+            total = np.abs(coefs).sum()
+            coefs = coefs / total if total > 0 else np.full_like(coefs, 1. / len(coefs))
+        raw_coefs = coefs
         device = recursive_find_device(self.encodes)
         dtype = recursive_find_dtype(self.encodes)
         # NOTE: Convert from float64 first to `dtype` and *then* to `device` to
@@ -26,6 +37,10 @@ class EncodingSampler:
         def single_apply(encodes):
             if encodes is None:
                 return None
+            elif isinstance(encodes, CompressedTensor):
+                return encodes.blend(raw_coefs)
+            elif len(encodes.shape) == 4: # i.e. latents [N, C, H, W]
+                return (coefs[:,None,None,None] * encodes).sum(0)
             elif len(encodes.shape) == 3:
                 return (coefs[:,None,None] * encodes).sum(0)
             elif len(encodes.shape) == 2:
@@ -0,0 +1,115 @@
+"""
+Render latency telemetry: a rolling window of recent renders with per-stage timings, percentiles and CSV export
+"""
+
+import csv
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+class StageTimer:
+    """
+    Times named stages of one render. Synchronizes cuda around each stage so the times are the device's
+
+    :param device: Device the stages run on
+    """
+    def __init__(self, device = None):
+        self.sync = torch.device(device).type == "cuda" if device is not None else False
+        self.stages : Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name):
+        if self.sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        yield
+        if self.sync:
+            torch.cuda.synchronize()
+        self.stages[name] = self.stages.get(name, 0.) + (time.perf_counter() - start) * 1000
+
+class LatencyStats:
+    """
+    Latency (ms) of the last `window` renders, with the tier and per-stage times of each
+
+    :param window: Number of renders to keep
+    """
+    def __init__(self, window : int = 120):
+        self.records = deque(maxlen = window)
+        self.version = 0 # Bumped on every record, i.e. to know when a HUD needs redrawing
+
+    def __len__(self):
+        return len(self.records)
+
+    def record(self, ms : float, tier : str = "full", stages : Optional[Dict[str, float]] = None):
+        self.records.append({"time" : time.time(), "tier" : tier, "total" : ms, **(stages or {})})
+        self.version += 1
+
+    def values(self, tier : Optional[str] = None, stage : str = "total") -> np.ndarray:
+        """
+        Times (ms) in the window, optionally for one tier only. stage is "total" or a stage name
+        """
+        return np.array([r[stage] for r in self.records if (tier is None or r["tier"] == tier) and stage in r])
+
+    def percentile(self, q : float, tier : Optional[str] = None, stage : str = "total") -> Optional[float]:
+        values = self.values(tier, stage)
+        return float(np.percentile(values, q)) if len(values) else None
+
+    @property
+    def tiers(self) -> List[str]:
+        return list(dict.fromkeys(r["tier"] for r in self.records))
+
+    @property
+    def stages(self) -> List[str]:
+        return list(dict.fromkeys(k for r in self.records for k in r if k not in ("time", "tier", "total")))
+
+    def summary(self) -> Dict[str, dict]:
+        """
+        Per tier: number of renders, mean/p50/p95 of the total and p50 of each stage
+        """
+        res = {}
+        for tier in self.tiers:
+            total = self.values(tier)
+            res[tier] = {
+                "n" : len(total),
+                "mean" : float(total.mean()),
+                "p50" : float(np.percentile(total, 50)),
+                "p95" : float(np.percentile(total, 95)),
+                "stages" : {stage : self.percentile(50, tier, stage) for stage in self.stages if len(self.values(tier, stage))},
+            }
+        return res
+
+    def lines(self) -> List[str]:
+        """
+        Summary as short text lines, for an on-screen overlay
+        """
+        res = []
+        for tier, stats in self.summary().items():
+            res.append(f"{tier}: p50 {stats['p50']:.0f} ms  p95 {stats['p95']:.0f} ms  (n={stats['n']})")
+            if stats["stages"]:
+                res.append("  " + "  ".join(f"{stage} {ms:.0f}" for stage, ms in stats["stages"].items()))
+        return res
+
+    def to_csv(self, path : str):
+        """
+        Write every render in the window as a row: time, tier, total and each stage (ms)
+        """
+        columns = ["time", "tier", "total"] + self.stages
+        with open(path, "w", newline = "") as f:
+            writer = csv.DictWriter(f, fieldnames = columns)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+def adaptive_interval(stats : LatencyStats, tier : Optional[str] = None, min_ms : float = 0., max_ms : float = 1000.) -> Optional[float]:
+    """
+    Render interval (ms) from measured latency: halfway between p50 and p95, so typical renders aren't
+    waited on but slow tails don't pile up. None until there are measurements.
+    """
+    p50 = stats.percentile(50, tier)
+    if p50 is None:
+        return None
+    p95 = stats.percentile(95, tier)
+    return float(np.clip(p50 + 0.5 * (p95 - p50), min_ms, max_ms))
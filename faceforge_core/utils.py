@@ -2,6 +2,8 @@ import random
 import math
 import torch
 
+from .encoding_compression import CompressedTensor
+
 def random_circle_init(min_r : float = 0.5, on_edge : bool = False):
     theta = random.uniform(0, 2 * math.pi)
     if on_edge:
@@ -24,7 +26,7 @@ def recursive_find_dtype(x):
                 continue
             else:
                 return res
-        elif isinstance(i, torch.Tensor):
+        elif isinstance(i, (torch.Tensor, CompressedTensor)):
             return i.dtype
 
 def recursive_find_device(x):
@@ -37,5 +39,5 @@ def recursive_find_device(x):
             if res is None:
                 continue
             return res
-        elif isinstance(i, torch.Tensor):
+        elif isinstance(i, (torch.Tensor, CompressedTensor)):
             return i.device
@@ -0,0 +1,193 @@
+"""
+Pooled HTTP client for a remote FaceForge API
+
+One client per API URL keeps connections alive between clicks, so remote deployments don't pay TCP/TLS setup
+per request. Requests ask for a binary image body instead of base64 JSON, use separate connect and read timeouts,
+and retry transient failures (connection errors, timeouts, 502/503/504) a bounded number of times with jittered
+exponential backoff. Non-idempotent requests (POST /generate, POST /datasets) are only retried when they can't have
+reached the API: failed connections and 503s. A read timeout may mean the server is still working on them.
+"""
+
+import io
+import os
+import base64
+import weakref
+import time
+import random
+import asyncio
+import logging
+
+import httpx
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger("faceforge_ui")
+
+CONNECT_TIMEOUT = float(os.environ.get("API_CONNECT_TIMEOUT", "3"))
+READ_TIMEOUT = float(os.environ.get("API_READ_TIMEOUT", "30"))
+RETRIES = int(os.environ.get("API_RETRIES", "2"))
+MAX_CONNECTIONS = int(os.environ.get("API_MAX_CONNECTIONS", "10"))
+RESPONSE_FORMAT = os.environ.get("API_RESPONSE_FORMAT", "png") # "png", "raw" or "json"
+
+RETRY_STATUS = (502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+# Failures before the request was sent, safe to retry for any method
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+class ApiError(Exception):
+    """
+    The API answered with an error status
+    """
+    def __init__(self, status_code, text):
+        super().__init__(f"API error: {status_code}")
+        self.status_code = status_code
+        self.text = text
+
+def decode_image(resp: httpx.Response) -> np.ndarray:
+    """
+    (H, W, 3) uint8 array from a /generate response in any of its formats
+    """
+    content_type = resp.headers.get("content-type", "")
+    if content_type.startswith("application/octet-stream"):
+        shape = tuple(int(d) for d in resp.headers["x-image-shape"].split(","))
+        return np.frombuffer(resp.content, dtype=np.uint8).reshape(shape)
+    if content_type.startswith("application/json"):
+        data = resp.json()
+        if "image" not in data:
+            raise ValueError("No image in API response")
+        content = base64.b64decode(data["image"])
+    else:
+        content = resp.content
+    return np.array(Image.open(io.BytesIO(content)).convert("RGB"))
+
+class ApiClient:
+    """
+    Sync and async access to a remote API over pooled keep-alive connections
+
+    :param base_url: API root, i.e. http://host:8000 or https://host/api
+    :param connect_timeout: Seconds to establish a connection
+    :param read_timeout: Seconds to wait for the response, generation included
+    :param retries: Extra attempts after a transient failure
+    :param backoff: Base delay (s) of the exponential backoff, each delay is drawn uniformly up to base * 2 ** attempt
+    :param max_connections: Connections kept per client
+    :param response_format: Response format asked from /generate
+    :param client_kwargs: Extra arguments for the httpx clients, i.e. a transport
+    """
+    def __init__(self, base_url, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, retries=RETRIES,
+                 backoff=0.2, max_connections=MAX_CONNECTIONS, response_format=RESPONSE_FORMAT, **client_kwargs):
+        self.base_url = base_url.rstrip("/")
+        self.retries = retries
+        self.backoff = backoff
+        self.response_format = response_format
+        self.client_kwargs = dict(
+            base_url=self.base_url,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            **client_kwargs,
+        )
+        self.client = httpx.Client(**self.client_kwargs)
+        self.async_clients = weakref.WeakKeyDictionary() # One per event loop, async clients can't be shared between loops
+
+    def delay(self, attempt):
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    def should_retry(self, method, attempt, error=None, resp=None):
+        if attempt >= self.retries:
+            return False
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        if error is not None:
+            return isinstance(error, httpx.TransportError if idempotent else CONNECT_ERRORS)
+        return resp.status_code in RETRY_STATUS if idempotent else resp.status_code == 503
+
+    def request(self, method, path, **kwargs) -> httpx.Response:
+        attempt = 0
+        while True:
+            try:
+                resp = self.client.request(method, path, **kwargs)
+            except httpx.HTTPError as e:
+                if not self.should_retry(method, attempt, error=e):
+                    raise
+                logger.warning(f"{method} {path} failed ({e}), retrying")
+            else:
+                if not self.should_retry(method, attempt, resp=resp):
+                    return resp
+                logger.warning(f"{method} {path} returned {resp.status_code}, retrying")
+            time.sleep(self.delay(attempt))
+            attempt += 1
+
+    def async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self.async_clients.get(loop)
+        if client is None:
+            client = self.async_clients[loop] = httpx.AsyncClient(**self.client_kwargs)
+        return client
+
+    async def arequest(self, method, path, **kwargs) -> httpx.Response:
+        client = self.async_client()
+        attempt = 0
+        while True:
+            try:
+                resp = await client.request(method, path, **kwargs)
+            except httpx.HTTPError as e:
+                if not self.should_retry(method, attempt, error=e):
+                    raise
+                logger.warning(f"{method} {path} failed ({e}), retrying")
+            else:
+                if not self.should_retry(method, attempt, resp=resp):
+                    return resp
+                logger.warning(f"{method} {path} returned {resp.status_code}, retrying")
+            await asyncio.sleep(self.delay(attempt))
+            attempt += 1
+
+    def generate_request(self, prompts, mode="distance", player_pos=None, preview=False, edits=None):
+        body = {"prompts": prompts, "mode": mode, "player_pos": player_pos, "preview": preview}
+        if edits:
+            body["edits"] = [{"id": direction_id, "alpha": alpha} for direction_id, alpha in edits]
+        return dict(json=body, params={"format": self.response_format})
+
+    @staticmethod
+    def image(resp) -> np.ndarray:
+        if not resp.is_success:
+            raise ApiError(resp.status_code, resp.text[:500])
+        return decode_image(resp)
+
+    def generate(self, prompts, mode="distance", player_pos=None, preview=False, edits=None) -> np.ndarray:
+        """
+        /generate, returns the image as an (H, W, 3) uint8 array.
+        edits: [(direction id, alpha)] of directions in the API's registry, applied to the blended encoding
+        """
+        return self.image(self.request("POST", "/generate", **self.generate_request(prompts, mode, player_pos, preview, edits)))
+
+    async def agenerate(self, prompts, mode="distance", player_pos=None, preview=False, edits=None) -> np.ndarray:
+        return self.image(await self.arequest("POST", "/generate", **self.generate_request(prompts, mode, player_pos, preview, edits)))
+
+    def close(self):
+        self.client.close()
+
+    async def aclose(self):
+        """
+        Close the async client of the running event loop
+        """
+        client = self.async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+clients = {}
+
+def get_client(base_url) -> ApiClient:
+    """
+    Shared client for an API URL
+    """
+    client = clients.get(base_url)
+    if client is None:
+        client = clients[base_url] = ApiClient(base_url)
+    return client
+
+async def close_clients():
+    """
+    Close the shared clients' connections. Register on shutdown of the server whose event loop the UI runs on
+    """
+    for client in clients.values():
+        await client.aclose()
+        client.close()
+    clients.clear()
@@ -1,14 +1,18 @@
 import gradio as gr
-import requests
+import httpx
 import numpy as np
 from PIL import Image
-import io
-import base64
 import logging
 import sys
 import traceback
 import os
 import json
+import asyncio
+
+try:
+    from faceforge_ui.api_client import ApiError, get_client
+except ImportError: # Run as a script from inside faceforge_ui/
+    from api_client import ApiError, get_client
 
 # Configure logging
 logging.basicConfig(
@@ -30,10 +34,29 @@ BASE_URL = os.environ.get("BASE_URL", "http://localhost:7860")
 logger.info(f"Using API URL: {API_URL}")
 logger.info(f"Using BASE URL: {BASE_URL}")
 
-def generate_image(prompts, mode, player_x, player_y):
-    """Generate an image based on prompts and player position."""
+# Live slider updates: events wait this long and are dropped if a newer one arrived in the meantime
+LIVE_DEBOUNCE_MS = int(os.environ.get("LIVE_DEBOUNCE_MS", "100"))
+# Generations running at once across all users, and requests allowed to wait in the queue
+QUEUE_CONCURRENCY = int(os.environ.get("QUEUE_CONCURRENCY", "1"))
+QUEUE_MAX_SIZE = int(os.environ.get("QUEUE_MAX_SIZE", "16"))
+
+# Generation service of an API mounted in the same process (see use_local_api). None calls API_URL over HTTP
+local_generate = None
+
+def use_local_api(generate_fn):
+    """
+    Call a co-located API's generation service directly instead of posting to API_URL.
+    main.py and app.py register faceforge_api.main.generate when they mount the API next to the UI.
+    Pass None to go back to HTTP.
+    """
+    global local_generate
+    local_generate = generate_fn
+    logger.info("Using in-process API" if generate_fn is not None else f"Using API over HTTP at {API_URL}")
+
+async def generate_image(prompts, mode, player_x, player_y, preview=False):
+    """Generate an image based on prompts and player position. preview asks for the fast approximate render."""
     try:
-        logger.debug(f"Generating image with prompts: {prompts}, mode: {mode}, position: ({player_x}, {player_y})")
+        logger.debug(f"Generating image with prompts: {prompts}, mode: {mode}, position: ({player_x}, {player_y}), preview: {preview}")
         
         # Parse prompts
         prompt_list = [p.strip() for p in prompts.split(",") if p.strip()]
@@ -45,7 +68,8 @@ def generate_image(prompts, mode, player_x, player_y):
         req = {
             "prompts": prompt_list,
             "mode": mode,
-            "player_pos": [float(player_x), float(player_y)]
+            "player_pos": [float(player_x), float(player_y)],
+            "preview": preview
         }
         
         logger.debug(f"Request payload: {json.dumps(req)}")
@@ -58,58 +82,32 @@ def generate_image(prompts, mode, player_x, player_y):
                 # Create a test image
                 img = Image.new("RGB", (256, 256), (int(player_x*128)+128, 100, int(player_y*128)+128))
                 return img, "Image generated using mock API"
+
+            # Co-located API: call it directly, the uint8 array goes straight to gr.Image
+            if local_generate is not None:
+                logger.debug("Calling in-process API")
+                img = await asyncio.to_thread(local_generate, prompt_list, mode=mode, player_pos=req["player_pos"], preview=preview)
+                return img, "Image generated successfully"
                 
             # Determine the base URL for the API
             if API_URL.startswith("/"):
                 # Relative URL, construct the full URL with the base URL
                 # Note: BASE_URL should NOT have a trailing slash
-                full_url = f"{BASE_URL}{API_URL}/generate"
-                logger.debug(f"Constructed full URL: {full_url}")
+                base_url = f"{BASE_URL}{API_URL}"
+                logger.debug(f"Constructed base URL: {base_url}")
             else:
                 # Absolute URL, use as is
-                full_url = f"{API_URL}/generate"
+                base_url = API_URL
             
-            logger.debug(f"Making request to: {full_url}")
-            resp = requests.post(full_url, json=req, timeout=30)
-            logger.debug(f"API response status: {resp.status_code}")
-            
-            if resp.ok:
-                try:
-                    data = resp.json()
-                    logger.debug(f"API response structure: {list(data.keys())}")
-                    
-                    if "image" in data:
-                        img_b64 = data["image"]
-                        logger.debug(f"Image base64 length: {len(img_b64)}")
-                        img_bytes = base64.b64decode(img_b64)
-                        
-                        try:
-                            # For testing, create a simple colored image if decode fails
-                            try:
-                                img = Image.open(io.BytesIO(img_bytes))
-                                logger.debug(f"Image decoded successfully: {img.size} {img.mode}")
-                            except Exception as e:
-                                logger.error(f"Failed to decode image from bytes: {e}, creating test image")
-                                # Fallback to create a test image
-                                img = Image.new("RGB", (256, 256), (int(player_x*128)+128, 100, int(player_y*128)+128))
-                                
-                            return img, "Image generated successfully"
-                        except Exception as e:
-                            logger.error(f"Error processing image: {e}")
-                            logger.debug(traceback.format_exc())
-                            return None, f"Error processing image: {str(e)}"
-                    else:
-                        logger.warning("No image field in API response")
-                        return None, "No image in API response"
-                except Exception as e:
-                    logger.error(f"Error parsing API response: {e}")
-                    logger.debug(f"Raw response: {resp.text[:500]}")
-                    return None, f"Error parsing API response: {str(e)}"
-            else:
-                logger.error(f"API error: {resp.status_code}, {resp.text[:500]}")
-                return None, f"API error: {resp.status_code}"
-                
-        except requests.exceptions.RequestException as e:
+            logger.debug(f"Making request to: {base_url}/generate")
+            img = await get_client(base_url).agenerate(prompt_list, mode=mode, player_pos=req["player_pos"], preview=preview)
+            logger.debug(f"Image decoded successfully: {img.shape}")
+            return img, "Image generated successfully"
+
+        except ApiError as e:
+            logger.error(f"API error: {e.status_code}, {e.text}")
+            return None, f"API error: {e.status_code}"
+        except httpx.HTTPError as e:
             logger.error(f"Request failed: {e}")
             # Fall back to a test image
             logger.debug("Falling back to test image")
@@ -121,6 +119,50 @@ def generate_image(prompts, mode, player_x, player_y):
         logger.debug(traceback.format_exc())
         return None, f"Error: {str(e)}"
 
+# Newest live event per session, so debounced events can tell they were superseded.
+# Handlers run on Gradio's event loop, so no lock is needed. Entries are dropped when the session ends
+live_events = {}
+
+async def debounce(live, request: gr.Request):
+    """
+    First step of a slider event, outside the generation slot: wait LIVE_DEBOUNCE_MS.
+    Returns the event's id for the render step, None if live updates are off or a newer event arrived in the meantime
+    """
+    if not live:
+        return None
+    session = request.session_hash if request else None
+    event_id = live_events.get(session, 0) + 1
+    live_events[session] = event_id
+    await asyncio.sleep(LIVE_DEBOUNCE_MS / 1000)
+    return event_id if live_events.get(session) == event_id else None
+
+def end_session(request: gr.Request):
+    """
+    Forget a closed session's live events
+    """
+    live_events.pop(request.session_hash if request else None, None)
+
+async def live_update(prompts, mode, player_x, player_y, event_id, request, preview):
+    """
+    Render step of a slider event, unless the debounce dropped it or a newer event arrived while it waited for the slot
+    """
+    session = request.session_hash if request else None
+    if event_id is None or live_events.get(session) != event_id:
+        return gr.skip(), gr.skip()
+    return await generate_image(prompts, mode, player_x, player_y, preview=preview)
+
+async def live_generate(prompts, mode, player_x, player_y, event_id, request: gr.Request):
+    """
+    Slider moved: fast preview render
+    """
+    return await live_update(prompts, mode, player_x, player_y, event_id, request, preview=True)
+
+async def live_release(prompts, mode, player_x, player_y, event_id, request: gr.Request):
+    """
+    Slider released: full render at the final position
+    """
+    return await live_update(prompts, mode, player_x, player_y, event_id, request, preview=False)
+
 # Create a simplified Gradio interface to avoid schema issues
 # Use basic components without custom schemas
 def create_demo():
@@ -155,18 +197,44 @@ def create_demo():
                     label="Player Y"
                 )
                 
+                live_input = gr.Checkbox(value=True, label="Live update while dragging")
                 generate_btn = gr.Button("Generate")
                 
             with gr.Column(scale=5):
                 output_image = gr.Image(label="Generated Image")
                 output_status = gr.Textbox(label="Status")
                 
-        generate_btn.click(
-            fn=generate_image,
-            inputs=[prompts_input, mode_input, player_x_input, player_y_input],
-            outputs=[output_image, output_status]
-        )
-        
+        inputs = [prompts_input, mode_input, player_x_input, player_y_input]
+        outputs = [output_image, output_status]
+        # All generation events share one concurrency limit, so live updates can't starve clicks
+        event_kwargs = dict(concurrency_limit=QUEUE_CONCURRENCY, concurrency_id="generate")
+
+        generate_btn.click(fn=generate_image, inputs=inputs, outputs=outputs, **event_kwargs)
+
+        # Live updates: the debounce runs in a group of its own, so a session waiting on it doesn't hold the
+        # generation slot other sessions need; only the render step after it queues for that slot.
+        # always_last drops queued events for a slider except the newest,
+        # and releasing the slider cancels a render still running for an older position
+        # Ids pass through a hidden component rather than gr.State, so each render step gets the id of its own
+        # debounce step in its payload instead of reading whatever the newest event left in the session state
+        live_event = gr.Number(visible=False, precision=0)
+        debounce_kwargs = dict(concurrency_limit=None, concurrency_id="debounce", show_progress="hidden")
+        for slider in (player_x_input, player_y_input):
+            change_debounce = slider.change(
+                fn=debounce, inputs=[live_input], outputs=[live_event], trigger_mode="always_last", **debounce_kwargs
+            )
+            change = change_debounce.then(
+                fn=live_generate, inputs=inputs + [live_event], outputs=outputs, show_progress="hidden", **event_kwargs
+            )
+            slider.release(
+                fn=debounce, inputs=[live_input], outputs=[live_event], cancels=[change_debounce, change],
+                trigger_mode="always_last", **debounce_kwargs
+            ).then(
+                fn=live_release, inputs=inputs + [live_event], outputs=outputs, show_progress="hidden", **event_kwargs
+            )
+        demo.unload(end_session)
+
+    demo.queue(max_size=QUEUE_MAX_SIZE, default_concurrency_limit=QUEUE_CONCURRENCY)
     return demo
 
 # Only start if this file is run directly, not when imported
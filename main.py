@@ -34,16 +34,24 @@ def main():
         
         # Set up FastAPI application with both API and UI
         logger.info("Setting up FastAPI application with API and UI")
+        from contextlib import asynccontextmanager
         from fastapi import FastAPI
         from fastapi.middleware.cors import CORSMiddleware
         import gradio as gr
         
         # Import the API and UI components
-        from faceforge_api.main import app as api_app
-        from faceforge_ui.app import create_demo
+        from faceforge_api.main import app as api_app, generate
+        from faceforge_ui.app import create_demo, use_local_api
+        from faceforge_ui.api_client import close_clients
         
+        # Close the UI's pooled connections to a remote API on shutdown, they live on this server's event loop
+        @asynccontextmanager
+        async def lifespan(app):
+            yield
+            await close_clients()
+
         # Create a new FastAPI application that will serve as the main app
-        app = FastAPI(title="FaceForge")
+        app = FastAPI(title="FaceForge", lifespan=lifespan)
         
         # Add CORS middleware
         app.add_middleware(
@@ -57,6 +65,10 @@ def main():
         # Mount the API under /api
         logger.info("Mounting API at /api")
         app.mount("/api", api_app)
+
+        # The UI calls the mounted API in process, skipping loopback HTTP and PNG/base64 encoding
+        if os.environ.get("LOCAL_API", "true").lower() == "true":
+            use_local_api(generate)
         
         # Create Gradio UI
         logger.info("Creating Gradio UI")
@@ -0,0 +1,115 @@
+import asyncio
+import io
+import unittest
+import httpx
+import numpy as np
+from PIL import Image
+from faceforge_api.main import app as api_app
+from faceforge_ui.api_client import ApiClient, ApiError, clients, close_clients
+
+def png(image):
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format = "PNG")
+    return buffer.getvalue()
+
+class TestApiClient(unittest.TestCase):
+    def setUp(self):
+        self.image = np.random.default_rng(0).integers(0, 255, (4, 6, 3), dtype = np.uint8)
+        self.requests = []
+        self.responses = []
+
+    def handler(self, request):
+        self.requests.append(request)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def client(self, **kwargs):
+        return ApiClient("http://api", backoff = 0, transport = httpx.MockTransport(self.handler), **kwargs)
+
+    def test_binary_png(self):
+        self.responses = [httpx.Response(200, content = png(self.image), headers = {"content-type" : "image/png"})]
+        res = self.client().generate(["a"], player_pos = [0., 1.])
+        self.assertTrue((res == self.image).all())
+        self.assertEqual(self.requests[0].url.params["format"], "png")
+
+    def test_retries_transient_failures(self):
+        self.responses = [
+            httpx.ConnectError("refused"), httpx.Response(503),
+            httpx.Response(200, content = png(self.image), headers = {"content-type" : "image/png"}),
+        ]
+        self.assertTrue((self.client().generate(["a"]) == self.image).all())
+        self.assertEqual(len(self.requests), 3)
+
+    def test_retries_bounded(self):
+        self.responses = [httpx.Response(503)] * 3
+        with self.assertRaises(ApiError) as ctx:
+            self.client(retries = 2).generate(["a"])
+        self.assertEqual(ctx.exception.status_code, 503)
+        self.assertEqual(len(self.requests), 3)
+
+    def test_no_retry_on_app_errors(self):
+        self.responses = [httpx.Response(500, text = "boom")]
+        with self.assertRaises(ApiError):
+            self.client().generate(["a"])
+        self.assertEqual(len(self.requests), 1)
+
+    def test_no_retry_once_posted(self):
+        # The API may still be rendering (or appending) a POST that timed out or went through a gateway error
+        for failure in (httpx.ReadTimeout("slow"), httpx.Response(504)):
+            self.requests, self.responses = [], [failure, httpx.Response(200)]
+            with self.assertRaises((httpx.ReadTimeout, ApiError)):
+                self.client().generate(["a"])
+            self.assertEqual(len(self.requests), 1)
+
+        # Idempotent requests are retried
+        self.requests, self.responses = [], [httpx.ReadTimeout("slow"), httpx.Response(504), httpx.Response(200)]
+        self.assertEqual(self.client().request("GET", "/directions").status_code, 200)
+        self.assertEqual(len(self.requests), 3)
+
+    def test_async(self):
+        self.responses = [httpx.ConnectTimeout("slow"), httpx.Response(200, content = png(self.image), headers = {"content-type" : "image/png"})]
+        res = asyncio.run(self.client().agenerate(["a"]))
+        self.assertTrue((res == self.image).all())
+
+        self.requests, self.responses = [], [httpx.ReadTimeout("slow"), httpx.Response(200)]
+        with self.assertRaises(httpx.ReadTimeout):
+            asyncio.run(self.client().agenerate(["a"]))
+        self.assertEqual(len(self.requests), 1)
+
+    def test_close_clients(self):
+        self.responses = [httpx.Response(200, content = png(self.image), headers = {"content-type" : "image/png"})]
+        client = clients["http://api"] = self.client()
+        async def generate_then_close():
+            await client.agenerate(["a"])
+            async_client = client.async_client()
+            await close_clients()
+            return async_client
+        self.assertTrue(asyncio.run(generate_then_close()).is_closed)
+        self.assertTrue(client.client.is_closed)
+        self.assertEqual((len(client.async_clients), len(clients)), (0, 0))
+
+    def test_timeouts(self):
+        client = ApiClient("http://api", connect_timeout = 1.5, read_timeout = 20)
+        self.assertEqual(client.client.timeout.connect, 1.5)
+        self.assertEqual(client.client.timeout.read, 20)
+
+class TestResponseFormats(unittest.TestCase):
+    def generate(self, response_format):
+        client = ApiClient("http://api", response_format = response_format, transport = httpx.ASGITransport(app = api_app))
+        return asyncio.run(client.agenerate(["a cat", "a dog"], player_pos = [0., 0.]))
+
+    def test_formats(self):
+        for response_format in ("json", "png", "raw"):
+            image = self.generate(response_format)
+            self.assertEqual(image.dtype, np.uint8)
+            self.assertEqual(image.shape, (256, 256, 3))
+
+    def test_unknown_format(self):
+        with self.assertRaises(ApiError) as ctx:
+            self.generate("gif")
+        self.assertEqual(ctx.exception.status_code, 400)
+
+if __name__ == "__main__":
+    unittest.main()
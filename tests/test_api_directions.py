@@ -0,0 +1,250 @@
+import asyncio
+import io
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import httpx
+import numpy as np
+import torch
+import faceforge_api.main as api
+from faceforge_core.direction_registry import DirectionRegistry
+from faceforge_core.fast_sd import TINY_MODEL_ID
+
+def request(method, path, **kwargs):
+    async def send():
+        async with httpx.AsyncClient(transport = httpx.ASGITransport(app = api.app), base_url = "http://api") as client:
+            return await client.request(method, path, **kwargs)
+    return asyncio.run(send())
+
+class TestAttributeDirectionApi(unittest.TestCase):
+    def post(self, body):
+        return request("POST", "/attribute_direction", json = body)
+
+    def test_label_matrix(self):
+        latents = [[0., 1.], [1., 0.], [1., 1.], [0., 0.]]
+        resp = self.post({"latents" : latents, "label_matrix" : [[0, 1], [1, 0], [1, 1], [0, 0]], "solver" : "lda"})
+        self.assertEqual(resp.status_code, 200)
+        directions = np.array(resp.json()["directions"])
+        self.assertEqual(directions.shape, (2, 2))
+        self.assertTrue((np.argmax(directions, axis = 1) == [0, 1]).all())
+
+    def test_bad_requests(self):
+        latents = [[0., 1.], [1., 0.]]
+        self.assertEqual(self.post({"latents" : latents, "label_matrix" : [[0], [1], [1]]}).status_code, 400)
+        self.assertEqual(self.post({"latents" : latents, "labels" : [0, 1], "label_matrix" : [[0], [1]]}).status_code, 400)
+        self.assertEqual(self.post({"latents" : latents, "labels" : [1, 1], "solver" : "mean_diff"}).status_code, 400)
+        self.assertEqual(self.post({"latents" : latents, "labels" : [0, 1], "solver" : "svm"}).status_code, 400)
+        self.assertEqual(self.post({"latents" : [], "label_matrix" : []}).status_code, 400)
+
+class TestGenerateService(unittest.TestCase):
+    def test_concurrent_calls_keep_their_points(self):
+        # Each call's encodings and positions must stay paired, however calls interleave
+        def encode_prompts(pipe, prompts):
+            return [(torch.full((1, 2), float(prompt)), None, torch.zeros(1, 1), None) for prompt in prompts]
+
+        def render(pipe, encodings, positions, *args, **kwargs):
+            time.sleep(0.001)
+            return np.array([[e[0][0, 0].item(), p[0]] for e, p in zip(encodings, positions)])
+
+        def call(i):
+            prompts = [str(i), str(i + 1000)]
+            return i, api.generate(prompts, positions=[[i, 0.], [i + 1000, 0.]])
+
+        with mock.patch.object(api, "get_pipeline", return_value = object()), \
+                mock.patch.object(api, "encode_prompts", encode_prompts), mock.patch.object(api, "render", render):
+            with ThreadPoolExecutor(max_workers = 8) as pool:
+                results = list(pool.map(call, range(64)))
+        for i, pairs in results:
+            self.assertEqual(pairs.tolist(), [[i, i], [i + 1000, i + 1000]])
+
+    def test_render_off_event_loop(self):
+        # Other requests are served while a render runs: the render waits for one to finish
+        started, served, waits = threading.Event(), threading.Event(), []
+        def generate(*args, **kwargs):
+            started.set()
+            waits.append(served.wait(5))
+            return np.zeros((8, 8, 3), dtype = np.uint8)
+
+        async def requests():
+            async with httpx.AsyncClient(transport = httpx.ASGITransport(app = api.app), base_url = "http://api") as client:
+                render = asyncio.create_task(client.post("/generate", json = {"prompts" : ["a cat"]}))
+                while not started.is_set() and not render.done():
+                    await asyncio.sleep(0.01)
+                self.assertEqual((await client.get("/")).status_code, 200)
+                served.set()
+                return await render
+
+        with mock.patch.object(api, "generate", generate):
+            self.assertEqual(asyncio.run(requests()).status_code, 200)
+        self.assertEqual(waits, [True])
+
+    def test_pipeline_loaded_once(self):
+        def load(**kwargs):
+            time.sleep(0.05)
+            return object()
+
+        with mock.patch.object(api, "MODEL_ID", TINY_MODEL_ID), mock.patch.object(api, "pipe", None), \
+                mock.patch.object(api, "anchor_latents", None), mock.patch.object(api, "AnchorLatentCache"), \
+                mock.patch("faceforge_core.fast_diffusion_pipeline", side_effect = load) as loader:
+            with ThreadPoolExecutor(max_workers = 8) as pool:
+                pipes = list(pool.map(lambda _: api.get_pipeline(), range(8)))
+        self.assertEqual(loader.call_count, 1)
+        self.assertEqual(len({id(p) for p in pipes}), 1)
+
+class TestDirectionRegistryApi(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.registry = DirectionRegistry(self.tmp.name)
+        patcher = mock.patch.object(api, "direction_registry", self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp.cleanup)
+        self.rng = np.random.default_rng(0)
+
+    def test_register_fitted(self):
+        latents = self.rng.standard_normal((40, 6))
+        labels = (latents[:, 0] > 0).astype(int).tolist()
+        resp = request("POST", "/attribute_direction", json = {"latents" : latents.tolist(), "labels" : labels, "solver" : "lda",
+                                                               "store" : True, "names" : ["first"]})
+        self.assertEqual(resp.json()["direction_ids"], ["first"])
+        meta = request("GET", "/directions/first", params = {"values" : True}).json()
+        self.assertEqual((meta["solver"], meta["dim"]), ("lda", 6))
+        self.assertEqual(meta["dataset_hash"], api.dataset_hash(np.array(latents.tolist())))
+        self.assertTrue(0 < meta["explained_variance"] < 1)
+        self.assertTrue(np.allclose(meta["direction"], resp.json()["direction"], atol = 1e-6))
+
+        resp = request("POST", "/attribute_direction", json = {"latents" : latents.tolist(), "n_components" : 3, "store" : True})
+        self.assertEqual(len(resp.json()["direction_ids"]), 3)
+        self.assertEqual(len(request("GET", "/directions").json()["directions"]), 4)
+        self.assertEqual(request("GET", "/directions/missing").status_code, 404)
+
+    def test_manipulate_fused(self):
+        a, b = self.rng.standard_normal(4), self.rng.standard_normal(4)
+        self.registry.register(a, "a")
+        self.registry.register(b, "b")
+        encoding = self.rng.standard_normal(4)
+        resp = request("POST", "/manipulate", json = {"encoding" : encoding.tolist(), "direction_id" : "a", "alpha" : 2,
+                                                      "edits" : [{"id" : "b", "alpha" : -1}], "direction" : [1, 0, 0, 0]})
+        expected = encoding + 2 * a / np.linalg.norm(a) - b / np.linalg.norm(b) + [2, 0, 0, 0]
+        self.assertTrue(np.allclose(resp.json()["manipulated_encoding"], expected, atol = 1e-5))
+
+        self.assertEqual(request("POST", "/manipulate", json = {"encoding" : encoding.tolist(), "direction_id" : "c"}).status_code, 404)
+        self.assertEqual(request("POST", "/manipulate", json = {"encoding" : [0., 1.], "direction_id" : "a"}).status_code, 400)
+        self.assertEqual(request("POST", "/manipulate", json = {"encoding" : [0., 1.]}).status_code, 400)
+
+    def test_registry_unavailable(self):
+        # In process callers (the UI) get a plain error, the endpoints map it to 501
+        with mock.patch.object(api, "direction_registry", None):
+            with self.assertRaises(api.RegistryUnavailable):
+                api.generate(["a cat"], edits = [("a", 1.0)])
+            resp = request("POST", "/manipulate", json = {"encoding" : [0., 1.], "direction_id" : "a"})
+            self.assertEqual(resp.status_code, 501)
+            resp = request("POST", "/generate", json = {"prompts" : ["a cat"], "edits" : [{"id" : "a", "alpha" : 1}]})
+            self.assertEqual(resp.status_code, 501)
+
+    def test_shift_encoding(self):
+        encoding = (torch.zeros(1, 3, 2), None, torch.zeros(1, 2), None)
+        pooled = api.shift_encoding(encoding, np.array([1., 2.]))
+        self.assertTrue(torch.equal(pooled[2], torch.tensor([[1., 2.]])))
+        self.assertTrue(torch.equal(pooled[0], encoding[0]))
+        both = api.shift_encoding(encoding, np.arange(8.))
+        self.assertTrue(torch.equal(both[0].flatten(), torch.arange(6.)))
+        self.assertTrue(torch.equal(both[2].flatten(), torch.tensor([6., 7.])))
+        with self.assertRaises(ValueError):
+            api.shift_encoding(encoding, np.zeros(5))
+
+    def test_generate_with_edits(self):
+        model_id, pipe, anchor_latents = api.MODEL_ID, api.pipe, api.anchor_latents
+        api.MODEL_ID, api.pipe = TINY_MODEL_ID, None
+        try:
+            tiny = api.get_pipeline()
+            pooled_dim = tiny.text_encoder_2.config.projection_dim
+            direction_id = self.registry.register(self.rng.standard_normal(pooled_dim))
+            prompts = ["A photo of a cat", "A photo of a dog"]
+            with mock.patch.object(tiny, "generate_from_encodes", wraps = tiny.generate_from_encodes) as render:
+                plain = api.generate(prompts, player_pos = [0.2, 0.1])
+                edited = api.generate(prompts, player_pos = [0.2, 0.1], preview = True, edits = [(direction_id, 2.0)])
+            self.assertEqual(edited.shape, plain.shape)
+            (plain_encoding,), (edited_encoding,) = (call.args for call in render.call_args_list) # Edited previews render in full
+            shift = (edited_encoding[2] - plain_encoding[2]).flatten().numpy()
+            self.assertTrue(np.allclose(shift, 2 * self.registry.get(direction_id), atol = 1e-5))
+            self.assertTrue(torch.equal(edited_encoding[0], plain_encoding[0]))
+            resp = request("POST", "/generate", json = {"prompts" : prompts, "edits" : [{"id" : "missing", "alpha" : 1}]})
+            self.assertEqual(resp.status_code, 404)
+        finally:
+            api.MODEL_ID, api.pipe, api.anchor_latents = model_id, pipe, anchor_latents
+
+class TestDatasetApi(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        for name, value in (("DATASET_DIR", self.tmp.name), ("direction_registry", DirectionRegistry(self.tmp.name + "/directions"))):
+            patcher = mock.patch.object(api, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp.cleanup)
+        rng = np.random.default_rng(0)
+        self.latents = rng.standard_normal((60, 5))
+        self.labels = (self.latents[:, :2] > 0).astype(int)
+
+    def upload(self, name, **arrays):
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        return request("POST", f"/datasets/{name}", content = buffer.getvalue())
+
+    def test_upload_and_fit(self):
+        self.assertEqual(self.upload("faces", latents = self.latents[:40], labels = self.labels[:40]).status_code, 200)
+        info = self.upload("faces", latents = self.latents[40:], labels = self.labels[40:]).json()
+        self.assertEqual((info["appended"], info["rows"], info["dim"], info["label_columns"]), (20, 60, 5, 2))
+        self.assertEqual(request("GET", "/datasets/faces").json()["hash"], info["hash"])
+
+        resp = request("POST", "/attribute_direction", json = {"dataset" : "faces", "dataset_labels" : True, "solver" : "lda", "store" : True})
+        self.assertEqual(resp.status_code, 200)
+        expected = api.LatentDirectionFinder(self.latents).classifier_directions(self.labels, solver = "lda")
+        np.testing.assert_allclose(resp.json()["directions"], expected, atol = 1e-5)
+        meta = request("GET", f"/directions/{resp.json()['direction_ids'][0]}").json()
+        self.assertEqual(meta["dataset_hash"], info["hash"])
+
+        resp = request("POST", "/attribute_direction", json = {"dataset" : "faces", "n_components" : 2})
+        self.assertEqual(np.array(resp.json()["components"]).shape, (2, 5))
+
+    def test_append_off_event_loop(self):
+        # Other requests are served while an upload is written: the append waits for one to finish
+        started, served, waits = threading.Event(), threading.Event(), []
+        append = api.LatentDataset.append
+        def slow_append(*args, **kwargs):
+            started.set()
+            waits.append(served.wait(5))
+            return append(*args, **kwargs)
+
+        buffer = io.BytesIO()
+        np.save(buffer, self.latents)
+        async def requests():
+            async with httpx.AsyncClient(transport = httpx.ASGITransport(app = api.app), base_url = "http://api") as client:
+                upload = asyncio.create_task(client.post("/datasets/slow", content = buffer.getvalue()))
+                while not started.is_set() and not upload.done():
+                    await asyncio.sleep(0.01)
+                self.assertEqual((await client.get("/")).status_code, 200)
+                served.set()
+                return await upload
+
+        with mock.patch.object(api.LatentDataset, "append", slow_append):
+            self.assertEqual(asyncio.run(requests()).json()["rows"], 60)
+        self.assertEqual(waits, [True])
+
+    def test_errors(self):
+        buffer = io.BytesIO()
+        np.save(buffer, self.latents)
+        self.assertEqual(request("POST", "/datasets/plain", content = buffer.getvalue()).json()["rows"], 60)
+        self.assertEqual(request("POST", "/datasets/plain", content = b"not numpy").status_code, 400)
+        self.assertEqual(self.upload("plain", latents = self.latents[:, :3]).status_code, 400)
+        self.assertEqual(request("GET", "/datasets/missing").status_code, 404)
+        self.assertEqual(request("GET", "/datasets/.hidden").status_code, 400)
+        self.assertEqual(request("POST", "/attribute_direction", json = {"dataset" : "plain", "dataset_labels" : True}).status_code, 400)
+        self.assertEqual(request("POST", "/attribute_direction", json = {"dataset" : "plain", "latents" : [[0.]]}).status_code, 400)
+        self.assertEqual(request("POST", "/attribute_direction", json = {"dataset" : "plain", "labels" : [0, 1]}).status_code, 400)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+from faceforge_core.append_only import ALIGNMENT, AppendOnlyIndex, append_aligned
+
+class TestAppendOnlyIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "store", "index.jsonl")
+        self.index = AppendOnlyIndex(self.path, os.path.join(self.tmp.name, "store", "lock"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_missing_index(self):
+        self.assertEqual(self.index.read(), ([], False))
+
+    def test_reads_only_new_complete_lines(self):
+        with self.index.locked():
+            self.index.append([{"a" : 1}, {"a" : 2}])
+        self.assertEqual(self.index.read(), ([{"a" : 1}, {"a" : 2}], False))
+
+        with open(self.path, "a") as f:
+            f.write('{"a" : 3}\n{"a" :') # A writer in the middle of a line
+        self.assertEqual(self.index.read(), ([{"a" : 3}], False))
+        with open(self.path, "a") as f:
+            f.write(' 4}\n')
+        self.assertEqual(self.index.read(), ([{"a" : 4}], False))
+
+    def test_replace_read_from_start(self):
+        with self.index.locked():
+            self.index.append([{"a" : 1}])
+        reader = AppendOnlyIndex(self.path, self.index.lock_path)
+        reader.read()
+        with self.index.locked():
+            self.index.replace([{"b" : 1}])
+        self.assertEqual(reader.read(), ([{"b" : 1}], True))
+        self.assertEqual(reader.read(), ([], False))
+
+    def test_append_aligned(self):
+        with open(os.path.join(self.tmp.name, "data.bin"), "ab") as f:
+            self.assertEqual(append_aligned(f, b"abc"), 0)
+            self.assertEqual(append_aligned(f, b"de"), ALIGNMENT)
+        with open(os.path.join(self.tmp.name, "data.bin"), "rb") as f:
+            data = f.read()
+        self.assertEqual(data[:3], b"abc")
+        self.assertEqual(data[ALIGNMENT:], b"de")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,9 @@
+import os
+import tempfile
 import unittest
 import numpy as np
 from faceforge_core.attribute_directions import LatentDirectionFinder
+from faceforge_core.latent_dataset import LatentDataset
 
 class TestLatentDirectionFinder(unittest.TestCase):
     def setUp(self):
@@ -19,5 +22,148 @@ class TestLatentDirectionFinder(unittest.TestCase):
         self.assertEqual(direction.shape, (5,))
         self.assertAlmostEqual(np.linalg.norm(direction), 1.0, places=5)
 
+class TestSolvers(unittest.TestCase):
+    def setUp(self):
+        # Isotropic latents with labels along the first axis: every solver should find roughly that axis
+        rng = np.random.default_rng(0)
+        self.latents = rng.standard_normal((400, 16))
+        self.labels = (self.latents[:, 0] + 0.3 * rng.standard_normal(400) > 0).astype(int).tolist()
+        self.finder = LatentDirectionFinder(self.latents)
+
+    def test_solvers_agree(self):
+        reference = self.finder.classifier_direction(self.labels)
+        for solver in LatentDirectionFinder.SOLVERS:
+            direction = self.finder.classifier_direction(self.labels, solver=solver)
+            self.assertEqual(direction.shape, (16,))
+            self.assertAlmostEqual(np.linalg.norm(direction), 1.0, places=5)
+            self.assertGreater(direction @ reference, 0.95, solver)
+            self.assertGreater(direction[0], 0.9, solver)
+
+    def test_sgd_deterministic(self):
+        a = self.finder.classifier_direction(self.labels, solver="sgd")
+        b = self.finder.classifier_direction(self.labels, solver="sgd")
+        np.testing.assert_array_equal(a, b)
+
+    def test_lda_wide(self):
+        # Fewer samples than dimensions: the low-rank covariance keeps LDA well defined
+        rng = np.random.default_rng(1)
+        latents = rng.standard_normal((30, 200))
+        direction = LatentDirectionFinder(latents).classifier_direction([0] * 15 + [1] * 15, solver="lda")
+        self.assertTrue(np.isfinite(direction).all())
+        self.assertAlmostEqual(np.linalg.norm(direction), 1.0, places=5)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            self.finder.classifier_direction(self.labels, solver="svm")
+        with self.assertRaises(ValueError):
+            self.finder.classifier_direction([1] * 400, solver="mean_diff")
+
+class TestMultiAttribute(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.latents = rng.standard_normal((300, 12))
+        # Attribute k follows latent dimension k
+        self.labels = (self.latents[:, :3] + 0.3 * rng.standard_normal((300, 3)) > 0).astype(int)
+        self.finder = LatentDirectionFinder(self.latents)
+
+    def test_matches_single_fits(self):
+        for solver in ("mean_diff", "lda", "logistic"):
+            directions = self.finder.classifier_directions(self.labels, solver=solver)
+            self.assertEqual(directions.shape, (3, 12))
+            for k in range(3):
+                single = LatentDirectionFinder(self.latents).classifier_direction(self.labels[:, k], solver=solver)
+                np.testing.assert_allclose(directions[k], single, atol=1e-6, err_msg=solver)
+
+    def test_sgd(self):
+        directions = self.finder.classifier_directions(self.labels, solver="sgd")
+        np.testing.assert_allclose(np.linalg.norm(directions, axis=1), 1.0)
+        self.assertTrue((np.argmax(np.abs(directions), axis=1) == [0, 1, 2]).all())
+
+    def test_statistics_shared(self):
+        self.finder.classifier_directions(self.labels, solver="lda")
+        self.assertEqual(len(self.finder.cache), 1)
+        self.finder.classifier_direction(self.labels[:, 0], solver="lda")
+        self.finder.classifier_directions(self.labels[:, 1:], solver="lda")
+        self.assertEqual(len(self.finder.cache), 1)
+
+    def test_bad_labels(self):
+        with self.assertRaises(ValueError):
+            self.finder.classifier_directions(self.labels[:10], solver="mean_diff")
+        labels = self.labels.copy()
+        labels[:, 1] = 1
+        with self.assertRaises(ValueError):
+            self.finder.classifier_directions(labels, solver="mean_diff")
+
+    def test_two_valued_labels(self):
+        # Any two values, i.e. LogisticRegression's -1/1, with the larger one as class 1
+        expected = self.finder.classifier_directions(self.labels, solver="lda")
+        self.assertTrue(np.allclose(self.finder.classifier_directions(2 * self.labels - 1, solver="lda"), expected))
+        self.assertTrue(np.allclose(self.finder.classifier_direction(np.where(self.labels[:, 0], 5, 2), solver="lda"), expected[0]))
+        labels = self.labels.copy()
+        labels[0, 0] = 2
+        with self.assertRaises(ValueError):
+            self.finder.classifier_directions(labels, solver="lda")
+
+class TestDatasetFits(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.latents = rng.standard_normal((300, 12)) * np.linspace(3, 0.5, 12)
+        self.labels = np.stack([self.latents[:, k] + 0.5 * rng.standard_normal(300) > 0 for k in range(3)], axis=1).astype(int)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dataset = LatentDataset(os.path.join(self.tmp.name, "dataset"), chunk_rows=70)
+        self.dataset.append(self.latents, self.labels)
+        self.finder = LatentDirectionFinder(self.dataset)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_pca_matches_in_memory(self):
+        components, explained = self.finder.pca_direction(n_components=4)
+        expected_components, expected_explained = LatentDirectionFinder(self.latents).pca_direction(n_components=4)
+        np.testing.assert_allclose(np.abs((components * expected_components).sum(1)), 1.0, atol=1e-4)
+        np.testing.assert_allclose(explained, expected_explained, atol=1e-5)
+
+    def test_classifiers_match_in_memory(self):
+        in_memory = LatentDirectionFinder(self.latents)
+        for solver in ("mean_diff", "lda"):
+            np.testing.assert_allclose(self.finder.classifier_directions(self.labels, solver=solver),
+                                       in_memory.classifier_directions(self.labels, solver=solver), atol=1e-5, err_msg=solver)
+        cosines = (self.finder.classifier_directions(self.labels, solver="sgd")
+                   * in_memory.classifier_directions(self.labels, solver="sgd")).sum(1)
+        self.assertTrue((cosines > 0.95).all())
+        with self.assertRaises(ValueError):
+            self.finder.classifier_directions(self.labels, solver="logistic")
+
+    def test_fits_looked_up_by_hash(self):
+        directions = self.finder.classifier_directions(self.labels, solver="sgd")
+        fits = os.listdir(self.dataset.fits_path)
+        # A new finder on the same content reads the fit back instead of fitting again
+        again = LatentDirectionFinder(LatentDataset(self.dataset.path)).classifier_directions(self.labels, solver="sgd")
+        np.testing.assert_array_equal(directions, again)
+        self.assertEqual(os.listdir(self.dataset.fits_path), fits)
+
+    def test_streamed_low_rank(self):
+        # Past dense_max_dim the covariance is never formed, eigenpairs come from the streamed range finder
+        rng = np.random.default_rng(1)
+        latents = rng.standard_normal((400, 96)) * np.r_[[8, 6, 4, 3], np.geomspace(1, 0.1, 92)] # A few strong directions
+        labels = (latents[:, :3] @ rng.standard_normal(3) + rng.standard_normal(400) > 0).astype(int)[:, None]
+        dataset = LatentDataset(os.path.join(self.tmp.name, "wide"), chunk_rows=128)
+        dataset.append(latents, labels)
+        finder, in_memory = LatentDirectionFinder(dataset, dense_max_dim=0), LatentDirectionFinder(latents)
+        with self.assertRaises(ValueError):
+            finder.moments()
+        components, explained = finder.pca_direction(n_components=4)
+        expected_components, expected_explained = in_memory.pca_direction(n_components=4)
+        np.testing.assert_allclose(np.abs((components * expected_components).sum(1)), 1.0, atol=1e-4)
+        np.testing.assert_allclose(explained, expected_explained, rtol=1e-4)
+        # Against the exact eigenpairs of the dense path
+        cosine = (finder.classifier_directions(labels, solver="lda", rank=4)
+                  * LatentDirectionFinder(dataset).classifier_directions(labels, solver="lda", rank=4)).sum()
+        self.assertGreater(cosine, 0.999)
+
+    def test_explained_variance(self):
+        components, explained = LatentDirectionFinder(self.latents).pca_direction(n_components=2)
+        np.testing.assert_allclose(self.finder.explained_variance(components), explained, rtol=1e-6)
+
 if __name__ == "__main__":
     unittest.main() 
\ No newline at end of file
@@ -24,5 +24,17 @@ class TestAttributePreservingLoss(unittest.TestCase):
         # pred_loss = mean((0-1)^2) = 1, recon_loss = 1
         self.assertAlmostEqual(loss.item(), 5.0)
 
+    def test_per_sample_reduction(self):
+        generated = self.generated.clone()
+        generated[1] = 0.5
+        attr_predictor = lambda x: x.mean((1, 2, 3))[:, None]
+        loss = attribute_preserving_loss(
+            generated, self.original, attr_predictor, self.y_target, lambda_pred=2.0, lambda_recon=3.0, reduction="none"
+        )
+        # sample 0: pred_loss = 0, recon_loss = 1; sample 1: pred_loss = 0.25, recon_loss = 0.25
+        self.assertTrue(torch.allclose(loss, torch.tensor([3.0, 1.25])))
+        mean = attribute_preserving_loss(generated, self.original, attr_predictor, self.y_target, lambda_pred=2.0, lambda_recon=3.0)
+        self.assertAlmostEqual(mean.item(), loss.mean().item(), places=6)
+
 if __name__ == "__main__":
     unittest.main() 
\ No newline at end of file
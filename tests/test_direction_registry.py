@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from faceforge_core.direction_registry import DirectionRegistry, UnknownDirection, dataset_hash, explained_variance
+
+class TestDirectionRegistry(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "directions")
+        self.registry = DirectionRegistry(self.path)
+        self.rng = np.random.default_rng(0)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_roundtrip_normalized(self):
+        direction = self.rng.standard_normal(32) * 5
+        direction_id = self.registry.register(direction, solver = "lda", dataset_hash = "abc", explained_variance = 0.25, attribute = "smile")
+        res = self.registry.get(direction_id)
+        self.assertEqual(res.dtype, np.float32)
+        self.assertTrue(np.allclose(res, direction / np.linalg.norm(direction), atol = 1e-6))
+        meta = self.registry.metadata(direction_id)
+        self.assertEqual((meta["solver"], meta["dataset_hash"], meta["explained_variance"]), ("lda", "abc", 0.25))
+        self.assertEqual((meta["dim"], meta["dtype"], meta["attribute"]), (32, "float32", "smile"))
+
+    def test_float16(self):
+        registry = DirectionRegistry(self.path, dtype = "float16")
+        direction = self.rng.standard_normal(100)
+        res = registry.get(registry.register(direction))
+        self.assertEqual(res.dtype, np.float16)
+        self.assertTrue(np.allclose(res, direction / np.linalg.norm(direction), atol = 1e-3))
+
+    def test_ids(self):
+        direction = self.rng.standard_normal(8)
+        self.assertEqual(self.registry.register(direction), self.registry.register(2 * direction))
+        self.assertEqual(len(self.registry), 1)
+        self.registry.register(direction, "named")
+        self.registry.register(-direction, "named") # Replaces it
+        self.assertTrue(np.allclose(self.registry.get("named"), -direction / np.linalg.norm(direction), atol = 1e-6))
+        self.registry.remove("named")
+        self.assertNotIn("named", self.registry)
+        with self.assertRaises(UnknownDirection):
+            self.registry.get("named")
+
+    def test_lazy_and_shared(self):
+        self.assertFalse(os.path.exists(self.path)) # Nothing touches the disk before a write
+        reader = DirectionRegistry(self.path)
+        self.assertNotIn("a", reader)
+        self.registry.register(self.rng.standard_normal(8), "a")
+        self.assertIn("a", reader)
+        self.assertTrue(np.array_equal(reader.get("a"), self.registry.get("a")))
+
+    def test_combine(self):
+        a, b = self.rng.standard_normal(16), self.rng.standard_normal(16)
+        self.registry.register(a, "a")
+        self.registry.register(b, "b")
+        expected = 0.5 * a / np.linalg.norm(a) - 2 * b / np.linalg.norm(b)
+        self.assertTrue(np.allclose(self.registry.combine([("a", 0.5), ("b", -2)]), expected, atol = 1e-5))
+        self.registry.register(self.rng.standard_normal(4), "c")
+        with self.assertRaises(ValueError):
+            self.registry.combine([("a", 1), ("c", 1)])
+
+    def test_rejects_zero(self):
+        with self.assertRaises(ValueError):
+            self.registry.register(np.zeros(4))
+
+    def test_dataset_hash_and_variance(self):
+        latents = self.rng.standard_normal((50, 4)) * [3, 1, 1, 1]
+        self.assertEqual(dataset_hash(latents), dataset_hash(latents.copy()))
+        self.assertNotEqual(dataset_hash(latents), dataset_hash(latents.astype(np.float32)))
+        self.assertGreater(explained_variance(latents, np.eye(4)[0]), 0.6)
+
+if __name__ == "__main__":
+    unittest.main()
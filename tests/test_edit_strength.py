@@ -0,0 +1,69 @@
+import unittest
+import torch
+from faceforge_core.edit_strength import EditStrengthOptimizer, latent_decoder
+from faceforge_core.fast_sd import tiny_diffusion_pipeline
+
+class TestEditStrengthOptimizer(unittest.TestCase):
+    def setUp(self):
+        generator = torch.Generator().manual_seed(0)
+        self.latents = torch.randn(6, 2, 4, 4, generator = generator)
+        self.direction = torch.randn(2, 4, 4, generator = generator)
+        self.predictor = lambda x: (x * self.direction).mean((1, 2, 3))[:, None]
+        self.targets = torch.linspace(-0.5, 0.5, 6)[:, None]
+
+    def best_alphas(self, generator, lambda_recon):
+        # Brute force over a grid
+        grid = torch.linspace(-5, 5, 20001)
+        best = []
+        for z, y in zip(self.latents, self.targets):
+            images = generator(z + grid[:, None, None, None] * self.direction)
+            losses = (self.predictor(images)[:, 0] - y) ** 2 + lambda_recon * ((images - generator(z[None])) ** 2).mean((1, 2, 3))
+            best.append(grid[losses.argmin()])
+        return torch.stack(best)
+
+    def test_finds_per_sample_optimum(self):
+        optimizer = EditStrengthOptimizer(torch.tanh, self.predictor, lambda_recon = 0.01, amp_dtype = None, max_steps = 500)
+        res = optimizer.optimize(self.latents, self.direction, self.targets)
+        self.assertTrue(torch.allclose(res.alphas, self.best_alphas(torch.tanh, 0.01), atol = 0.05))
+        self.assertTrue((res.losses <= res.initial_losses).all())
+        self.assertTrue(res.converged.all())
+
+    def test_early_stopping_per_sample(self):
+        # The first sample starts at its optimum, the others have to move
+        targets = self.targets.clone()
+        targets[0] = self.predictor(self.latents[:1])
+        optimizer = EditStrengthOptimizer(lambda x: x, self.predictor, lambda_recon = 0.0, amp_dtype = None, patience = 3)
+        res = optimizer.optimize(self.latents, self.direction, targets)
+        self.assertEqual(res.steps[0].item(), 4)
+        self.assertTrue((res.steps[1:] > res.steps[0]).all())
+        self.assertEqual(res.sample_steps, res.steps.sum().item())
+
+    def test_checkpoint_and_micro_batches_match(self):
+        kwargs = dict(lambda_recon = 0.01, amp_dtype = None, max_steps = 50)
+        plain = EditStrengthOptimizer(torch.tanh, self.predictor, checkpoint = False, **kwargs).optimize(self.latents, self.direction, self.targets)
+        chunked = EditStrengthOptimizer(torch.tanh, self.predictor, checkpoint = True, micro_batch = 4, **kwargs).optimize(self.latents, self.direction, self.targets)
+        self.assertTrue(torch.allclose(plain.alphas, chunked.alphas, atol = 1e-5))
+        self.assertTrue(torch.equal(plain.steps, chunked.steps))
+
+    def test_rejects_mismatched_direction(self):
+        with self.assertRaises(ValueError):
+            EditStrengthOptimizer(torch.tanh, self.predictor).optimize(self.latents, torch.zeros(3, 4, 4), self.targets)
+
+class TestTinyDecoder(unittest.TestCase):
+    def test_mixed_precision_on_tiny_decoder(self):
+        pipe = tiny_diffusion_pipeline()
+        pipe.vae.requires_grad_(False)
+        generator = latent_decoder(pipe)
+        latents = torch.randn(4, 4, 8, 8, generator = torch.Generator().manual_seed(0))
+        direction = torch.randn(4, 8, 8, generator = torch.Generator().manual_seed(1))
+        predictor = lambda images: images.mean((1, 2, 3))[:, None]
+        with torch.no_grad():
+            targets = predictor(generator(latents + 0.5 * direction))
+        res = EditStrengthOptimizer(generator, predictor, lambda_recon = 0.0, amp_dtype = torch.bfloat16, max_steps = 100).optimize(latents, direction, targets)
+        self.assertTrue((res.losses < res.initial_losses).all())
+        summary = res.summary()
+        self.assertEqual(summary["samples"], 4)
+        self.assertGreater(summary["sample_steps_per_s"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
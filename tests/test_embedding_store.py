@@ -0,0 +1,104 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import torch
+from faceforge_core.embedding_store import EmbeddingStore, prompt_key
+
+def make_encodes(value, dtype = torch.float16):
+    return (torch.full((1, 77, 8), value, dtype = dtype), None, torch.full((1, 4), value, dtype = dtype), None)
+
+class TestEmbeddingStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "store")
+        self.store = EmbeddingStore(self.path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_roundtrip(self):
+        self.store.put("model", "a cat", make_encodes(1.5))
+        res = self.store.get("model", "a cat")
+        self.assertEqual(res[0].shape, (1, 77, 8))
+        self.assertEqual(res[0].dtype, torch.float16)
+        self.assertIsNone(res[1])
+        self.assertTrue(torch.equal(res[2], make_encodes(1.5)[2]))
+
+    def test_keyed_by_model(self):
+        self.store.put("model", "a cat", make_encodes(1.0))
+        self.assertIsNone(self.store.get("other_model", "a cat"))
+        self.assertIn(prompt_key("model", "a cat"), self.store)
+
+    def test_bfloat16(self):
+        self.store.put("model", "a cat", make_encodes(0.25, dtype = torch.bfloat16))
+        res = self.store.get("model", "a cat")
+        self.assertEqual(res[0].dtype, torch.bfloat16)
+        self.assertTrue(torch.equal(res[0], make_encodes(0.25, dtype = torch.bfloat16)[0]))
+
+    def test_other_instance_sees_appends(self):
+        reader = EmbeddingStore(self.path)
+        self.assertIsNone(reader.get("model", "a cat"))
+        self.store.put("model", "a cat", make_encodes(2.0))
+        self.assertEqual(reader.get("model", "a cat")[0][0, 0, 0].item(), 2.0)
+
+    def test_cached_encodes_only_encodes_misses(self):
+        self.store.put("model", "a", make_encodes(1.0))
+        calls = []
+        def encode_fn(prompts):
+            calls.append(prompts)
+            return [make_encodes(float(len(p))) for p in prompts]
+
+        res = self.store.cached_encodes("model", ["a", "bb", "bb"], encode_fn)
+        self.assertEqual(calls, [["bb"]])
+        self.assertEqual([r[0][0, 0, 0].item() for r in res], [1.0, 2.0, 2.0])
+        self.store.cached_encodes("model", ["a", "bb"], encode_fn)
+        self.assertEqual(len(calls), 1)
+
+    def test_compaction_drops_superseded(self):
+        reader = EmbeddingStore(self.path)
+        self.assertIsNone(reader.get("model", "a"))
+        for value in range(3):
+            self.store.put("model", "a", make_encodes(float(value)))
+        self.store.put("model", "b", make_encodes(5.0))
+        before = self.store.nbytes
+        self.store.compact()
+        self.assertLess(self.store.nbytes, before)
+        self.assertEqual(len(self.store), 2)
+        self.assertEqual(reader.get("model", "a")[0][0, 0, 0].item(), 2.0)
+
+    def test_read_during_compaction(self):
+        # The reader refreshes onto a data file another store compacts away before the reader maps it
+        self.store.put("model", "a", make_encodes(1.0))
+        self.store.put("model", "a", make_encodes(3.0))
+        reader = EmbeddingStore(self.path)
+        refresh, compacted = reader._refresh, []
+        def refresh_then_compact():
+            refresh()
+            if not compacted:
+                compacted.append(self.store.compact())
+        with mock.patch.object(reader, "_refresh", side_effect = refresh_then_compact):
+            res = reader.get("model", "a")
+        self.assertEqual(res[0][0, 0, 0].item(), 3.0)
+        self.assertNotEqual(reader.data_file, os.path.join(self.path, "data-0.bin"))
+
+    def test_size_cap_evicts_oldest(self):
+        entry = EmbeddingStore._nbytes(make_encodes(0.0))
+        store = EmbeddingStore(os.path.join(self.tmp.name, "capped"), max_bytes = 3 * entry)
+        for i in range(5):
+            store.put("model", str(i), make_encodes(float(i)))
+        self.assertLessEqual(store.nbytes, 3 * entry)
+        self.assertIsNone(store.get("model", "0"))
+        self.assertIsNotNone(store.get("model", "4"))
+
+    def test_oversize_batch_not_stored(self):
+        entry = EmbeddingStore._nbytes(make_encodes(0.0))
+        store = EmbeddingStore(os.path.join(self.tmp.name, "capped"), max_bytes = 2 * entry)
+        store.put("model", "a", make_encodes(1.0))
+        store.put_many("model", ["b", "c", "d"], [make_encodes(2.0)] * 3)
+        self.assertIsNone(store.get("model", "b"))
+        self.assertEqual(store.get("model", "a")[0][0, 0, 0].item(), 1.0)
+        self.assertLessEqual(store.nbytes, 2 * entry)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+import numpy as np
+import torch
+from faceforge_core.encoding_compression import (
+    CompressedTensor, anchor_memory, batch, compress_encoding, decompress_encoding, encoding_nbytes
+)
+from faceforge_core.sampling import DistanceSampling
+
+def anchors(n, tokens = 77, dim = 64):
+    """
+    Prompt embeddings with a few outlier channels, like a text encoder's, and pooled embeddings
+    """
+    generator = torch.Generator().manual_seed(0)
+    embeds = torch.randn(n, tokens, dim, generator = generator)
+    embeds[:, :, :2] *= 30
+    return [embeds, None, torch.randn(n, 32, generator = generator), None]
+
+class TestCompressedTensor(unittest.TestCase):
+    def test_round_trip(self):
+        embeds, _, pooled, _ = anchors(4)
+        pooled[:, :2] *= 30
+        for x in (embeds, pooled):
+            for mode, tol in (("fp16", 1e-3), ("int8", 1e-2)):
+                compressed = CompressedTensor.compress(x, mode)
+                restored = compressed.decompress()
+                self.assertEqual(restored.dtype, torch.float32)
+                self.assertEqual(restored.shape, x.shape)
+                self.assertLess(((restored - x).norm() / x.norm()).item(), tol)
+
+    def test_per_channel_scales(self):
+        x = anchors(3)[0]
+        compressed = CompressedTensor.compress(x, "int8")
+        self.assertEqual(compressed.scale.shape, (3, 1, 64))
+        # Outlier channels don't cost the others their precision
+        restored = compressed.decompress()
+        error = (restored - x)[:, :, 2:].abs().max()
+        self.assertLessEqual(error.item(), x[:, :, 2:].abs().max().item() / 254 + 1e-6)
+
+        # Pooled embeddings too, over the batch
+        x = anchors(3)[2]
+        x[:, :2] *= 30
+        compressed = CompressedTensor.compress(x, "int8")
+        self.assertEqual(compressed.scale.shape, (1, 32))
+        error = (compressed.decompress() - x)[:, 2:].abs().max()
+        self.assertLessEqual(error.item(), x[:, 2:].abs().max().item() / 254 + 1e-6)
+
+    def test_nbytes(self):
+        x = torch.randn(1, 77, 2048)
+        self.assertEqual(CompressedTensor.compress(x, "fp16").nbytes, 77 * 2048 * 2)
+        self.assertEqual(CompressedTensor.compress(x, "int8").nbytes, 77 * 2048 + 2048 * 4)
+        encoding = compress_encoding((x, None, torch.randn(1, 1280), None), "int8")
+        self.assertEqual(encoding_nbytes(encoding), 77 * 2048 + 2048 * 4 + 1280 + 1280 * 4)
+        memory = anchor_memory([encoding, encoding], "int8")
+        self.assertEqual(memory["anchors"], 2)
+        self.assertEqual(memory["bytes_per_anchor"], encoding_nbytes(encoding))
+
+    def test_numpy(self):
+        x = np.random.default_rng(0).standard_normal(512)
+        compressed = compress_encoding(x, "int8")
+        restored = decompress_encoding(compressed)
+        self.assertIsInstance(restored, np.ndarray)
+        self.assertEqual(restored.dtype, np.float64)
+        self.assertLess(np.abs(restored - x).max(), np.abs(x).max() / 127)
+
+    def test_blend_matches_fp32(self):
+        x = anchors(10)[0]
+        coefs = np.random.default_rng(0).uniform(0, 1, 10)
+        expected = (torch.from_numpy(coefs).float()[:, None, None] * x).sum(0)
+        for mode in ("fp16", "int8"):
+            blended = CompressedTensor.compress(x, mode).blend(coefs, block = 3)
+            self.assertEqual(blended.shape, (77, 64))
+            self.assertLess(((blended - expected).norm() / expected.norm()).item(), 1e-2)
+        with self.assertRaises(ValueError):
+            CompressedTensor.compress(x, "int8").blend(coefs[:3])
+
+    def test_batch(self):
+        per_anchor = [compress_encoding(tuple(e[i:i + 1] if e is not None else None for e in anchors(3)), "int8") for i in range(3)]
+        batched = batch([e[0] for e in per_anchor])
+        self.assertEqual(batched.shape, (3, 77, 64))
+        self.assertIsNone(batch([e[1] for e in per_anchor]))
+        self.assertTrue(torch.equal(batched.decompress()[1:2], per_anchor[1][0].decompress()))
+        with self.assertRaises(ValueError):
+            batch([per_anchor[0][0], compress_encoding(anchors(1)[0], "fp16")])
+
+        # Pooled embeddings compressed as a batch share their scales, which batching repeats per anchor
+        pooled = anchors(3)[2]
+        batched = batch([CompressedTensor.compress(pooled[:2], "int8"), per_anchor[2][2]])
+        self.assertEqual(batched.scale.shape, (3, 32))
+        self.assertLess(((batched.decompress() - pooled).norm() / pooled.norm()).item(), 1e-2)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            CompressedTensor.compress(torch.zeros(2, 3), "int4")
+
+class TestCompressedSampling(unittest.TestCase):
+    def test_sampler_blends_compressed(self):
+        encodes = anchors(5)
+        rng = np.random.default_rng(0)
+        positions, point = rng.uniform(-1, 1, (5, 2)), rng.uniform(-1, 1, 2)
+        expected = DistanceSampling(encodes)(point, positions)
+        for mode in ("fp16", "int8"):
+            blended = DistanceSampling(compress_encoding(encodes, mode))(point, positions)
+            self.assertIsNone(blended[1])
+            for b, e in zip(blended[::2], expected[::2]):
+                self.assertEqual(b.dtype, torch.float32)
+                self.assertLess(((b - e).norm() / e.norm()).item(), 1e-2)
+
+if __name__ == "__main__":
+    unittest.main()
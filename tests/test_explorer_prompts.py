@@ -0,0 +1,45 @@
+import os
+import unittest
+from unittest import mock
+import pygame
+from faceforge_core import LatentSpaceExplorer, GameConfig
+from faceforge_core.fast_sd import TINY_MODEL_ID
+
+class TestIncrementalEncoding(unittest.TestCase):
+    def setUp(self):
+        # Tiny stand-in pipeline on SDL's dummy video driver
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        self.explorer = LatentSpaceExplorer(GameConfig(model_id = TINY_MODEL_ID, device = "cpu", width = 320, height = 240, threaded = False))
+        self.encoded = []
+
+        encode_prompts = self.explorer.encode_prompts
+        def record(prompts):
+            self.encoded.append(list(prompts))
+            return encode_prompts(prompts)
+        patcher = mock.patch.object(self.explorer, "encode_prompts", side_effect = record)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(pygame.quit)
+
+    def test_add_only_encodes_new_prompt(self):
+        self.explorer.set_prompts(["a", "bb"])
+        first = self.explorer.points[0].encoding
+        self.explorer.set_prompts(self.explorer.prompts + ["ccc"])
+        self.assertEqual(self.encoded, [["a", "bb"], ["ccc"]])
+        self.assertIs(self.explorer.points[0].encoding, first)
+        self.assertEqual(len(self.explorer.encodes[0]), 3)
+
+    def test_modify_keeps_positions(self):
+        self.explorer.set_prompts(["a", "bb"])
+        positions = [p.xy_pos for p in self.explorer.points]
+        self.explorer.set_prompts(["a", "dddd"])
+        self.assertEqual(self.encoded[-1], ["dddd"])
+        self.assertEqual([p.xy_pos for p in self.explorer.points], positions)
+
+    def test_reset_does_not_reencode(self):
+        self.explorer.set_prompts(["a", "bb", "a"])
+        self.explorer.set_prompts(self.explorer.prompts, reset = True)
+        self.assertEqual(self.encoded, [["a", "bb"]])
+
+if __name__ == "__main__":
+    unittest.main()
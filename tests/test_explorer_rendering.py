@@ -0,0 +1,223 @@
+import os
+import unittest
+from unittest import mock
+import numpy as np
+import pygame
+from faceforge_core import LatentSpaceExplorer, GameConfig
+from faceforge_core.game_objects import Point
+from faceforge_core.encoding_compression import compress_encoding
+from faceforge_core.fast_sd import TINY_MODEL_ID
+
+def headless_explorer(**config):
+    """
+    Explorer on the tiny stand-in pipeline with two points, on SDL's dummy video driver.
+    Renders run on the main thread unless threaded = True is passed
+    """
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    config = {"model_id" : TINY_MODEL_ID, "device" : "cpu", "width" : 320, "height" : 240, "threaded" : False, **config}
+    explorer = LatentSpaceExplorer(GameConfig(**config))
+    explorer.points = [Point("a", tuple(explorer.pipe.get_encodes("a")), (0., 1.)), Point("b", tuple(explorer.pipe.get_encodes("b")), (1., 0.))]
+    explorer.player_pos = np.array([0.5, 0.5])
+    return explorer
+
+class TestProgressiveRendering(unittest.TestCase):
+    def setUp(self):
+        self.explorer = headless_explorer(progressive = True, low_resolution = 32, call_every = 0, adaptive_call_every = False)
+
+    def test_low_then_full(self):
+        self.explorer.draw_sample(self.explorer.moving_tier)
+        self.assertEqual(self.explorer.sample_image.shape, (32, 32, 3))
+        self.assertTrue(self.explorer.pending_full_render)
+
+        self.explorer.draw_sample()
+        self.assertEqual(self.explorer.sample_image.shape, (64, 64, 3))
+        self.assertFalse(self.explorer.pending_full_render)
+        self.assertEqual(set(self.explorer.latency.tiers), {"low", "full"})
+        self.assertEqual(self.explorer.avg_latency[0], 2)
+        self.assertEqual(set(self.explorer.latency.summary()["full"]["stages"]), {"blend", "unet", "decode"})
+
+    def test_adaptive_call_every(self):
+        self.explorer.config.adaptive_call_every = True
+        self.explorer.draw_sample(self.explorer.moving_tier)
+        self.assertEqual(self.explorer.config.call_every, int(self.explorer.latency.percentile(50, "low")))
+
+    def test_full_render_cached_per_position(self):
+        self.explorer.draw_sample()
+        full = self.explorer.sample_image
+
+        self.explorer.player_pos = np.array([0., 0.])
+        self.explorer.draw_sample(self.explorer.moving_tier)
+        self.explorer.player_pos = np.array([0.5, 0.5])
+        self.explorer.draw_sample(self.explorer.moving_tier)
+        self.assertIs(self.explorer.sample_image, full)
+        self.assertFalse(self.explorer.pending_full_render)
+        self.assertEqual(len(self.explorer.latency.values("low")), 1)
+
+    def test_cache_invalidated_by_point_changes(self):
+        self.explorer.draw_sample()
+        self.explorer.invalidate_renders()
+        self.assertEqual(len(self.explorer.render_cache), 0)
+
+    def test_preview_tier(self):
+        self.explorer.config.preview = True
+        self.assertEqual(self.explorer.moving_tier, "preview")
+        self.explorer.draw_sample(self.explorer.moving_tier)
+        self.assertEqual(self.explorer.sample_image.shape, (64, 64, 3))
+        self.assertTrue(self.explorer.pending_full_render)
+
+class TestCompressedEncodings(unittest.TestCase):
+    def test_render_close_to_uncompressed(self):
+        expected = headless_explorer(call_every = 0, adaptive_call_every = False)
+        expected.draw_sample()
+        for mode in ("fp16", "int8"):
+            explorer = headless_explorer(call_every = 0, adaptive_call_every = False, encoding_compression = mode)
+            for point in explorer.points:
+                point.encoding = compress_encoding(point.encoding, mode)
+            explorer.draw_sample()
+            diff = np.abs(explorer.sample_image.astype(int) - expected.sample_image.astype(int))
+            self.assertLessEqual(diff.mean(), 1.0)
+            memory = explorer.anchor_memory()
+            self.assertEqual(memory["compression"], mode)
+            self.assertLess(memory["bytes_per_anchor"], expected.anchor_memory()["bytes_per_anchor"])
+
+    def test_preview_decompresses(self):
+        explorer = headless_explorer(preview = True, call_every = 0, adaptive_call_every = False, encoding_compression = "int8")
+        for point in explorer.points:
+            point.encoding = compress_encoding(point.encoding, "int8")
+        explorer.draw_sample(explorer.moving_tier)
+        self.assertEqual(explorer.sample_image.shape, (64, 64, 3))
+
+class TestThreadedRendering(unittest.TestCase):
+    def setUp(self):
+        self.explorer = headless_explorer(threaded = True)
+
+    def tearDown(self):
+        self.explorer.render_worker.stop()
+
+    def test_result_swapped_in_later(self):
+        self.explorer.draw_sample()
+        self.assertTrue(self.explorer.render_worker.wait(30))
+        self.assertIsNone(self.explorer.sample_image)
+        self.explorer.collect_sample()
+        self.assertEqual(self.explorer.sample_image.shape, (64, 64, 3))
+        self.assertEqual(len(self.explorer.render_cache), 1)
+
+        expected = headless_explorer(call_every = 0, adaptive_call_every = False)
+        expected.draw_sample()
+        self.assertTrue((self.explorer.sample_image == expected.sample_image).all())
+
+    def test_stale_render_not_cached(self):
+        self.explorer.draw_sample()
+        self.explorer.points[0].move((0.3, 0.3))
+        self.explorer.invalidate_renders()
+        self.assertTrue(self.explorer.render_worker.wait(30))
+        self.explorer.collect_sample()
+        # Rendered with the old points: neither shown nor cached
+        self.assertIsNone(self.explorer.sample_image)
+        self.assertEqual(len(self.explorer.render_cache), 0)
+
+    def test_cache_hit_not_replaced_by_older_render(self):
+        self.explorer.draw_sample()
+        self.assertTrue(self.explorer.render_worker.wait(30))
+        self.explorer.collect_sample()
+        here = self.explorer.sample_image
+
+        # Move away and back before the render of the other position finishes
+        self.explorer.player_pos = np.array([-0.5, 0.2])
+        self.explorer.draw_sample()
+        self.explorer.player_pos = np.array([0.5, 0.5])
+        self.explorer.draw_sample()
+        self.assertIs(self.explorer.sample_image, here)
+        self.assertTrue(self.explorer.render_worker.wait(30))
+        self.explorer.collect_sample()
+        self.assertIs(self.explorer.sample_image, here)
+
+    def test_renders_of_passed_positions_shown_while_moving(self):
+        self.explorer.draw_sample(self.explorer.moving_tier)
+        self.explorer.player_pos = np.array([-0.5, 0.2]) # Moved on while it rendered
+        self.assertTrue(self.explorer.render_worker.wait(30))
+        self.explorer.collect_sample()
+        self.assertIsNotNone(self.explorer.sample_image)
+
+    def test_moving_submissions_spaced_by_call_every(self):
+        self.explorer.config.call_every = 50
+        self.explorer.render_worker.stop()
+        self.explorer.render_worker = mock.Mock()
+        self.explorer.ms_elapsed = 10
+        self.explorer.draw_sample(self.explorer.moving_tier, moving = True)
+        self.explorer.render_worker.submit.assert_not_called()
+        self.assertTrue(self.explorer.pending_full_render) # Covered once the player stops
+
+        self.explorer.ms_elapsed = 60
+        self.explorer.draw_sample(self.explorer.moving_tier, moving = True)
+        self.explorer.render_worker.submit.assert_called_once()
+        self.assertEqual(self.explorer.ms_elapsed, 0)
+
+        self.explorer.draw_sample() # Full render once stopped isn't throttled
+        self.assertEqual(self.explorer.render_worker.submit.call_count, 2)
+
+class TestDrawCaching(unittest.TestCase):
+    def setUp(self):
+        self.explorer = headless_explorer(sample_width = 128, sample_height = 128, call_every = 0, adaptive_call_every = False)
+        self.explorer.zoom_level = 100.
+
+    def tearDown(self):
+        pygame.quit()
+
+    def test_labels_rendered_once(self):
+        self.explorer.draw_main_screen()
+        labels = dict(self.explorer.text_surfaces)
+        self.explorer.points[0].move((0.2, 0.3))
+        self.explorer.draw_main_screen()
+        self.assertEqual(len(self.explorer.text_surfaces), 2)
+        for key, surface in self.explorer.text_surfaces.items():
+            self.assertIs(labels[key], surface)
+
+        self.explorer.selected_point_idx = 0
+        self.explorer.draw_main_screen()
+        self.assertEqual(len(self.explorer.text_surfaces), 3)
+
+    def test_sample_scaled_once_per_image(self):
+        self.explorer.draw_sample()
+        rects = self.explorer.draw_main_screen()
+        scaled = self.explorer.scaled_sample
+        self.assertEqual(scaled.get_size(), (128, 128))
+        self.assertIn(pygame.Rect(0, 0, 128, 128), rects)
+
+        self.explorer.draw_main_screen()
+        self.assertIs(self.explorer.scaled_sample, scaled)
+
+        self.explorer.sample_image = self.explorer.sample_image.copy()
+        self.explorer.draw_main_screen()
+        self.assertIsNot(self.explorer.scaled_sample, scaled)
+
+    def test_hud(self):
+        self.explorer.config.show_hud = True
+        self.explorer.draw_main_screen()
+        self.assertEqual(self.explorer.hud_surfaces, [])
+        self.explorer.draw_sample()
+        rects = self.explorer.draw_main_screen()
+        self.assertEqual(len(self.explorer.hud_surfaces), 2)
+        self.assertEqual(max(rect.bottom for rect in rects[-2:]), 240)
+        surfaces = self.explorer.hud_surfaces
+        self.explorer.draw_main_screen()
+        self.assertIs(self.explorer.hud_surfaces, surfaces)
+
+    def test_dirty_rect_updates(self):
+        with mock.patch.object(pygame.display, "flip") as flip, mock.patch.object(pygame.display, "update") as update:
+            self.explorer.update()
+            self.assertEqual(flip.call_count, 1)
+            self.assertEqual(update.call_count, 0)
+            first = list(self.explorer.dirty_rects)
+
+            self.explorer.player_pos = np.array([-0.5, 0.2])
+            self.explorer.update()
+            self.assertEqual(flip.call_count, 1)
+            pushed = update.call_args[0][0]
+            # Old player position is cleared, new one drawn
+            self.assertEqual(pushed[:len(first)], first)
+            self.assertEqual(pushed[len(first):], self.explorer.dirty_rects)
+            self.assertLess(sum(r.w * r.h for r in pushed), 320 * 240)
+
+if __name__ == "__main__":
+    unittest.main()
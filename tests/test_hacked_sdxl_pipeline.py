@@ -0,0 +1,94 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from faceforge_core.fast_sd import tiny_diffusion_pipeline
+
+class TestInitialLatents(unittest.TestCase):
+    def setUp(self):
+        self.pipe = tiny_diffusion_pipeline()
+
+    def test_cached_per_seed(self):
+        latents = self.pipe.initial_latents(0)
+        self.assertEqual(latents.shape, (1, 4, 8, 8))
+        self.assertIs(self.pipe.initial_latents(0), latents)
+        self.assertFalse(torch.equal(self.pipe.initial_latents(1), latents))
+        self.assertEqual(self.pipe.initial_latents(0, batch_size = 2, height = 32, width = 32).shape, (2, 4, 4, 4))
+
+    def test_matches_seeded_generator(self):
+        encodes = self.pipe.get_encodes("a cat")
+        from_latents = self.pipe.generate_from_encodes(list(encodes), latents = self.pipe.initial_latents(3), output_type = "np").images
+        generator = torch.Generator(self.pipe.device).manual_seed(3)
+        from_generator = self.pipe.generate_from_encodes(list(encodes), generator = generator, output_type = "np").images
+        self.assertTrue((from_latents == from_generator).all())
+
+class TestUint8Output(unittest.TestCase):
+    def test_matches_pil(self):
+        pipe = tiny_diffusion_pipeline()
+        encodes = pipe.get_encodes(["a cat", "a dog"])
+        pil = pipe.generate_from_encodes(list(encodes), latents = pipe.initial_latents(0, batch_size = 2), output_type = "pil").images
+        res = pipe.generate_from_encodes(list(encodes), latents = pipe.initial_latents(0, batch_size = 2), output_type = "uint8").images
+        self.assertEqual(res.dtype, np.uint8)
+        self.assertEqual(res.shape, (2, 64, 64, 3))
+        self.assertTrue(res.flags["C_CONTIGUOUS"])
+        for image, expected in zip(res, pil):
+            self.assertTrue((image == np.array(expected)).all())
+
+class TestReentrancy(unittest.TestCase):
+    def setUp(self):
+        self.pipe = tiny_diffusion_pipeline()
+
+    def render(self, encodes):
+        return self.pipe.generate_from_encodes(encodes, latents = self.pipe.initial_latents(0), output_type = "np").images
+
+    def test_encodes_not_mutated(self):
+        encodes = [torch.randn(5, 16), None, torch.randn(8), None]
+        self.render(encodes)
+        self.assertEqual(encodes[0].shape, (5, 16))
+        self.assertEqual(encodes[2].shape, (8,))
+        self.assertFalse(hasattr(self.pipe, "cached_encodes"))
+
+    def test_concurrent_callers_isolated(self):
+        all_encodes = [self.pipe.get_encodes(f"prompt {i}") for i in range(8)]
+        expected = [self.render(encodes) for encodes in all_encodes]
+
+        jobs = list(range(len(all_encodes))) * 6
+        with ThreadPoolExecutor(max_workers = 8) as pool:
+            results = list(pool.map(lambda i: (i, self.render(all_encodes[i])), jobs))
+
+        for i, image in results:
+            self.assertTrue((image == expected[i]).all(), f"Result for caller {i} leaked another caller's state")
+
+    def guided(self, encodes, guidance_scale):
+        return self.pipe(
+            prompt_embeds = encodes[0], pooled_prompt_embeds = encodes[2], guidance_scale = guidance_scale,
+            num_inference_steps = 1, latents = self.pipe.initial_latents(0), output_type = "latent",
+        ).images
+
+    def test_concurrent_guidance_scales_isolated(self):
+        # Calls with and without classifier-free guidance at once, each must keep its own settings
+        all_encodes = [self.pipe.get_encodes(f"prompt {i}") for i in range(4)]
+        scales = [0.0, 5.0, 1.0, 7.5]
+        expected = {(i, g) : self.guided(all_encodes[i], g) for i in range(4) for g in scales}
+        self.assertFalse(torch.equal(expected[0, 0.0], expected[0, 5.0]))
+
+        jobs = list(expected) * 4
+        with ThreadPoolExecutor(max_workers = 8) as pool:
+            results = list(pool.map(lambda job: (job, self.guided(all_encodes[job[0]], job[1])), jobs))
+
+        for job, image in results:
+            self.assertTrue(torch.equal(image, expected[job]), f"Result for {job} leaked another caller's guidance settings")
+        self.assertFalse(hasattr(self.pipe, "_guidance_scale"))
+
+    def test_decode_keeps_vae_dtype(self):
+        self.pipe.vae.to(torch.float16)
+        self.pipe.vae.register_to_config(force_upcast = True)
+        latents = self.pipe.initial_latents(0)
+        images = self.pipe.decode(latents, output_type = "np")
+        self.assertEqual(self.pipe.vae.dtype, torch.float16)
+        self.assertEqual(images.shape, (1, 64, 64, 3))
+        self.assertIs(self.pipe.upcast_vae_copy(), self.pipe.upcast_vae_copy())
+        self.assertEqual(self.pipe.upcast_vae_copy().dtype, torch.float32)
+
+if __name__ == "__main__":
+    unittest.main()
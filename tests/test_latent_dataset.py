@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from faceforge_core.latent_dataset import LatentDataset
+
+class TestLatentDataset(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "dataset")
+        self.dataset = LatentDataset(self.path, chunk_rows = 4)
+        self.rng = np.random.default_rng(0)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_chunked_append(self):
+        latents = self.rng.standard_normal((10, 3))
+        self.dataset.append(latents[:6])
+        self.dataset.append(latents[6:])
+        self.assertEqual(len(self.dataset), 10)
+        self.assertEqual([len(c) for c in self.dataset.chunks()], [4, 2, 4])
+        self.assertTrue(isinstance(next(self.dataset.chunks()), np.memmap))
+        self.assertTrue(np.allclose(self.dataset.load(), latents.astype(np.float32)))
+
+    def test_labels(self):
+        latents, labels = self.rng.standard_normal((5, 3)), np.array([0, 1, 1, 0, 1])
+        self.dataset.append(latents, labels)
+        self.assertEqual(self.dataset.label_columns, 1)
+        self.assertTrue(np.array_equal(self.dataset.labels()[:, 0], labels))
+        with self.assertRaises(ValueError):
+            self.dataset.append(latents) # Labels are required once the dataset has them
+        with self.assertRaises(ValueError):
+            self.dataset.append(self.rng.standard_normal((5, 4)), labels)
+
+    def test_hash(self):
+        self.assertIsNone(self.dataset.hash)
+        latents = self.rng.standard_normal((6, 3))
+        first = self.dataset.append(latents[:3])
+        second = self.dataset.append(latents[3:])
+        self.assertNotEqual(first, second)
+        # Same content in the same chunks, same hash
+        other = LatentDataset(os.path.join(self.tmp.name, "other"), chunk_rows = 4)
+        other.append(latents[:3])
+        self.assertEqual(other.append(latents[3:]), second)
+        changed = LatentDataset(os.path.join(self.tmp.name, "changed"), chunk_rows = 4)
+        changed.append(latents[:3])
+        self.assertNotEqual(changed.append(latents[3:] + 1), second)
+
+    def test_other_instance_sees_appends(self):
+        reader = LatentDataset(self.path)
+        self.assertEqual(len(reader), 0)
+        self.dataset.append(self.rng.standard_normal((3, 2)))
+        self.assertEqual(len(reader), 3)
+        self.assertEqual(reader.hash, self.dataset.hash)
+
+    def test_ingests_memory_mapped_files(self):
+        source = os.path.join(self.tmp.name, "latents.npy")
+        np.save(source, self.rng.standard_normal((9, 2)))
+        self.dataset.append(np.load(source, mmap_mode = "r"))
+        self.assertEqual(len(self.dataset.entries), 3)
+        self.assertTrue(np.allclose(self.dataset.load(), np.load(source)))
+
+    def test_cached_fit(self):
+        self.dataset.append(self.rng.standard_normal((3, 2)))
+        calls = []
+        def fit():
+            calls.append(1)
+            return {"value" : np.arange(3)}
+        self.assertTrue(np.array_equal(self.dataset.cached_fit({"method" : "test"}, fit)["value"], np.arange(3)))
+        self.assertTrue(np.array_equal(LatentDataset(self.path).cached_fit({"method" : "test"}, fit)["value"], np.arange(3)))
+        self.assertEqual(len(calls), 1)
+        self.dataset.cached_fit({"method" : "test", "param" : 1}, fit)
+        self.dataset.append(self.rng.standard_normal((1, 2))) # New content, new hash
+        self.dataset.cached_fit({"method" : "test"}, fit)
+        self.assertEqual(len(calls), 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -40,5 +40,25 @@ class TestLatentSpaceExplorer(unittest.TestCase):
         self.assertIsNotNone(sampled)
         self.assertEqual(sampled.shape, (2,))
 
+    def test_compressed_encodings(self):
+        rng = np.random.default_rng(0)
+        encodings = [rng.standard_normal(512) for _ in range(3)]
+        positions = [(0.0, 0.0), (1.0, 0.0), (0.0, 1.0)]
+        for i, (encoding, pos) in enumerate(zip(encodings, positions)):
+            self.explorer.add_point(str(i), encoding, pos)
+        expected = self.explorer.sample_encoding((0.3, 0.2))
+        for mode in ("fp16", "int8"):
+            explorer = LatentSpaceExplorer(compression=mode)
+            for i, (encoding, pos) in enumerate(zip(encodings, positions)):
+                explorer.add_point(str(i), encoding, pos)
+            sampled = explorer.sample_encoding((0.3, 0.2))
+            self.assertEqual(sampled.dtype, np.float64)
+            self.assertLess(np.linalg.norm(sampled - expected) / np.linalg.norm(expected), 1e-2)
+            self.assertLess(np.abs(explorer.get_encodings()[0] - encodings[0]).max(), 0.05)
+        memory = explorer.memory_per_anchor()
+        self.assertEqual(memory["anchors"], 3)
+        self.assertEqual(memory["bytes_per_anchor"], 512 + 4)
+        self.assertEqual(self.explorer.memory_per_anchor()["bytes_per_anchor"], 512 * 8)
+
 if __name__ == "__main__":
     unittest.main() 
\ No newline at end of file
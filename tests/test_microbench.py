@@ -0,0 +1,31 @@
+import unittest
+
+from benchmarks.micro import compare, run
+
+def results(**p50s):
+    return {"environment" : {}, "results" : {name : {"p50_ms" : ms} for name, ms in p50s.items()}}
+
+class TestCompare(unittest.TestCase):
+    def test_flags_slowdowns_past_threshold(self):
+        baseline = results(a = 10., b = 10., c = 10.)
+        current = results(a = 11.5, b = 10.5, c = 5.)
+        report = compare(baseline, current, threshold = 0.1)
+        self.assertEqual(report["regressions"], ["a"])
+        self.assertEqual(report["improvements"], ["c"])
+
+    def test_skips_cases_missing_from_either_run(self):
+        report = compare(results(a = 1., b = 1.), results(b = 1., c = 100.))
+        self.assertEqual([row[0] for row in report["rows"]], ["b"])
+        self.assertEqual(report["regressions"], [])
+
+class TestRun(unittest.TestCase):
+    def test_filtered_run(self):
+        res = run(filters = [r"explorer\.distance\[n=10,"], quick = True, min_time = 0., verbose = False)
+        self.assertEqual(list(res["results"]), ["explorer.distance[n=10,d=1280]"])
+        row = res["results"]["explorer.distance[n=10,d=1280]"]
+        self.assertGreaterEqual(row["iters"], 5)
+        self.assertLessEqual(row["p50_ms"], row["p95_ms"])
+        self.assertIn("torch", res["environment"])
+
+if __name__ == "__main__":
+    unittest.main()
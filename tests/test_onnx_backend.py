@@ -0,0 +1,61 @@
+import tempfile
+import unittest
+from faceforge_core.onnx_backend import GraphBackend, export_onnx
+from faceforge_core.fast_sd import TINY_MODEL_ID, fast_diffusion_pipeline, tiny_diffusion_pipeline
+
+try:
+    import onnxruntime
+    HAS_ONNXRUNTIME = True
+except ImportError:
+    HAS_ONNXRUNTIME = False
+
+@unittest.skipUnless(HAS_ONNXRUNTIME, "onnxruntime not installed")
+class TestOnnxBackend(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.pipe = tiny_diffusion_pipeline()
+        export_onnx(cls.pipe, cls.tmp.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def tearDown(self):
+        self.pipe.set_backend(None)
+
+    def render(self, encodes, **kwargs):
+        return self.pipe.generate_from_encodes(list(encodes), output_type = "np", **kwargs).images
+
+    def test_parity_with_torch(self):
+        encodes = self.pipe.get_encodes(["a cat", "a dog"])
+        latents = self.pipe.initial_latents(0, batch_size = 2)
+        expected = self.render(encodes, latents = latents)
+        self.pipe.set_backend(GraphBackend(self.tmp.name, "onnxruntime"))
+        res = self.render(encodes, latents = latents)
+        self.assertEqual(res.shape, expected.shape)
+        self.assertLess(abs(res - expected).max(), 1e-3)
+
+    def test_dynamic_resolution(self):
+        encodes = self.pipe.get_encodes("a cat")
+        latents = self.pipe.initial_latents(0, height = 32, width = 48)
+        expected = self.render(encodes, latents = latents, height = 32, width = 48)
+        self.pipe.set_backend(GraphBackend(self.tmp.name, "onnxruntime"))
+        res = self.render(encodes, latents = latents, height = 32, width = 48)
+        self.assertEqual(res.shape, (1, 32, 48, 3))
+        self.assertLess(abs(res - expected).max(), 1e-3)
+
+    def test_pipeline_frees_replaced_modules(self):
+        pipe = fast_diffusion_pipeline(model_id = TINY_MODEL_ID, device = "cpu", backend = "onnxruntime", onnx_dir = self.tmp.name)
+        self.assertTrue(all(p.is_meta for p in pipe.unet.parameters()))
+        self.assertTrue(all(p.is_meta for p in pipe.vae.decoder.parameters()))
+        self.assertEqual(pipe.device.type, "cpu")
+
+        encodes = self.pipe.get_encodes("a cat")
+        latents = self.pipe.initial_latents(0)
+        expected = self.render(encodes, latents = latents)
+        res = pipe.generate_from_encodes(list(pipe.get_encodes("a cat")), latents = latents, output_type = "np").images
+        self.assertLess(abs(res - expected).max(), 1e-3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import time
+import threading
+import unittest
+import numpy as np
+import torch
+from faceforge_core.preview import AnchorLatentCache
+from faceforge_core.sampling import CircleSampling, DistanceSampling
+from faceforge_core.fast_sd import tiny_diffusion_pipeline
+
+class TestSamplingLatents(unittest.TestCase):
+    def test_normalized_blend(self):
+        latents = torch.randn(3, 4, 8, 8)
+        res = DistanceSampling(latents, normalize = True)(np.zeros(2), np.random.randn(3, 2))
+        self.assertEqual(res.shape, (4, 8, 8))
+        # Identical anchors blend to themselves when coefs sum to 1
+        same = DistanceSampling(latents[:1].expand(3, -1, -1, -1), normalize = True)(np.zeros(2), np.random.randn(3, 2))
+        self.assertTrue(torch.allclose(same, latents[0], atol = 1e-5))
+
+    def test_zero_coefs_blend_to_mean(self):
+        # Circle sampling at the origin (the default player position) weights every anchor by 0
+        latents = torch.randn(3, 4, 8, 8)
+        res = CircleSampling(latents, normalize = True)(np.zeros(2), np.random.randn(3, 2))
+        self.assertFalse(torch.isnan(res).any())
+        self.assertTrue(torch.allclose(res, latents.mean(0), atol = 1e-5))
+
+class TestAnchorLatentCache(unittest.TestCase):
+    def setUp(self):
+        self.pipe = tiny_diffusion_pipeline()
+        self.prompts = ["a", "b", "c"]
+        self.encodings = [tuple(self.pipe.get_encodes(prompt)) for prompt in self.prompts]
+        self.cache = AnchorLatentCache(self.pipe, max_size = 3)
+
+    def test_single_anchor_matches_full_render(self):
+        full = self.pipe.generate_from_encodes(list(self.encodings[0]), latents = self.pipe.initial_latents(0), output_type = "np").images
+        preview = self.cache.preview(DistanceSampling, self.prompts[:1], self.encodings[:1], np.zeros(2), np.ones((1, 2)), output_type = "np")
+        self.assertEqual(preview.shape, full.shape)
+        self.assertTrue(np.allclose(preview, full, atol = 1e-5))
+
+    def test_circle_preview_at_origin(self):
+        preview = self.cache.preview(CircleSampling, self.prompts, self.encodings, np.zeros(2), np.random.randn(3, 2), output_type = "np")
+        self.assertFalse(np.isnan(preview).any())
+
+    def test_batched_matches_individual(self):
+        batched = self.cache.latents(self.prompts, self.encodings)
+        self.assertEqual(batched.shape, (3, 4, 8, 8))
+        for i in range(3):
+            single = AnchorLatentCache(self.pipe).latents(self.prompts[i:i+1], self.encodings[i:i+1])
+            self.assertTrue(torch.allclose(single[0], batched[i], rtol = 1e-4, atol = 1e-3))
+
+    def test_cached_and_evicted(self):
+        self.cache.latents(self.prompts, self.encodings)
+        calls = []
+        self.pipe.generate_from_encodes = lambda *args, **kwargs: calls.append(1)
+        self.cache.latents(self.prompts[::-1], self.encodings[::-1])
+        self.assertEqual(calls, [])
+
+        del self.pipe.generate_from_encodes
+        self.cache.latents(["d"], [tuple(self.pipe.get_encodes("d"))])
+        self.assertEqual(len(self.cache), 3)
+        self.assertNotIn(("c", None, None), self.cache.cache)
+
+    def test_concurrent_misses_render_once(self):
+        generate, calls = self.pipe.generate_from_encodes, []
+        def slow_generate(*args, **kwargs):
+            calls.append(1)
+            time.sleep(0.05) # Let the other threads reach the cache while this one renders
+            return generate(*args, **kwargs)
+        self.pipe.generate_from_encodes = slow_generate
+
+        results = []
+        threads = [threading.Thread(target = lambda: results.append(self.cache.latents(self.prompts, self.encodings))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 4)
+
+if __name__ == "__main__":
+    unittest.main()
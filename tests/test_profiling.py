@@ -0,0 +1,113 @@
+import io
+import json
+import asyncio
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+import httpx
+import torch
+import faceforge_api.main as api
+from faceforge_core.profiling import RequestProfiler, ProfilerBusy, profile_stage
+from faceforge_core.fast_sd import tiny_diffusion_pipeline
+
+class TestRequestProfiler(unittest.TestCase):
+    def test_profile_contents(self):
+        pipe = tiny_diffusion_pipeline()
+        encodes = pipe.get_encodes("a cat")
+        with RequestProfiler() as profiler:
+            pipe.generate_from_encodes(list(encodes), latents = pipe.initial_latents(0), output_type = "uint8")
+        self.assertGreater(profiler.ms, 0)
+        path = profiler.save(tempfile.mktemp(suffix = ".zip"), meta = {"prompt" : "a cat"})
+        with zipfile.ZipFile(path) as zf:
+            self.assertEqual(set(zf.namelist()), {"python.prof", "python.txt", "torch_ops.txt", "torch_trace.json", "meta.json"})
+            trace = zf.read("torch_trace.json").decode()
+            for stage in ("faceforge.prepare_latents", "faceforge.unet", "faceforge.scheduler_step", "faceforge.decode", "faceforge.postprocess"):
+                self.assertIn(stage, trace)
+            self.assertIn("generate_from_encodes", zf.read("python.txt").decode())
+            self.assertEqual(json.loads(zf.read("meta.json"))["prompt"], "a cat")
+
+    def test_stage_is_noop_without_profiler(self):
+        self.assertFalse(torch.autograd._profiler_enabled())
+        with mock.patch("faceforge_core.profiling.record_function") as record_function:
+            with profile_stage("faceforge.unet"):
+                pass
+        record_function.assert_not_called()
+
+    def test_one_at_a_time(self):
+        with RequestProfiler():
+            with self.assertRaises(ProfilerBusy):
+                with RequestProfiler():
+                    pass
+        with RequestProfiler():
+            pass
+
+    def test_failed_start_frees_profiler(self):
+        with mock.patch("cProfile.Profile.enable", side_effect = ValueError("Another profiling tool is already active")):
+            with self.assertRaises(ValueError):
+                with RequestProfiler():
+                    pass
+        self.assertFalse(torch.autograd._profiler_enabled())
+        with RequestProfiler():
+            pass
+
+class TestProfiledRequests(unittest.TestCase):
+    def setUp(self):
+        self.patches = [mock.patch.object(api, "ADMIN_TOKEN", "secret"), mock.patch.object(api, "PROFILE_DIR", tempfile.mkdtemp()),
+                        mock.patch.object(api, "PROFILE_KEEP", 2)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def request(self, method, path, **kwargs):
+        async def send():
+            async with httpx.AsyncClient(transport = httpx.ASGITransport(app = api.app), base_url = "http://api") as client:
+                return await client.request(method, path, **kwargs)
+        return asyncio.run(send())
+
+    def generate(self, headers = None, profile = True):
+        params = {"format" : "raw", "profile" : profile}
+        return self.request("POST", "/generate", json = {"prompts" : ["a cat", "a dog"]}, params = params, headers = headers)
+
+    def test_needs_admin_token(self):
+        self.assertEqual(self.generate().status_code, 403)
+        self.assertEqual(self.generate({"X-Admin-Token" : "wrong"}).status_code, 403)
+        with mock.patch.object(api, "ADMIN_TOKEN", None):
+            self.assertEqual(self.generate({"X-Admin-Token" : ""}).status_code, 403)
+
+    def test_unprofiled_by_default(self):
+        resp = self.generate(profile = False)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn("x-profile-id", resp.headers)
+
+    def test_download(self):
+        resp = self.generate({"X-Admin-Token" : "secret"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["x-image-shape"], "256,256,3")
+        url = resp.headers["x-profile-url"]
+        self.assertTrue(url.endswith("/profiles/" + resp.headers["x-profile-id"]))
+        self.assertEqual(self.request("GET", url).status_code, 403)
+        download = self.request("GET", url, headers = {"X-Admin-Token" : "secret"})
+        self.assertEqual(download.status_code, 200)
+        with zipfile.ZipFile(io.BytesIO(download.content)) as zf:
+            self.assertIn("faceforge.encode_image", zf.read("torch_trace.json").decode())
+            self.assertEqual(json.loads(zf.read("meta.json"))["path"], "/generate")
+
+    def test_header_and_retention(self):
+        ids = [self.generate({"X-Admin-Token" : "secret", "X-Profile" : "1"}, profile = False).headers["x-profile-id"] for _ in range(3)]
+        get = lambda profile_id: self.request("GET", f"/profiles/{profile_id}", headers = {"X-Admin-Token" : "secret"}).status_code
+        self.assertEqual([get(profile_id) for profile_id in ids], [404, 200, 200])
+        self.assertEqual(get("..%2F..%2Fetc%2Fpasswd"), 404)
+
+    def test_attribute_direction(self):
+        resp = self.request("POST", "/attribute_direction", params = {"profile" : True}, headers = {"X-Admin-Token" : "secret"},
+                            json = {"latents" : [[0., 1.], [1., 0.], [1., 1.], [0., 0.]], "labels" : [0, 1, 1, 0]})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("direction", resp.json())
+        self.assertIn("x-profile-id", resp.headers)
+
+if __name__ == "__main__":
+    unittest.main()
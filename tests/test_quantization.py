@@ -0,0 +1,61 @@
+import tempfile
+import unittest
+import torch
+from faceforge_core.quantization import (
+    Int8WeightOnlyLinear, DynamicInt8Linear, quantize_linear_layers, quantize_pipeline, module_nbytes,
+    load_quantized_components, save_quantized_components,
+)
+from faceforge_core.fast_sd import tiny_diffusion_pipeline
+
+class TestQuantization(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = torch.nn.Sequential(torch.nn.Linear(32, 64), torch.nn.GELU(), torch.nn.Sequential(torch.nn.Linear(64, 16)))
+        self.x = torch.randn(4, 7, 32)
+        self.expected = self.model(self.x)
+
+    def test_weight_only(self):
+        self.assertEqual(quantize_linear_layers(self.model, "weight_only"), 2)
+        self.assertIsInstance(self.model[0], Int8WeightOnlyLinear)
+        self.assertEqual(self.model[0].qweight.dtype, torch.int8)
+        self.assertTrue(torch.allclose(self.model(self.x), self.expected, atol = 0.05))
+
+    def test_weight_only_keeps_dtype(self):
+        model = self.model.to(torch.bfloat16)
+        quantize_linear_layers(model, "weight_only")
+        self.assertEqual(model(self.x.to(torch.bfloat16)).dtype, torch.bfloat16)
+
+    def test_dynamic(self):
+        self.assertEqual(quantize_linear_layers(self.model, "dynamic"), 2)
+        self.assertIsInstance(self.model[2][0], DynamicInt8Linear)
+        self.assertTrue(torch.allclose(self.model(self.x), self.expected, atol = 0.05))
+
+    def test_dynamic_needs_fp32(self):
+        with self.assertRaises(ValueError):
+            quantize_linear_layers(self.model.half(), "dynamic")
+
+    def test_smaller(self):
+        before = module_nbytes(self.model)
+        quantize_linear_layers(self.model, "weight_only")
+        self.assertLess(module_nbytes(self.model), before / 2)
+
+    def test_pipeline_cache_roundtrip(self):
+        pipe = tiny_diffusion_pipeline()
+        encodes = pipe.get_encodes("a cat")
+        quantize_pipeline(pipe, "dynamic")
+        expected = pipe.generate_from_encodes(list(encodes), latents = pipe.initial_latents(0), output_type = "np").images
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.assertEqual(load_quantized_components(cache_dir, "tiny", "dynamic", torch.float32), {})
+            save_quantized_components(pipe, cache_dir, "tiny", "dynamic", torch.float32)
+            components = load_quantized_components(cache_dir, "tiny", "dynamic", torch.float32)
+
+        self.assertEqual(set(components), {"unet", "text_encoder", "text_encoder_2"})
+        fresh = tiny_diffusion_pipeline()
+        for name, component in components.items():
+            setattr(fresh, name, component)
+        res = fresh.generate_from_encodes(list(encodes), latents = fresh.initial_latents(0), output_type = "np").images
+        self.assertTrue((res == expected).all())
+
+if __name__ == "__main__":
+    unittest.main()
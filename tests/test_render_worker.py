@@ -0,0 +1,60 @@
+import threading
+import unittest
+from faceforge_core.render_worker import RenderWorker
+
+class TestRenderWorker(unittest.TestCase):
+    def setUp(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.rendered = []
+
+        def render(job):
+            self.started.set()
+            self.release.wait(5)
+            if job == "bad":
+                raise RuntimeError("render failed")
+            self.rendered.append(job)
+            return job * 2
+        self.worker = RenderWorker(render)
+
+    def tearDown(self):
+        self.release.set()
+        self.worker.stop()
+
+    def test_latest_wins(self):
+        self.worker.submit(1)
+        self.assertTrue(self.started.wait(5))
+        # Posted while 1 is rendering, only the newest survives
+        for job in (2, 3, 4):
+            self.worker.submit(job)
+        self.assertIsNone(self.worker.poll())
+
+        self.release.set()
+        self.assertTrue(self.worker.wait(5))
+        self.assertEqual(self.rendered, [1, 4])
+        job, result, ms = self.worker.poll()
+        self.assertEqual((job, result), (4, 8))
+        self.assertGreaterEqual(ms, 0)
+        self.assertIsNone(self.worker.poll())
+        self.assertTrue(self.worker.idle)
+
+    def test_cancel(self):
+        self.worker.submit(1)
+        self.assertTrue(self.started.wait(5))
+        self.worker.submit(2)
+        self.worker.cancel() # Drops 2, 1 is already running
+        self.release.set()
+        self.assertTrue(self.worker.wait(5))
+        self.assertEqual(self.rendered, [1])
+
+    def test_survives_failed_render(self):
+        self.release.set()
+        self.worker.submit("bad")
+        self.assertTrue(self.worker.wait(5))
+        self.assertIsNone(self.worker.poll())
+        self.worker.submit(5)
+        self.assertTrue(self.worker.wait(5))
+        self.assertEqual(self.worker.poll()[1], 10)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import csv
+import os
+import tempfile
+import unittest
+from faceforge_core.telemetry import LatencyStats, StageTimer, adaptive_interval
+
+class TestLatencyStats(unittest.TestCase):
+    def setUp(self):
+        self.stats = LatencyStats(window = 10)
+        for i in range(20):
+            self.stats.record(float(i), "full" if i % 2 else "low", {"unet" : i / 2, "decode" : 1.})
+
+    def test_rolling_window(self):
+        self.assertEqual(len(self.stats), 10)
+        self.assertEqual(self.stats.values().min(), 10)
+        self.assertEqual(self.stats.percentile(50, "full"), 15)
+        self.assertIsNone(self.stats.percentile(50, "preview"))
+
+    def test_summary(self):
+        summary = self.stats.summary()
+        self.assertEqual(set(summary), {"full", "low"})
+        self.assertEqual(summary["low"]["n"], 5)
+        self.assertEqual(summary["low"]["p50"], 14)
+        self.assertEqual(summary["low"]["stages"], {"unet" : 7., "decode" : 1.})
+        self.assertEqual(len(self.stats.lines()), 4)
+
+    def test_csv(self):
+        self.stats.record(3., "preview", {"latents" : 2.})
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "latency.csv")
+            self.stats.to_csv(path)
+            with open(path) as f:
+                rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(rows[-1]["tier"], "preview")
+        self.assertEqual(rows[-1]["unet"], "")
+        self.assertEqual(float(rows[-1]["latents"]), 2.)
+
+    def test_adaptive_interval(self):
+        self.assertIsNone(adaptive_interval(LatencyStats()))
+        interval = adaptive_interval(self.stats, "full")
+        self.assertGreater(interval, self.stats.percentile(50, "full"))
+        self.assertLess(interval, self.stats.percentile(95, "full"))
+        self.assertEqual(adaptive_interval(self.stats, "full", max_ms = 5), 5)
+
+    def test_stage_timer(self):
+        timer = StageTimer("cpu")
+        for _ in range(2):
+            with timer.stage("a"):
+                pass
+        self.assertEqual(list(timer.stages), ["a"])
+        self.assertGreaterEqual(timer.stages["a"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import unittest
+import numpy as np
+import torch
+import pygame
+import faceforge_api.main as api
+from faceforge_core import LatentSpaceExplorer, GameConfig
+from faceforge_core.fast_sd import TINY_MODEL_ID, fast_diffusion_pipeline, tiny_diffusion_pipeline
+from faceforge_core.hacked_sdxl_pipeline import HackedSDXLPipeline
+
+class TestTinyPipeline(unittest.TestCase):
+    def setUp(self):
+        self.pipe = tiny_diffusion_pipeline()
+
+    def test_sdxl_layouts(self):
+        self.assertIsInstance(self.pipe, HackedSDXLPipeline)
+        encodes = self.pipe.get_encodes(["A photo of a cat", "A photo of a dog"])
+        self.assertEqual(encodes[0].shape, (2, 77, 16))
+        self.assertEqual(encodes[2].shape, (2, 8))
+        self.assertEqual(self.pipe.initial_latents(0).shape, (1, 4, 8, 8))
+        images = self.pipe.generate_from_encodes(list(encodes), output_type = "uint8").images
+        self.assertEqual(images.shape, (2, 64, 64, 3))
+        self.assertEqual(self.pipe.generate_from_encodes(list(encodes), height = 128, width = 96, output_type = "uint8").images.shape, (2, 128, 96, 3))
+
+    def test_deterministic(self):
+        other = tiny_diffusion_pipeline()
+        encodes = self.pipe.get_encodes(["A photo of a cat"])
+        self.assertTrue(torch.equal(encodes[0], other.get_encodes(["A photo of a cat"])[0]))
+        render = lambda pipe: pipe.generate_from_encodes(list(encodes), latents = pipe.initial_latents(0), output_type = "uint8").images
+        self.assertTrue((render(self.pipe) == render(other)).all())
+        self.assertFalse(torch.equal(tiny_diffusion_pipeline(seed = 1).get_encodes(["A photo of a cat"])[0], encodes[0]))
+
+    def test_leaves_global_rng_alone(self):
+        torch.manual_seed(5)
+        expected = torch.rand(3)
+        torch.manual_seed(5)
+        tiny_diffusion_pipeline()
+        self.assertTrue(torch.equal(torch.rand(3), expected))
+
+    def test_selected_by_model_id(self):
+        pipe = fast_diffusion_pipeline(model_id = TINY_MODEL_ID, device = "cpu", dtype = "bf16")
+        self.assertIsInstance(pipe, HackedSDXLPipeline)
+        self.assertEqual(pipe.unet.dtype, torch.bfloat16)
+        self.assertEqual(pipe.text_encoder_2.dtype, torch.bfloat16)
+
+class TestTinyEndToEnd(unittest.TestCase):
+    def test_api_generate(self):
+        model_id, pipe, anchor_latents = api.MODEL_ID, api.pipe, api.anchor_latents
+        api.MODEL_ID, api.pipe = TINY_MODEL_ID, None
+        try:
+            image = api.generate(["A photo of a cat", "A photo of a dog"], player_pos = [0.2, 0.1])
+            preview = api.generate(["A photo of a cat", "A photo of a dog"], player_pos = [0.2, 0.1], preview = True)
+        finally:
+            api.MODEL_ID, api.pipe, api.anchor_latents = model_id, pipe, anchor_latents
+        self.assertEqual(image.shape, (64, 64, 3))
+        self.assertEqual(preview.shape, (64, 64, 3))
+
+    def test_headless_explorer(self):
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        config = GameConfig(model_id = TINY_MODEL_ID, device = "cpu", width = 320, height = 240, sample_width = 64, sample_height = 64,
+                            threaded = False, call_every = 0, adaptive_call_every = False)
+        explorer = LatentSpaceExplorer(config)
+        explorer.set_prompts(["A photo of a cat", "A photo of a dog"])
+        explorer.player_pos = np.array([0.3, 0.3])
+        explorer.draw_sample()
+        self.assertEqual(explorer.sample_image.shape, (64, 64, 3))
+        pygame.quit()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import asyncio
+import unittest
+from unittest import mock
+import numpy as np
+
+try:
+    import gradio
+    HAS_GRADIO = True
+except ImportError:
+    HAS_GRADIO = False
+
+@unittest.skipUnless(HAS_GRADIO, "gradio not installed")
+class TestLocalApi(unittest.TestCase):
+    def setUp(self):
+        import faceforge_ui.app as ui
+        self.ui = ui
+        self.calls = []
+
+    def tearDown(self):
+        self.ui.use_local_api(None)
+
+    def test_calls_service_without_http(self):
+        image = np.zeros((8, 8, 3), dtype = np.uint8)
+        def generate(prompts, mode, player_pos, preview):
+            self.calls.append((prompts, mode, player_pos, preview))
+            return image
+
+        self.ui.use_local_api(generate)
+        with mock.patch.object(self.ui, "get_client", side_effect = AssertionError("HTTP used")):
+            img, status = asyncio.run(self.ui.generate_image("a cat, a dog", "circle", 0.5, -0.5))
+        self.assertIs(img, image)
+        self.assertEqual(self.calls, [(["a cat", "a dog"], "circle", [0.5, -0.5], False)])
+
+    def test_api_service(self):
+        from faceforge_api.main import generate
+        self.ui.use_local_api(generate)
+        img, status = asyncio.run(self.ui.generate_image("a cat, a dog", "distance", 0., 0.))
+        self.assertEqual(img.dtype, np.uint8)
+        self.assertEqual(img.shape[2], 3)
+
+    def test_http_when_not_registered(self):
+        client = mock.Mock(agenerate = mock.AsyncMock(side_effect = self.ui.ApiError(503, "")))
+        with mock.patch.object(self.ui, "API_URL", "http://remote:8000"), mock.patch.object(self.ui, "get_client", return_value = client) as get_client:
+            img, status = asyncio.run(self.ui.generate_image("a cat", "distance", 0., 0.))
+        get_client.assert_called_once_with("http://remote:8000")
+        self.assertIsNone(img)
+        self.assertEqual(status, "API error: 503")
+
+@unittest.skipUnless(HAS_GRADIO, "gradio not installed")
+class TestLiveUpdates(unittest.TestCase):
+    def setUp(self):
+        import faceforge_ui.app as ui
+        self.ui = ui
+        self.calls = []
+        ui.use_local_api(lambda prompts, mode, player_pos, preview: self.calls.append(preview) or np.zeros((8, 8, 3), dtype = np.uint8))
+
+    def tearDown(self):
+        self.ui.use_local_api(None)
+
+    def request(self, session = "s"):
+        return mock.Mock(session_hash = session)
+
+    def live(self, fn, x, live = True, session = "s"):
+        """
+        Debounce step then render step, as the slider events chain them
+        """
+        async def event():
+            event_id = await self.ui.debounce(live, self.request(session))
+            return await fn("a cat", "distance", x, 0., event_id, self.request(session))
+        return event()
+
+    def test_preview_while_dragging(self):
+        asyncio.run(self.live(self.ui.live_generate, 0.1))
+        asyncio.run(self.live(self.ui.live_release, 0.1))
+        self.assertEqual(self.calls, [True, False])
+
+    def test_superseded_events_dropped(self):
+        async def events():
+            first = asyncio.create_task(self.live(self.ui.live_generate, 0.1))
+            await asyncio.sleep(0.05)
+            other_session = asyncio.create_task(self.live(self.ui.live_generate, 0.1, session = "t"))
+            last = asyncio.create_task(self.live(self.ui.live_generate, 0.2))
+            return await asyncio.gather(first, other_session, last)
+
+        with mock.patch.object(self.ui, "LIVE_DEBOUNCE_MS", 200):
+            results = asyncio.run(events())
+        self.assertIsInstance(results[0][0], type(self.ui.gr.skip()))
+        self.assertIsInstance(results[1][0], np.ndarray)
+        self.assertIsInstance(results[2][0], np.ndarray)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_superseded_while_waiting_for_slot(self):
+        async def events():
+            event_id = await self.ui.debounce(True, self.request())
+            await self.ui.debounce(True, self.request()) # Newer event debounced while the render waited
+            return await self.ui.live_generate("a cat", "distance", 0.1, 0., event_id, self.request())
+
+        self.assertIsInstance(asyncio.run(events())[0], type(self.ui.gr.skip()))
+        self.assertEqual(self.calls, [])
+
+    def test_live_off(self):
+        asyncio.run(self.live(self.ui.live_generate, 0.1, live = False))
+        self.assertEqual(self.calls, [])
+
+    def test_session_end_forgets_events(self):
+        asyncio.run(self.live(self.ui.live_generate, 0.1, session = "gone"))
+        self.assertIn("gone", self.ui.live_events)
+        self.ui.end_session(self.request("gone"))
+        self.assertNotIn("gone", self.ui.live_events)
+
+    def test_queue_limits(self):
+        demo = self.ui.create_demo()
+        self.assertEqual(demo._queue.max_size, self.ui.QUEUE_MAX_SIZE)
+        fns = [fn for fn in demo.fns.values() if fn.name in ("generate_image", "live_generate", "live_release")]
+        self.assertEqual(len(fns), 5)
+        self.assertEqual({fn.concurrency_id for fn in fns}, {"generate"})
+        self.assertEqual({fn.concurrency_limit for fn in fns}, {self.ui.QUEUE_CONCURRENCY})
+
+        # Debouncing doesn't take the generation slot
+        debounces = [fn for fn in demo.fns.values() if fn.name == "debounce"]
+        self.assertEqual(len(debounces), 4)
+        self.assertEqual({fn.concurrency_id for fn in debounces}, {"debounce"})
+        self.assertEqual({fn.concurrency_limit for fn in debounces}, {None})
+        self.assertEqual({fn.trigger_mode for fn in debounces}, {"always_last"})
+        self.assertEqual(sum(fn.name == "end_session" for fn in demo.fns.values()), 1)
+
+if __name__ == "__main__":
+    unittest.main()